@@ -0,0 +1,1464 @@
+"""Performance benchmarks for the Beaver's Choice multi-agent system.
+
+Each benchmark builds its own synthetic SQLite ledger in a temporary directory,
+points the helper functions at it, and reports wall-clock timings. The real
+`munder_difflin.db` is never touched and no model calls are made (the model
+scheduler benchmark drives a simulated provider, the end-to-end benchmark a
+local StubModel).
+
+Run from the project/ directory:
+
+    python benchmarks.py                   # run every benchmark
+    python benchmarks.py demand_forecast   # run selected benchmarks by name
+
+    python benchmarks.py helpers end_to_end --runs 3 --save-baseline benchmark_baseline.json
+    python benchmarks.py helpers end_to_end --runs 3 --compare benchmark_baseline.json
+
+`--compare` exits with status 1 when a timing or throughput metric is worse
+than the baseline by more than `--tolerance` (25% by default).
+"""
+
+import contextlib
+import io
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+# The agents are built at import time; benchmarks never call the model
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, Engine
+
+import project_starter as ps
+
+
+# -----------------------------------------------------------------------------
+# Synthetic data
+# -----------------------------------------------------------------------------
+
+def build_synthetic_ledger(
+    path: str,
+    n_items: int,
+    sales_per_item: int = 5,
+    history_days: int = 60,
+    end_date: str = "2025-04-30",
+    seed: int = 137,
+    n_quotes: int = 0,
+) -> Engine:
+    """Create a SQLite ledger with `n_items` catalog items and random sales history.
+
+    Every item gets one initial stock order on the first history day plus
+    `sales_per_item` sales spread uniformly over the remaining days. With
+    `n_quotes`, the `quotes` and `quote_requests` tables get that many rows.
+    """
+    rng = np.random.default_rng(seed)
+    engine = create_engine(f"sqlite:///{path}")
+
+    names = np.array([f"SKU-{i:07d}" for i in range(n_items)])
+    unit_price = np.round(rng.uniform(0.02, 3.0, n_items), 2)
+    initial_stock = rng.integers(200, 800, n_items)
+    inventory = pd.DataFrame({
+        "item_name": names,
+        "category": rng.choice(["paper", "product", "large_format", "specialty"], n_items),
+        "unit_price": unit_price,
+        "current_stock": initial_stock,
+        "min_stock_level": rng.integers(50, 150, n_items),
+    })
+    inventory.to_sql("inventory", engine, if_exists="replace", index=False)
+
+    start = np.datetime64(end_date, "D") - np.timedelta64(history_days, "D")
+    stock_orders = pd.DataFrame({
+        "id": None,
+        "item_name": names,
+        "transaction_type": "stock_orders",
+        "units": initial_stock,
+        "price": initial_stock * unit_price,
+        "transaction_date": str(start),
+    })
+    sale_items = np.repeat(np.arange(n_items), sales_per_item)
+    sale_units = rng.integers(1, 40, len(sale_items))
+    sale_days = start + rng.integers(1, history_days + 1, len(sale_items)).astype("timedelta64[D]")
+    sales = pd.DataFrame({
+        "id": None,
+        "item_name": names[sale_items],
+        "transaction_type": "sales",
+        "units": sale_units,
+        "price": sale_units * unit_price[sale_items],
+        "transaction_date": np.datetime_as_string(sale_days, unit="D"),
+    })
+    cash = pd.DataFrame([{
+        "id": None, "item_name": None, "transaction_type": "sales",
+        "units": None, "price": 50000.0, "transaction_date": str(start),
+    }])
+    pd.concat([cash, stock_orders, sales]).to_sql(
+        "transactions", engine, if_exists="replace", index=False, chunksize=50_000
+    )
+    if n_quotes:
+        events = np.array(["wedding", "conference", "party", "exhibition", "school board meeting"])
+        quote_items = names[rng.integers(0, n_items, n_quotes)]
+        quote_events = events[rng.integers(0, len(events), n_quotes)]
+        pd.DataFrame({
+            "id": np.arange(n_quotes),
+            "response": [f"I need {item} for a {event}" for item, event in zip(quote_items, quote_events)],
+        }).to_sql("quote_requests", engine, if_exists="replace", index=False, chunksize=50_000)
+        pd.DataFrame({
+            "request_id": np.arange(n_quotes),
+            "total_amount": rng.integers(20, 2000, n_quotes),
+            "quote_explanation": [f"Bulk pricing for {item}" for item in quote_items],
+            "job_type": "office manager",
+            "order_size": rng.choice(["small", "medium", "large"], n_quotes),
+            "event_type": quote_events,
+            "order_date": np.datetime_as_string(start + rng.integers(0, history_days, n_quotes).astype("timedelta64[D]")),
+        }).to_sql("quotes", engine, if_exists="replace", index=False, chunksize=50_000)
+    ps.ensure_ledger_schema(engine)
+    return engine
+
+
+def build_quote_history(
+    path: str,
+    n_quotes: int,
+    years: int = 3,
+    end_date: str = "2025-04-30",
+    seed: int = 137,
+    chunk_size: int = 250_000,
+) -> Engine:
+    """Create a SQLite database holding only `quote_requests` and `quotes`, with
+    `n_quotes` verbose quotes over `years` of history, written in chunks so that
+    multi-million-row histories fit in memory.
+
+    Texts are assembled from boilerplate sentences, catalog items, quantities,
+    prices and dates the way the real quote_requests.csv / quotes.csv read. Every
+    quote gets a distinct order timestamp so "newest first" has no ties.
+    """
+    rng = np.random.default_rng(seed)
+    engine = create_engine(f"sqlite:///{path}")
+    items = [item["item_name"] for item in ps.paper_supplies]
+    prices = [item["unit_price"] for item in ps.paper_supplies]
+    events = ["wedding", "conference", "party", "exhibition", "school board meeting", "festival", "workshop", "gala"]
+    sizes = ["small", "medium", "large"]
+    jobs = ["office manager", "event planner", "teacher", "marketing lead"]
+    openers = [
+        "I would like to request a large order of high-quality paper supplies for an upcoming {}. ",
+        "I need to order some supplies for our {}. ",
+        "Our team is organizing a {} and needs printed materials. ",
+        "Hello, we are preparing for a {} next month. ",
+    ]
+    closers = ["Thank you.", "Thanks in advance!", "Please let me know if you need anything else."]
+    signoffs = [
+        "We appreciate your business and look forward to serving you again.",
+        "This brings your total to a rounded and friendly price, making it easier for your budgeting needs.",
+        "Please let us know if you would like to adjust any quantities.",
+    ]
+    quantities = np.array([10, 20, 50, 100, 200, 250, 500, 1000, 2000, 5000])
+    discounts = np.array([0, 5, 10, 15, 20])
+
+    span = int(years * 365 * 86400)
+    start = np.datetime64(end_date, "s") - np.timedelta64(span, "s")
+    # Distinct, shuffled timestamps: one slot of span / n_quotes seconds per quote
+    stamps = start + (np.arange(n_quotes, dtype=np.int64) * span // n_quotes).astype("timedelta64[s]")
+    stamps = stamps[rng.permutation(n_quotes)]
+    for begin in range(0, n_quotes, chunk_size):
+        n = min(chunk_size, n_quotes - begin)
+        ids = np.arange(begin, begin + n)
+        event, size, job = rng.integers(0, len(events), n), rng.integers(0, 3, n), rng.integers(0, len(jobs), n)
+        first, second = rng.integers(0, len(items), n), rng.integers(0, len(items), n)
+        q1, q2 = quantities[rng.integers(0, len(quantities), n)], quantities[rng.integers(0, len(quantities), n)]
+        opener, closer, signoff = rng.integers(0, len(openers), n), rng.integers(0, 3, n), rng.integers(0, 3, n)
+        discount = discounts[rng.integers(0, len(discounts), n)]
+        order_dates = stamps[begin:begin + n]
+        deliveries = pd.to_datetime(order_dates + rng.integers(3, 30, n).astype("timedelta64[D]")).strftime("%B %d, %Y")
+        requests, explanations, totals = [], [], []
+        for i in range(n):
+            a, b = items[first[i]], items[second[i]]
+            requests.append(
+                openers[opener[i]].format(events[event[i]])
+                + f"We need {q1[i]} sheets of {a}. We also need {q2[i]} sheets of {b}. "
+                + f"Please ensure the delivery is made by {deliveries[i]}. " + closers[closer[i]]
+            )
+            subtotal = q1[i] * prices[first[i]] + q2[i] * prices[second[i]]
+            total = max(1, round(subtotal * (100 - discount[i]) / 100))
+            totals.append(total)
+            explanations.append(
+                f"Thank you for your {sizes[size[i]]} order! "
+                f"We have calculated the costs for {q1[i]} sheets of {a} at ${prices[first[i]]:.2f} each. "
+                f"We have calculated the costs for {q2[i]} sheets of {b} at ${prices[second[i]]:.2f} each. "
+                + (f"To reward your bulk order, we are pleased to offer a {discount[i]}% discount on the total. " if discount[i] else "")
+                + f"The total comes to ${total}. " + signoffs[signoff[i]]
+            )
+        mode = "replace" if begin == 0 else "append"
+        pd.DataFrame({"id": ids, "response": requests}).to_sql("quote_requests", engine, if_exists=mode, index=False)
+        pd.DataFrame({
+            "request_id": ids,
+            "total_amount": totals,
+            "quote_explanation": explanations,
+            "order_date": np.datetime_as_string(order_dates, unit="s"),
+            "job_type": np.array(jobs)[job],
+            "order_size": np.array(sizes)[size],
+            "event_type": np.array(events)[event],
+        }).to_sql("quotes", engine, if_exists=mode, index=False)
+    return engine
+
+
+@contextmanager
+def use_engine(engine: Engine):
+    """Temporarily point every helper in project_starter at `engine`."""
+    previous = ps.db_engine
+    ps.db_engine = engine
+    ps.inventory_catalogs.reset()
+    ps.quote_templates.reset()
+    ps.quote_archives.reset()
+    ps.stock_counters.get().reset()
+    try:
+        yield engine
+    finally:
+        ps.db_engine = previous
+        ps.inventory_catalogs.reset()
+        ps.quote_templates.reset()
+        ps.quote_archives.reset()
+        ps.stock_counters.get().reset()
+
+
+@contextmanager
+def ledger_snapshots(enabled: bool):
+    """Temporarily route analytics through (or around) the columnar ledger snapshot."""
+    previous = ps.LEDGER_SNAPSHOT_ENABLED
+    ps.LEDGER_SNAPSHOT_ENABLED = enabled
+    try:
+        yield
+    finally:
+        ps.LEDGER_SNAPSHOT_ENABLED = previous
+
+
+@contextmanager
+def quiet_output():
+    """Discard stdout, including queued progress lines, inside the block."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            yield
+        finally:
+            ps.flush_logs()
+
+
+def timed(fn: Callable, *args, repeat: int = 1, **kwargs):
+    """Return (best wall-clock seconds, last result) over `repeat` calls."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+# -----------------------------------------------------------------------------
+# Benchmarks
+# -----------------------------------------------------------------------------
+
+def bench_reorder_planner(n_items: int = 100_000) -> Dict:
+    """Plan and bulk-record reorders for a large catalog (target: under one second)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = build_synthetic_ledger(os.path.join(tmp, "ledger.db"), n_items)
+        with use_engine(engine):
+            plan_seconds, plan = timed(ps.plan_stock_reorders, "2025-04-30", repeat=3)
+            place_seconds, txn_ids = timed(ps.place_stock_orders, plan)
+        engine.dispose()
+
+    total = plan_seconds + place_seconds
+    return {
+        "n_items": n_items,
+        "orders_planned": len(plan),
+        "orders_recorded": len(txn_ids),
+        "plan_seconds": round(plan_seconds, 4),
+        "bulk_insert_seconds": round(place_seconds, 4),
+        "total_seconds": round(total, 4),
+        "under_one_second": total < 1.0,
+    }
+
+
+def bench_demand_forecast(n_items: int = 100_000, years: int = 3, sale_day_fraction: float = 0.1) -> Dict:
+    """Fit SMA/SES demand models for every item over years of daily sales history.
+
+    `sale_day_fraction` is the share of (item, day) cells with a sale; 0.1 gives
+    about 11M sales rows for 100k items over 3 years.
+    """
+    rng = np.random.default_rng(137)
+    n_days = 365 * years
+    end_day = ps.DemandForecaster.to_day("2025-04-30")
+    n_sales = int(n_items * n_days * sale_day_fraction)
+    codes = rng.integers(0, n_items, n_sales, dtype=np.int64)
+    days = end_day - rng.integers(0, n_days, n_sales, dtype=np.int64)
+    units = rng.integers(1, 50, n_sales).astype(float)
+    names = [f"SKU-{i:07d}" for i in range(n_items)]
+
+    forecaster = ps.DemandForecaster()
+    fit_seconds, _ = timed(forecaster.fit_arrays, names, codes, days, units, end_day, repeat=3)
+    rates_seconds, rates = timed(forecaster.daily_rates, "2025-05-07", repeat=3)
+
+    n_updates = 10_000
+    update_items = rng.integers(0, n_items, n_updates)
+    update_days = np.datetime_as_string(
+        np.datetime64("2025-04-30") + rng.integers(0, 7, n_updates).astype("timedelta64[D]"), unit="D"
+    )
+    start = time.perf_counter()
+    for item, day in zip(update_items, np.sort(update_days)):
+        forecaster.observe(names[item], 10.0, day)
+    observe_seconds = time.perf_counter() - start
+
+    return {
+        "n_items": n_items,
+        "history_days": n_days,
+        "sales_rows": n_sales,
+        "fit_seconds": round(fit_seconds, 4),
+        "fit_rows_per_second": int(n_sales / fit_seconds),
+        "daily_rates_seconds": round(rates_seconds, 4),
+        "incremental_observe_us": round(observe_seconds / n_updates * 1e6, 2),
+        "items_with_demand": int((rates["ses"] > 0).sum()),
+    }
+
+
+def _run_concurrent_sales(sell: Callable, writers: int, attempts_per_writer: int, n_items: int) -> Dict:
+    """Run `sell(item, qty, date)` from `writers` threads against a fresh ledger."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ledger.db")
+        build_synthetic_ledger(path, n_items, sales_per_item=0).dispose()
+        engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 60}, pool_size=writers)
+        with use_engine(engine):
+            ps.stock_counter.reset()
+            ps.stock_counter.stats.update(dict.fromkeys(ps.stock_counter.stats, 0))
+            names = [f"SKU-{i:07d}" for i in range(n_items)]
+
+            def writer(seed: int) -> int:
+                rng = np.random.default_rng(seed)
+                sold = 0
+                for _ in range(attempts_per_writer):
+                    item = names[rng.integers(n_items)]
+                    if sell(item, int(rng.integers(1, 40)), "2025-04-30") is not None:
+                        sold += 1
+                return sold
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(writers) as pool:
+                committed = sum(pool.map(writer, range(writers)))
+            elapsed = time.perf_counter() - start
+
+            final_stock = pd.read_sql(
+                """
+                SELECT item_name, SUM(CASE WHEN transaction_type = 'stock_orders' THEN units
+                                           ELSE -units END) AS stock
+                FROM transactions WHERE item_name IS NOT NULL GROUP BY item_name
+                """,
+                engine,
+            )["stock"]
+            stats = dict(ps.stock_counter.stats)
+            ps.stock_counter.reset()
+        engine.dispose()
+
+    attempts = writers * attempts_per_writer
+    return {
+        "committed": committed,
+        "elapsed": elapsed,
+        "attempts": attempts,
+        "stats": stats,
+        "min_final_stock": int(final_stock.min()),
+    }
+
+
+def bench_concurrent_sales(writers: int = 64, attempts_per_writer: int = 50, n_items: int = 8) -> Dict:
+    """Hammer the sale path from many threads and check stock never goes negative.
+
+    Few items and large orders keep contention high. The naive path (stock check,
+    then an unconditional insert) is run first for comparison.
+    """
+    def naive_sell(item, quantity, date):
+        if int(ps.get_stock_level(item, date)["current_stock"].iloc[0]) < quantity:
+            return None
+        return ps.create_transaction(item, "sales", quantity, 0.0, date)
+
+    naive = _run_concurrent_sales(naive_sell, writers, attempts_per_writer, n_items)
+    reserved = _run_concurrent_sales(ps.reserve_and_sell, writers, attempts_per_writer, n_items)
+    attempts, stats = reserved["attempts"], reserved["stats"]
+    return {
+        "writers": writers,
+        "attempts": attempts,
+        "naive_min_final_stock": naive["min_final_stock"],
+        "committed": reserved["committed"],
+        "attempts_per_second": int(attempts / reserved["elapsed"]),
+        "commits_per_second": int(reserved["committed"] / reserved["elapsed"]),
+        "fast_reject_rate": round(stats["fast_rejects"] / attempts, 3),
+        "ledger_reject_rate": round(stats["ledger_rejects"] / attempts, 3),
+        "min_final_stock": reserved["min_final_stock"],
+        "no_negative_stock": reserved["min_final_stock"] >= 0,
+    }
+
+
+class _SimulatedProvider:
+    """Model endpoint that answers 429 beyond `max_concurrent` calls or `requests_per_second`."""
+
+    class RateLimited(Exception):
+        status_code = 429
+
+    def __init__(self, requests_per_second: float, max_concurrent: int, latency: float):
+        self.rate = requests_per_second
+        self.max_concurrent = max_concurrent
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.tokens = requests_per_second
+        self.refilled_at = time.monotonic()
+        self.rejected = 0
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            if self.in_flight >= self.max_concurrent or self.tokens < 1:
+                self.rejected += 1
+                raise self.RateLimited("429 Too Many Requests")
+            self.tokens -= 1
+            self.in_flight += 1
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+        return "ok"
+
+
+def bench_model_scheduler(
+    calls: int = 300, workers: int = 16, provider_rps: float = 40.0, latency: float = 0.05
+) -> Dict:
+    """Drive a simulated provider from many threads through the adaptive limiter.
+
+    Compares throughput with the fixed one-request-per-second pacing the batch
+    runner used before, and checks that high-priority (sales) calls queue less.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    provider = _SimulatedProvider(provider_rps, max_concurrent=6, latency=latency)
+    limiter = ps.AdaptiveRateLimiter(
+        requests_per_minute=provider_rps * 60, max_concurrency=workers,
+        target_latency=1.0, max_retries=8, base_delay=0.05, max_delay=1.0,
+    )
+    agents = list(ps.AGENT_PRIORITIES)
+    waits = {agent: [] for agent in agents}
+
+    def one_call(i: int) -> None:
+        agent = agents[i % len(agents)]
+        start = time.perf_counter()
+        limiter.call(provider, priority=ps.AGENT_PRIORITIES[agent], agent_name=agent)
+        waits[agent].append(time.perf_counter() - start)
+
+    printed = ps.print_step
+    ps.print_step = lambda *args, **kwargs: None
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(one_call, range(calls)))
+        elapsed = time.perf_counter() - start
+    finally:
+        ps.print_step = printed
+
+    return {
+        "calls": calls,
+        "provider_limit_rps": provider_rps,
+        "throughput_rps": round(calls / elapsed, 1),
+        "fixed_pacing_rps": 1.0,
+        "provider_429s": provider.rejected,
+        "retries": limiter.stats["retries"],
+        "failed": limiter.stats["failed"],
+        "final_concurrency_limit": round(limiter.concurrency_limit, 2),
+        "sales_mean_latency_ms": round(1000 * np.mean(waits["sales"]), 1),
+        "advisor_mean_latency_ms": round(1000 * np.mean(waits["advisor"]), 1),
+    }
+
+
+def bench_tenant_scaling(
+    tenant_counts=(1, 16, 64, 256), n_items: int = 200, calls_per_tenant: int = 10, workers: int = 8
+) -> Dict:
+    """Per-tenant helper latency as the number of tenant shards grows.
+
+    Every tenant gets its own copy of a small synthetic ledger. Threads pick
+    tenants at random and run a stock check, a cash balance and a reserved sale
+    inside that tenant's scope.
+    """
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    names = [f"SKU-{i:07d}" for i in range(n_items)]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        template = os.path.join(tmp, "template.db")
+        build_synthetic_ledger(template, n_items).dispose()
+        router = ps.ShardRouter(os.path.join(tmp, "shards"))
+        os.makedirs(router.shard_dir)
+        previous_router, ps.shard_router = ps.shard_router, router
+        try:
+            for n_tenants in tenant_counts:
+                tenants = [f"store-{i:04d}" for i in range(n_tenants)]
+                for tenant in tenants:
+                    if not os.path.exists(router.shard_path(tenant)):
+                        shutil.copy(template, router.shard_path(tenant))
+                rng = np.random.default_rng(n_tenants)
+                work = [(tenants[t], names[i]) for t, i in zip(
+                    rng.integers(0, n_tenants, n_tenants * calls_per_tenant),
+                    rng.integers(0, n_items, n_tenants * calls_per_tenant),
+                )]
+
+                def one_call(job) -> float:
+                    tenant, item = job
+                    start = time.perf_counter()
+                    with ps.tenant_scope(tenant):
+                        ps.get_stock_level(item, "2025-04-30")
+                        ps.get_cash_balance("2025-04-30")
+                        ps.reserve_and_sell(item, 1, "2025-04-30")
+                    return time.perf_counter() - start
+
+                with ThreadPoolExecutor(workers) as pool:
+                    latencies = np.array(list(pool.map(one_call, work)))
+                results[f"{n_tenants}_tenants_p50_ms"] = round(1000 * np.percentile(latencies, 50), 2)
+                results[f"{n_tenants}_tenants_p95_ms"] = round(1000 * np.percentile(latencies, 95), 2)
+        finally:
+            ps.shard_router = previous_router
+            router.dispose()
+    return results
+
+
+def bench_catalog(n_items: int = 1_000_000, n_lookups: int = 100_000) -> Dict:
+    """Memory and lookup speed of CompactCatalog against the list-of-dicts layout."""
+    import tracemalloc
+
+    rng = np.random.default_rng(137)
+    categories = ["paper", "product", "large_format", "specialty"]
+    category_idx = rng.integers(0, len(categories), n_items)
+    prices = np.round(rng.uniform(0.02, 3.0, n_items), 2)
+
+    tracemalloc.start()
+    records = [
+        {"item_name": f"SKU-{i:07d}", "category": categories[c], "unit_price": float(p)}
+        for i, c, p in zip(range(n_items), category_idx.tolist(), prices.tolist())
+    ]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    catalog = ps.CompactCatalog(
+        (f"SKU-{i:07d}" for i in range(n_items)), [categories[c] for c in category_idx], prices
+    )
+    compact_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    queries = [f"SKU-{i:07d}" for i in rng.integers(0, n_items, n_lookups)]
+    scan_queries = queries[:20]
+    scan_seconds, _ = timed(lambda: [next(r for r in records if r["item_name"] == q) for q in scan_queries])
+    lookup_seconds, _ = timed(lambda: [catalog.price(q) for q in queries])
+    join_seconds, joined = timed(catalog.prices_for, queries)
+    index_seconds, _ = timed(catalog.search, "SKU-09999")  # first search builds the text index
+    search_seconds, _ = timed(catalog.search, "SKU-09998")
+
+    return {
+        "n_items": n_items,
+        "list_of_dicts_mb": round(dict_bytes / 2**20, 1),
+        "compact_catalog_mb": round(compact_bytes / 2**20, 1),
+        "memory_ratio": round(dict_bytes / compact_bytes, 2),
+        "linear_scan_lookup_us": round(scan_seconds / len(scan_queries) * 1e6, 1),
+        "indexed_lookup_us": round(lookup_seconds / n_lookups * 1e6, 2),
+        "vectorized_join_us_per_item": round(join_seconds / n_lookups * 1e6, 3),
+        "search_index_build_ms": round(index_seconds * 1000, 2),
+        "substring_search_ms": round(search_seconds * 1000, 2),
+        "join_matches": int((~np.isnan(joined)).sum()),
+    }
+
+
+def bench_report_workers(n_items: int = 20_000, sales_per_item: int = 50, n_reports: int = 16, worker_counts=None) -> Dict:
+    """Financial reports for many dates on a large ledger, inline vs worker processes.
+
+    Workers open their own read-only connections. Whether throughput scales with
+    cores is what this measures; run it on a multi-core host.
+    """
+    worker_counts = worker_counts or sorted({1, 2, os.cpu_count() or 1})
+    dates = [str(np.datetime64("2025-03-01") + np.timedelta64(i * 2, "D")) for i in range(n_reports)]
+    results = {"n_items": n_items, "ledger_rows": n_items * (sales_per_item + 1), "cpu_count": os.cpu_count()}
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = build_synthetic_ledger(os.path.join(tmp, "ledger.db"), n_items, sales_per_item=sales_per_item)
+        with use_engine(engine), ledger_snapshots(False):
+            inline_seconds, _ = timed(ps.ReportingBackend(workers=0).financial_reports, dates)
+            results["inline_reports_per_second"] = round(n_reports / inline_seconds, 2)
+            for workers in worker_counts:
+                backend = ps.ReportingBackend(workers=workers)
+                backend.financial_report(dates[0])  # start the workers outside the timing
+                seconds, _ = timed(backend.financial_reports, dates)
+                backend.shutdown()
+                results[f"{workers}_workers_reports_per_second"] = round(n_reports / seconds, 2)
+                results[f"{workers}_workers_speedup"] = round(inline_seconds / seconds, 2)
+        engine.dispose()
+    return results
+
+
+def bench_ledger_snapshot(
+    n_items: int = 20_000, sales_per_item: int = 50, n_appended: int = 1_000, n_write_reads: int = 200
+) -> Dict:
+    """Financial reports and cash balance from SQLite vs the memory-mapped columnar snapshot."""
+    date = "2025-04-15"
+    results = {"n_items": n_items, "ledger_rows": n_items * (sales_per_item + 1)}
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = build_synthetic_ledger(os.path.join(tmp, "ledger.db"), n_items, sales_per_item=sales_per_item)
+        with use_engine(engine):
+            with ledger_snapshots(False):
+                sql_report_seconds, sql_report = timed(ps.generate_financial_report, date, repeat=3)
+                sql_cash_seconds, sql_cash = timed(ps.get_cash_balance, date, repeat=3)
+            export_seconds, _ = timed(ps.get_ledger_snapshot)
+            report_seconds, report = timed(ps.generate_financial_report, date, repeat=5)
+            cash_seconds, cash = timed(ps.get_cash_balance, date, repeat=5)
+
+            ps.create_transactions_bulk([
+                {"item_name": f"SKU-{i:07d}", "transaction_type": "sales", "units": 1, "price": 1.0,
+                 "transaction_date": "2025-04-10"}
+                for i in range(n_appended)
+            ])
+            refreshed_seconds, refreshed = timed(ps.generate_financial_report, date)
+
+            # The request hot path: one sale, then a cash lookup that must see it
+            segments_before = len(ps.get_ledger_snapshot(refresh=False)._segment_names)
+            write_read_seconds = 0.0
+            for i in range(n_write_reads):
+                ps.create_transaction(f"SKU-{i:07d}", "sales", 1, 1.0, "2025-04-10")
+                start = time.perf_counter()
+                ps.get_cash_balance(date)
+                write_read_seconds += time.perf_counter() - start
+            segments_written = ps.get_ledger_snapshot(refresh=False)._segment_names
+        engine.dispose()
+
+    results.update({
+        "sql_report_ms": round(sql_report_seconds * 1000, 2),
+        "initial_export_ms": round(export_seconds * 1000, 2),
+        "snapshot_report_ms": round(report_seconds * 1000, 2),
+        "report_speedup": round(sql_report_seconds / report_seconds, 1),
+        "sql_cash_ms": round(sql_cash_seconds * 1000, 2),
+        "snapshot_cash_ms": round(cash_seconds * 1000, 2),
+        f"report_after_{n_appended}_appends_ms": round(refreshed_seconds * 1000, 2),
+        "reports_match": bool(
+            abs(sql_report["inventory_value"] - report["inventory_value"]) < 1e-6
+            and abs(sql_cash - cash) < 1e-6
+            and [p["item_name"] for p in sql_report["top_selling_products"]]
+            == [p["item_name"] for p in report["top_selling_products"]]
+        ),
+        "appended_rows_visible": bool(abs(refreshed["cash_balance"] - cash - n_appended) < 1e-6),
+        "cash_after_each_write_ms": round(write_read_seconds / n_write_reads * 1000, 3),
+        f"segments_written_for_{n_write_reads}_writes": len(segments_written) - segments_before,
+    })
+    return results
+
+
+def bench_async_requests(n_items: int = 2_000, n_requests: int = 5_000) -> Dict:
+    """Thousands of concurrent coroutines doing stock checks, cash lookups and sales through
+    the async helpers, with the event-loop lag measured while they are in flight."""
+    import asyncio
+
+    async def one_request(i: int, latencies: list) -> None:
+        start = time.perf_counter()
+        item = f"SKU-{i % n_items:07d}"
+        await ps.get_stock_level_async(item, "2025-04-30")
+        await ps.get_cash_balance_async("2025-04-30")
+        await ps.create_transaction_async(item, "sales", 1, 1.0, "2025-04-30")
+        latencies.append(time.perf_counter() - start)
+
+    async def run_all() -> Dict:
+        latencies = []
+        async with ps.LoopLatencyMonitor(interval=0.005) as monitor:
+            threads_before = threading.active_count()
+            start = time.perf_counter()
+            tasks = [asyncio.ensure_future(one_request(i, latencies)) for i in range(n_requests)]
+            await asyncio.sleep(0)
+            in_flight = sum(not task.done() for task in tasks)
+            peak_threads = threading.active_count()
+            await asyncio.gather(*tasks)
+            seconds = time.perf_counter() - start
+        lag = monitor.summary()
+        return {
+            "requests_in_flight": in_flight,
+            "threads_used": peak_threads - threads_before + 1,
+            "requests_per_second": round(n_requests / seconds, 1),
+            "request_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1),
+            "request_p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 1),
+            "loop_lag_p50_ms": lag["p50_ms"],
+            "loop_lag_p99_ms": lag["p99_ms"],
+            "loop_lag_max_ms": lag["max_ms"],
+        }
+
+    results = {"n_requests": n_requests, "db_calls": n_requests * 3}
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = build_synthetic_ledger(os.path.join(tmp, "ledger.db"), n_items)
+        with use_engine(engine):
+            results.update(asyncio.run(run_all()))
+            ps.database_thread.shutdown()
+        engine.dispose()
+    return results
+
+
+def bench_helpers(sizes=(1_000, 10_000, 50_000), sales_per_item: int = 10, repeat: int = 5) -> Dict:
+    """Best-of-`repeat` latency of each ledger helper at several ledger sizes."""
+    date = "2025-04-15"
+    results = {}
+    for n_items in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = build_synthetic_ledger(
+                os.path.join(tmp, "ledger.db"), n_items, sales_per_item=sales_per_item, n_quotes=n_items
+            )
+            rows = n_items * (sales_per_item + 1)
+            with use_engine(engine):
+                ps.get_ledger_snapshot()  # the snapshot's one-time export is not part of any helper
+                helpers = {
+                    "get_stock_level": lambda: ps.get_stock_level("SKU-0000001", date),
+                    "get_all_inventory": lambda: ps.get_all_inventory(date),
+                    "get_cash_balance": lambda: ps.get_cash_balance(date),
+                    "generate_financial_report": lambda: ps.generate_financial_report(date),
+                    "search_quote_history": lambda: ps.search_quote_history(["sku-0000001", "wedding"]),
+                    "create_transaction": lambda: ps.create_transaction("SKU-0000001", "sales", 1, 1.0, date),
+                }
+                for name, helper in helpers.items():
+                    seconds, _ = timed(helper, repeat=repeat)
+                    results[f"{rows}_rows.{name}_ms"] = round(seconds * 1000, 3)
+            engine.dispose()
+    return results
+
+
+def _sample_requests(n_requests: int, seed: int = 137) -> list:
+    """Customer requests for catalog items, phrased like quote_requests_sample.csv."""
+    rng = np.random.default_rng(seed)
+    names = [item["item_name"] for item in ps.paper_supplies]
+    events = ["wedding", "conference", "party", "exhibition"]
+    requests = []
+    for i in range(n_requests):
+        picks = rng.choice(len(names), 2, replace=False)
+        lines = " and ".join(f"{int(rng.integers(50, 500))} units of {names[p]}" for p in picks)
+        requests.append(
+            f"I would like to order {lines} for our {events[i % len(events)]}. "
+            f"(Date of request: 2025-04-{1 + i % 28:02d})"
+        )
+    return requests
+
+
+def bench_end_to_end(n_requests: int = 20, model_latency_ms: float = 0.0) -> Dict:
+    """process_customer_request on a copy of munder_difflin.db with every agent on the local StubModel.
+
+    Parsing, agents, tools, caches and the ledger all run for real; only the
+    provider is replaced, so the numbers are the pipeline's own overhead.
+    """
+    import shutil
+
+    stub = ps.StubModel(latency=model_latency_ms / 1000)
+    previous_model, previous_rpm = ps.model, ps.model_rate_limiter.rate * 60
+    latencies, tool_calls = [], 0
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy("munder_difflin.db", os.path.join(tmp, "ledger.db"))
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+        ps.ensure_ledger_schema(engine)
+        ps.set_backing_model(stub)
+        ps.model_rate_limiter.set_rate(1e9)  # the stub has no provider limit to respect
+        try:
+            with use_engine(engine), quiet_output():
+                for request in _sample_requests(n_requests):
+                    metrics = {}
+                    seconds, _ = timed(ps.process_customer_request, request, metrics=metrics)
+                    latencies.append(seconds)
+                    tool_calls += sum(metrics["tool_calls"].values())
+        finally:
+            ps.set_backing_model(previous_model)
+            ps.model_rate_limiter.set_rate(previous_rpm)
+            engine.dispose()
+    return {
+        "n_requests": n_requests,
+        "model_latency_ms": model_latency_ms,
+        "requests_per_second": round(n_requests / sum(latencies), 2),
+        "request_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1),
+        "request_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1),
+        "model_calls_per_request": round(stub.calls / n_requests, 1),
+        "tool_calls_per_request": round(tool_calls / n_requests, 1),
+    }
+
+
+def bench_coalescing(n_requests: int = 40, n_distinct: int = 5, model_latency_ms: float = 20.0, n_searches: int = 32) -> Dict:
+    """Concurrent requests for a few distinct orders (each worded two ways) through
+    process_customer_request_async on the StubModel, with and without single-flight
+    coalescing of the read-only stages; plus concurrent identical quote-history searches."""
+    import asyncio
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    rng = np.random.default_rng(137)
+    names = [item["item_name"] for item in ps.paper_supplies]
+    orders = [
+        [(names[p], int(rng.integers(50, 500))) for p in rng.choice(len(names), 2, replace=False)]
+        for _ in range(n_distinct)
+    ]
+    requests = []
+    for i in range(n_requests):
+        (first, q1), (second, q2) = orders[i % n_distinct]
+        if (i // n_distinct) % 2:
+            requests.append(f"Please send {q2} units of {second} and {q1} units of {first}. (Date of request: 2025-04-10)")
+        else:
+            requests.append(f"I would like to order {q1} units of {first} and {q2} units of {second}. (Date of request: 2025-04-10)")
+
+    async def run_batch() -> float:
+        start = time.perf_counter()
+        await asyncio.gather(*(ps.process_customer_request_async(request) for request in requests))
+        return time.perf_counter() - start
+
+    results = {"n_requests": n_requests, "distinct_orders": n_distinct, "model_latency_ms": model_latency_ms}
+    previous_model, previous_rpm = ps.model, ps.model_rate_limiter.rate * 60
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy("munder_difflin.db", os.path.join(tmp, "ledger.db"))
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+        ps.ensure_ledger_schema(engine)
+        ps.model_rate_limiter.set_rate(1e9)
+        try:
+            with use_engine(engine), quiet_output():
+                for enabled in (False, True):
+                    stub = ps.StubModel(latency=model_latency_ms / 1000)
+                    ps.set_backing_model(stub)
+                    ps.single_flight.enabled = enabled
+                    ps.single_flight.reset_stats()
+                    seconds = asyncio.run(run_batch())
+                    label = "coalesced" if enabled else "independent"
+                    results[f"{label}_requests_per_second"] = round(n_requests / seconds, 2)
+                    results[f"{label}_model_calls"] = stub.calls
+                stats = ps.single_flight.stats
+                for stage in ("inventory", "quoting"):
+                    results[f"{stage}_coalesced_fraction"] = round(stats.get(stage, {}).get("coalesced_fraction", 0.0), 3)
+                ps.database_thread.shutdown()
+        finally:
+            ps.single_flight.enabled = True
+            ps.set_backing_model(previous_model)
+            ps.model_rate_limiter.set_rate(previous_rpm)
+            engine.dispose()
+
+        # Identical quote-history searches issued at the same moment from many threads
+        engine = build_synthetic_ledger(os.path.join(tmp, "quotes.db"), 1_000, sales_per_item=1, n_quotes=200_000)
+        with use_engine(engine), ThreadPoolExecutor(n_searches) as pool:
+            ps.single_flight.reset_stats()
+            barrier = threading.Barrier(n_searches)
+
+            def search(_):
+                barrier.wait()
+                return ps.search_quote_history(["wedding", "sku-00001"])
+
+            seconds, _ = timed(lambda: list(pool.map(search, range(n_searches))))
+            results["quote_search_coalesced_fraction"] = round(
+                ps.single_flight.stats["quote_history"]["coalesced_fraction"], 3
+            )
+            results["quote_searches_per_second"] = round(n_searches / seconds, 1)
+        engine.dispose()
+    return results
+
+
+def bench_streaming(n_requests: int = 10, model_latency_ms: float = 50.0, token_interval_ms: float = 5.0) -> Dict:
+    """Time to the first byte of the response: process_customer_request vs the first
+    streamed token of process_customer_request_stream, on the StubModel with simulated
+    provider latency and token pacing."""
+    import shutil
+
+    requests = _sample_requests(n_requests)
+    blocking, first_tokens, streamed_totals = [], [], []
+    previous_model, previous_rpm = ps.model, ps.model_rate_limiter.rate * 60
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy("munder_difflin.db", os.path.join(tmp, "ledger.db"))
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+        ps.ensure_ledger_schema(engine)
+        ps.set_backing_model(ps.StubModel(latency=model_latency_ms / 1000, token_interval=token_interval_ms / 1000))
+        ps.model_rate_limiter.set_rate(1e9)
+        try:
+            with use_engine(engine), quiet_output():
+                for request in requests:
+                    seconds, _ = timed(ps.process_customer_request, request)
+                    blocking.append(seconds)
+                    metrics = {}
+                    for _ in ps.process_customer_request_stream(request, metrics=metrics):
+                        pass
+                    first_tokens.append(metrics["time_to_first_token"])
+                    streamed_totals.append(metrics["total_seconds"])
+        finally:
+            ps.set_backing_model(previous_model)
+            ps.model_rate_limiter.set_rate(previous_rpm)
+            engine.dispose()
+    return {
+        "n_requests": n_requests,
+        "model_latency_ms": model_latency_ms,
+        "token_interval_ms": token_interval_ms,
+        "blocking_first_byte_p50_ms": round(float(np.median(blocking)) * 1000, 1),
+        "streaming_first_token_p50_ms": round(float(np.median(first_tokens)) * 1000, 1),
+        "streaming_total_p50_ms": round(float(np.median(streamed_totals)) * 1000, 1),
+        "first_byte_speedup": round(float(np.median(blocking) / np.median(first_tokens)), 2),
+    }
+
+
+def bench_delivery_scheduler(n_orders: int = 1_000_000, n_calls: int = 20_000) -> Dict:
+    """Supplier delivery dates one call at a time vs the vectorized scheduler, with and
+    without a working-day calendar."""
+    rng = np.random.default_rng(137)
+    dates = (np.datetime64("2025-01-01") + rng.integers(0, 365, n_orders).astype("timedelta64[D]")).astype(str)
+    quantities = rng.integers(1, 5_000, n_orders)
+    calendar = ps.make_supplier_calendar(holidays=["2025-05-26", "2025-07-04", "2025-12-25"])
+
+    call_dates, call_quantities = dates[:n_calls].tolist(), quantities[:n_calls].tolist()
+    per_call_seconds, per_call = timed(
+        lambda: [ps.get_supplier_delivery_date(d, q) for d, q in zip(call_dates, call_quantities)]
+    )
+    batch_seconds, batch = timed(ps.schedule_deliveries, dates, quantities, repeat=3)
+    calendar_seconds, _ = timed(ps.schedule_deliveries, dates, quantities, calendar, repeat=3)
+
+    return {
+        "n_orders": n_orders,
+        "per_call_us": round(per_call_seconds / n_calls * 1e6, 2),
+        "vectorized_per_order_us": round(batch_seconds / n_orders * 1e6, 4),
+        "calendar_per_order_us": round(calendar_seconds / n_orders * 1e6, 4),
+        "speedup": round((per_call_seconds / n_calls) / (batch_seconds / n_orders), 1),
+        "results_match": per_call == batch[:n_calls].astype(str).tolist(),
+    }
+
+
+class _BlockingStream:
+    """A stdout stand-in whose writes block for a while, like a busy terminal or a full pipe.
+    Writes are serialized, as on a real stdout."""
+
+    def __init__(self, stream, write_seconds: float):
+        self.stream = stream
+        self.write_seconds = write_seconds
+        self._lock = threading.Lock()
+
+    def write(self, data: str) -> int:
+        with self._lock:
+            time.sleep(self.write_seconds)
+            return self.stream.write(data)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+def bench_logging(n_requests: int = 10_000, tool_calls_per_request: int = 4, threads: int = 8) -> Dict:
+    """Caller-side cost of one progress line per tool call: the old synchronous print and
+    flush vs the queued logging backend (console and JSON sinks, and filtered out), writing
+    to /dev/null and to a sink whose writes block for 50us."""
+
+    n_calls = n_requests * tool_calls_per_request
+
+    def legacy_print_step(agent_name: str, message: str) -> None:
+        color = ps.AGENT_COLORS.get(agent_name.lower(), ps.AGENT_COLORS["reset"])
+        print(f"{color}  > {message}{ps.AGENT_COLORS['reset']}")
+        sys.stdout.flush()
+
+    def run(step: Callable) -> float:
+        def worker(first: int) -> None:
+            for request in range(first, n_requests, threads):
+                with ps.correlation_scope(f"bench-{request}"):
+                    for call in range(tool_calls_per_request):
+                        step("inventory", f"Checking stock of SKU-{request:07d} (call {call})")
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return time.perf_counter() - start
+
+    results = {"n_requests": n_requests, "tool_calls": n_calls}
+    with open(os.devnull, "w") as devnull:
+        sinks = {"devnull": devnull, "blocking_sink": _BlockingStream(devnull, 50e-6)}
+        try:
+            for sink_name, sink in sinks.items():
+                with contextlib.redirect_stdout(sink):
+                    results[f"{sink_name}_print_per_call_us"] = round(run(legacy_print_step) / n_calls * 1e6, 2)
+                for fmt in ("console", "json"):
+                    ps.configure_logging(level="INFO", fmt=fmt, stream=sink)
+                    seconds = run(ps.print_step)
+                    drain_start = time.perf_counter()
+                    ps.flush_logs()
+                    results[f"{sink_name}_queued_{fmt}_per_call_us"] = round(seconds / n_calls * 1e6, 2)
+                    results[f"{sink_name}_queued_{fmt}_drain_ms"] = round((time.perf_counter() - drain_start) * 1000, 1)
+            ps.configure_logging(level="WARNING", stream=devnull)
+            results["filtered_per_call_us"] = round(run(ps.print_step) / n_calls * 1e6, 2)
+        finally:
+            ps.configure_logging()
+    return results
+
+
+def bench_agent_console(n_requests: int = 10, model_latency_ms: float = 0.0) -> Dict:
+    """process_customer_request on the StubModel with smolagents' own Rich console output
+    at the library default (LogLevel.INFO) vs off (AGENT_VERBOSITY=OFF), writing stdout
+    to memory and to a sink whose writes block for 50us."""
+    import shutil
+
+    agents = [ps.inventory_agent, ps.quoting_agent, ps.sales_agent, ps.advisor_agent, ps.orchestrator]
+    previous_loggers = [(agent.logger, agent.monitor.logger) for agent in agents]
+    stub = ps.StubModel(latency=model_latency_ms / 1000)
+    previous_model, previous_rpm = ps.model, ps.model_rate_limiter.rate * 60
+    requests = _sample_requests(n_requests)
+    results = {"n_requests": n_requests, "model_latency_ms": model_latency_ms}
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        shutil.copy("munder_difflin.db", os.path.join(tmp, "ledger.db"))
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+        ps.ensure_ledger_schema(engine)
+        ps.set_backing_model(stub)
+        ps.model_rate_limiter.set_rate(1e9)
+        try:
+            with use_engine(engine):
+                for sink_name, make_sink in (("memory", io.StringIO), ("blocking_sink", lambda: _BlockingStream(devnull, 50e-6))):
+                    for verbosity in (ps.LogLevel.INFO, ps.LogLevel.OFF):
+                        for agent in agents:
+                            agent.logger = ps.AgentLogger(
+                                level=verbosity,
+                                console=ps.Console(highlight=False, quiet=verbosity == ps.LogLevel.OFF),
+                            )
+                            agent.monitor.logger = agent.logger
+                        with contextlib.redirect_stdout(make_sink()):
+                            start = time.perf_counter()
+                            for request in requests:
+                                ps.process_customer_request(request)
+                            seconds = time.perf_counter() - start
+                            ps.flush_logs()
+                        label = "console" if verbosity == ps.LogLevel.INFO else "off"
+                        results[f"{sink_name}_{label}_request_ms"] = round(seconds / n_requests * 1000, 2)
+        finally:
+            for agent, (agent_logger, monitor_logger) in zip(agents, previous_loggers):
+                agent.logger, agent.monitor.logger = agent_logger, monitor_logger
+            ps.set_backing_model(previous_model)
+            ps.model_rate_limiter.set_rate(previous_rpm)
+            engine.dispose()
+    for sink_name in ("memory", "blocking_sink"):
+        results[f"{sink_name}_off_speedup"] = round(
+            results[f"{sink_name}_console_request_ms"] / results[f"{sink_name}_off_request_ms"], 2
+        )
+    return results
+
+
+class _QuotingWorkflowModel(ps.StubModel):
+    """StubModel that follows the quoting agent's WORKFLOW: given a QUOTE DRAFT it answers
+    with the draft right away; otherwise it searches past quotes and then looks up the
+    price of each item in the structured order, one tool call per step, before answering."""
+
+    def _next_call(self, messages, tools_to_call_from):
+        task = "\n".join(self._text(m) for m in messages if self._role(m) == ps.MessageRole.USER.value)
+        if "QUOTE DRAFT" in task:
+            return ps.ChatMessageToolCallFunction(
+                name="final_answer", arguments={"answer": task[task.index("QUOTE DRAFT"):][:2000]}
+            )
+        plan = [("search_past_quotes", {"search_terms": ", ".join(re.findall(r"for our (\w+)", task))})]
+        plan += [("get_item_unit_price", {"item_name": name}) for name in re.findall(r"-> ([^:\n]+):", task)]
+        observations = [self._text(m) for m in messages if self._role(m) == ps.MessageRole.TOOL_RESPONSE.value]
+        if len(observations) < len(plan):
+            name, arguments = plan[len(observations)]
+            return ps.ChatMessageToolCallFunction(name=name, arguments=arguments)
+        return ps.ChatMessageToolCallFunction(name="final_answer", arguments={"answer": observations[-1][:2000]})
+
+
+def bench_quote_drafts(n_requests: int = 20, model_latency_ms: float = 100.0, n_sales: int = 200) -> Dict:
+    """Quoting-stage latency with and without precomputed quote drafts, on a model that
+    follows the quoting workflow with simulated provider latency; plus the cost of the
+    offline template build and of incremental re-pricing after ledger writes."""
+    import shutil
+
+    requests = _sample_requests(n_requests)
+    previous_model, previous_rpm = ps.model, ps.model_rate_limiter.rate * 60
+    results = {"n_requests": n_requests, "model_latency_ms": model_latency_ms}
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy("munder_difflin.db", os.path.join(tmp, "ledger.db"))
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+        ps.ensure_ledger_schema(engine)
+        ps.model_rate_limiter.set_rate(1e9)
+        try:
+            with use_engine(engine), quiet_output():
+                build_seconds, templates = timed(lambda: ps.quote_templates.get().build())
+                results["template_build_ms"] = round(build_seconds * 1000, 1)
+                results["templates"] = templates.summary()["templates"]
+
+                for label, drafts in (("searched", False), ("drafted", True)):
+                    stub = _QuotingWorkflowModel(latency=model_latency_ms / 1000)
+                    ps.set_backing_model(stub)
+                    previous_enabled, ps.QUOTE_DRAFTS_ENABLED = ps.QUOTE_DRAFTS_ENABLED, drafts
+                    latencies, tool_calls = [], 0
+                    try:
+                        for request in requests:
+                            metrics = {"tool_calls": {}}
+                            with ps.tool_cache_scope() as tool_cache:
+                                order_context, _, quote_draft = ps._order_context(request, True, metrics)
+                                task = ps._quote_task(order_context, "(see structured order)", quote_draft)
+                                seconds, _ = timed(ps._run_stage, "quoting", task, metrics, tool_cache)
+                            latencies.append(seconds)
+                            tool_calls += metrics["tool_calls"]["quoting"]
+                    finally:
+                        ps.QUOTE_DRAFTS_ENABLED = previous_enabled
+                    results[f"{label}_quoting_p50_ms"] = round(float(np.percentile(latencies, 50)) * 1000, 1)
+                    results[f"{label}_model_calls_per_quote"] = round(stub.calls / n_requests, 1)
+                    results[f"{label}_tool_calls_per_quote"] = round(tool_calls / n_requests, 1)
+                results["quoting_speedup"] = round(
+                    results["searched_quoting_p50_ms"] / results["drafted_quoting_p50_ms"], 2
+                )
+
+                rng = np.random.default_rng(137)
+                names = [item["item_name"] for item in ps.paper_supplies]
+                repriced, refresh_seconds = 0, 0.0
+                for i in range(n_sales):
+                    ps.create_transaction(names[rng.integers(len(names))], "stock_orders", 10, 1.0, "2025-04-30")
+                    seconds, count = timed(templates.refresh)
+                    refresh_seconds += seconds
+                    repriced += count
+                results["repriced_per_write"] = round(repriced / n_sales, 1)
+                results["refresh_per_write_ms"] = round(refresh_seconds / n_sales * 1000, 2)
+        finally:
+            ps.set_backing_model(previous_model)
+            ps.model_rate_limiter.set_rate(previous_rpm)
+            engine.dispose()
+    return results
+
+
+class _LongRunModel(ps.StubModel):
+    """StubModel that keeps calling tools with long outputs for `n_calls` steps before
+    answering, and whose latency grows with the prompt like a provider's prefill."""
+
+    def __init__(self, n_calls: int, base_latency: float, seconds_per_1k_tokens: float):
+        super().__init__()
+        self.n_calls = n_calls
+        self.base_latency = base_latency
+        self.seconds_per_1k_tokens = seconds_per_1k_tokens
+
+    def _next_call(self, messages, tools_to_call_from):
+        step = sum(self._role(m) == ps.MessageRole.TOOL_RESPONSE.value for m in messages)
+        if step >= self.n_calls:
+            return ps.ChatMessageToolCallFunction(name="final_answer", arguments={"answer": "done"})
+        terms = ["meeting", "festival", "paper", "cardstock", "party", "large", "small"]
+        calls = [
+            ("check_all_inventory", {"as_of_date": f"2025-04-{1 + step:02d}"}),
+            ("search_past_quotes", {"search_terms": terms[step % len(terms)]}),
+            ("check_all_inventory", {"as_of_date": f"2025-05-{1 + step:02d}"}),
+        ]
+        name, arguments = calls[step % len(calls)]
+        return ps.ChatMessageToolCallFunction(name=name, arguments=arguments)
+
+    def _respond(self, messages, tools_to_call_from):
+        prompt_tokens = sum(len(self._text(m)) for m in messages) // 4
+        time.sleep(self.base_latency + self.seconds_per_1k_tokens * prompt_tokens / 1000)
+        return super()._respond(messages, tools_to_call_from)
+
+
+def bench_memory_compaction(n_steps: int = 15, base_latency_ms: float = 20.0, ms_per_1k_tokens: float = 10.0) -> Dict:
+    """Per-step prompt tokens and latency of a long quoting-agent run (history searches and
+    inventory listings every step), with and without memory compaction."""
+    import shutil
+
+    agent = ps.quoting_agent
+    previous = (ps.model, ps.model_rate_limiter.rate * 60, agent.max_steps, ps.MEMORY_COMPACTION_ENABLED)
+    results = {"n_steps": n_steps, "ms_per_1k_tokens": ms_per_1k_tokens}
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy("munder_difflin.db", os.path.join(tmp, "ledger.db"))
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+        ps.ensure_ledger_schema(engine)
+        ps.model_rate_limiter.set_rate(1e9)
+        agent.max_steps = n_steps + 1
+        try:
+            with use_engine(engine), quiet_output():
+                for label, enabled in (("full", False), ("compacted", True)):
+                    ps.MEMORY_COMPACTION_ENABLED = enabled
+                    ps.set_backing_model(_LongRunModel(n_steps - 1, base_latency_ms / 1000, ms_per_1k_tokens / 1000))
+                    seconds, _ = timed(agent.run, "Quote 500 sheets of A4 paper for a meeting (Date of request: 2025-04-05)")
+                    steps = [step for step in agent.memory.steps if isinstance(step, ps.ActionStep)]
+                    tokens = [step.token_usage.input_tokens for step in steps]
+                    step_ms = [round(step.timing.duration * 1000, 1) for step in steps]
+                    results[f"{label}_run_seconds"] = round(seconds, 3)
+                    results[f"{label}_last_step_input_tokens"] = tokens[-1]
+                    results[f"{label}_total_input_tokens"] = sum(tokens)
+                    results[f"{label}_last_step_ms"] = step_ms[-1]
+                    results[f"{label}_input_tokens_by_step"] = tokens
+                    results[f"{label}_step_ms_by_step"] = step_ms
+            results["token_ratio"] = round(results["full_total_input_tokens"] / results["compacted_total_input_tokens"], 2)
+        finally:
+            ps.set_backing_model(previous[0])
+            ps.model_rate_limiter.set_rate(previous[1])
+            agent.max_steps = previous[2]
+            ps.MEMORY_COMPACTION_ENABLED = previous[3]
+            engine.dispose()
+    return results
+
+
+class _WanderingModel(ps.StubModel):
+    """StubModel with a model's step habits. Each run needs 1-4 distinct tool calls,
+    sometimes repeats its last call once before answering, and now and then gets stuck
+    repeating it until the step cap. Runs are seeded by agent and request, so both
+    passes of the step budget benchmark see the same behaviour."""
+
+    def __init__(self, repeat_fraction: float = 0.3, stuck_fraction: float = 0.05):
+        super().__init__()
+        self.repeat_fraction = repeat_fraction
+        self.stuck_fraction = stuck_fraction
+
+    def _next_call(self, messages, tools_to_call_from):
+        tools = [tool for tool in tools_to_call_from or [] if set(tool.inputs) == {"as_of_date"}]
+        if not tools:
+            return ps.ChatMessageToolCallFunction(name="final_answer", arguments={"answer": "done"})
+        task = "\n".join(self._text(m) for m in messages if self._role(m) == ps.MessageRole.USER.value)
+        # Seed by agent and customer request, not by the whole task, which embeds earlier stages' answers
+        request = re.search(r"Customer request: (.*)", task)
+        key = " ".join(sorted(tool.name for tool in tools)) + (request.group(1) if request else task)
+        rng = np.random.default_rng(zlib.crc32(key.encode()))
+        needed = int(rng.integers(1, 5))
+        repeats = int(rng.random() < self.repeat_fraction)
+        stuck = rng.random() < self.stuck_fraction
+        step = sum(self._role(m) == ps.MessageRole.TOOL_RESPONSE.value for m in messages)
+        if step >= needed + repeats and not stuck:
+            return ps.ChatMessageToolCallFunction(name="final_answer", arguments={"answer": "done"})
+        day = min(step, needed - 1) + 1
+        return ps.ChatMessageToolCallFunction(name=tools[0].name, arguments={"as_of_date": f"2025-04-{day:02d}"})
+
+
+def bench_step_budgets(n_requests: int = 40) -> Dict:
+    """Agent steps and model calls per request before and after step tuning: first with
+    the default max_steps and no early stop, then with the budgets recommended from the
+    first pass's traces and the repeated-call early stop, on a model with realistic
+    step habits (_WanderingModel)."""
+    import shutil
+
+    previous = (ps.model, ps.model_rate_limiter.rate * 60, ps.step_profiler, ps.STEP_EARLY_STOP_ENABLED)
+    default_budgets = {name: agent.max_steps for name, agent in ps.AGENTS.items()}
+    requests = _sample_requests(n_requests)
+    results = {"n_requests": n_requests}
+    budgets = {}
+    try:
+        ps.model_rate_limiter.set_rate(1e9)
+        for label, early_stop in (("before", False), ("after", True)):
+            ps.STEP_EARLY_STOP_ENABLED = early_stop
+            ps.apply_step_budgets(budgets or default_budgets)
+            ps.step_profiler = ps.StepProfiler()
+            stub = _WanderingModel()
+            ps.set_backing_model(stub)
+            with tempfile.TemporaryDirectory() as tmp:
+                shutil.copy("munder_difflin.db", os.path.join(tmp, "ledger.db"))
+                engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+                ps.ensure_ledger_schema(engine)
+                try:
+                    with use_engine(engine), quiet_output():
+                        for request in requests:
+                            ps.process_customer_request(request)
+                finally:
+                    engine.dispose()
+            summary = ps.step_profiler.summary()
+            results[f"{label}_model_calls_per_request"] = round(stub.calls / n_requests, 2)
+            results[f"{label}_mean_steps"] = summary["mean_steps"].to_dict()
+            results[f"{label}_duplicate_steps"] = int(summary["duplicate_steps"].sum())
+            results[f"{label}_cap_hits"] = int(summary["cap_hits"].sum())
+            results[f"{label}_stopped_early"] = int(summary["stopped_early"].sum())
+            if not budgets:
+                budgets = ps.step_profiler.recommend_budgets()
+                results["default_budgets"] = {name: default_budgets[name] for name in budgets}
+                results["tuned_budgets"] = budgets
+        results["model_call_ratio"] = round(
+            results["before_model_calls_per_request"] / results["after_model_calls_per_request"], 2
+        )
+    finally:
+        ps.set_backing_model(previous[0])
+        ps.model_rate_limiter.set_rate(previous[1])
+        ps.step_profiler = previous[2]
+        ps.STEP_EARLY_STOP_ENABLED = previous[3]
+        ps.apply_step_budgets(default_budgets)
+    return results
+
+
+def bench_quote_archive(n_quotes: int = int(os.getenv("QUOTE_HISTORY_SIZE", "200000")), repeat: int = 3) -> Dict:
+    """Database size and search_quote_history latency on a synthetic verbose quote
+    history, stored raw and after archive_quote_history. QUOTE_HISTORY_SIZE sets the
+    number of quotes (e.g. 10000000 for the full-size run; that one takes a while)."""
+    searches = {
+        "common": ["cardstock"],
+        "two_terms": ["glossy paper", "wedding"],
+        "rare": ["5000 sheets of poster paper", "gala"],
+        "no_match": ["invoice"],
+    }
+    results = {"quotes": n_quotes}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "quotes.db")
+        build_seconds, engine = timed(build_quote_history, path, n_quotes)
+        results["build_history_seconds"] = round(build_seconds, 1)
+        try:
+            with use_engine(engine), quiet_output():
+                expected = {}
+                with engine.connect() as conn:
+                    results["raw_db_mb"] = round(ps._database_mb(conn), 1)
+                for label, terms in searches.items():
+                    seconds, expected[label] = timed(ps.search_quote_history, terms, repeat=repeat)
+                    results[f"raw_{label}_search_ms"] = round(seconds * 1000, 2)
+
+                seconds, report = timed(ps.archive_quote_history, engine)
+                results["archive_seconds"] = round(seconds, 1)
+                results["hot_quotes"] = report["hot_quotes"]
+                results["cold_pages"] = report["cold_pages"]
+                results["fragments"] = report["fragments"]
+                results["archived_db_mb"] = round(report["db_mb_after"], 1)
+                results["size_ratio"] = round(report["db_mb_before"] / report["db_mb_after"], 1)
+                seconds, _ = timed(ps.quote_archives.get)
+                results["archive_open_ms"] = round(seconds * 1000, 1)
+
+                same = True
+                for label, terms in searches.items():
+                    seconds, found = timed(ps.search_quote_history, terms, repeat=repeat)
+                    results[f"archived_{label}_search_ms"] = round(seconds * 1000, 2)
+                    results[f"{label}_search_speedup"] = round(
+                        results[f"raw_{label}_search_ms"] / max(results[f"archived_{label}_search_ms"], 0.01), 1
+                    )
+                    same = same and found == expected[label]
+                results["results_match"] = same
+        finally:
+            engine.dispose()
+    return results
+
+
+BENCHMARKS = {
+    "reorder_planner": bench_reorder_planner,
+    "demand_forecast": bench_demand_forecast,
+    "concurrent_sales": bench_concurrent_sales,
+    "model_scheduler": bench_model_scheduler,
+    "tenant_scaling": bench_tenant_scaling,
+    "report_workers": bench_report_workers,
+    "catalog": bench_catalog,
+    "ledger_snapshot": bench_ledger_snapshot,
+    "async_requests": bench_async_requests,
+    "helpers": bench_helpers,
+    "end_to_end": bench_end_to_end,
+    "coalescing": bench_coalescing,
+    "streaming": bench_streaming,
+    "delivery_scheduler": bench_delivery_scheduler,
+    "logging": bench_logging,
+    "agent_console": bench_agent_console,
+    "quote_drafts": bench_quote_drafts,
+    "memory_compaction": bench_memory_compaction,
+    "step_budgets": bench_step_budgets,
+    "quote_archive": bench_quote_archive,
+}
+
+
+# -----------------------------------------------------------------------------
+# Baselines
+# -----------------------------------------------------------------------------
+
+# Changes smaller than this (in the metric's own unit) are treated as noise
+NOISE_FLOOR = 0.05
+# Timings jitter by a few hundred microseconds between runs however fast the code is,
+# so sub-millisecond metrics need an absolute change this large to count as a regression
+TIMING_NOISE_FLOORS = {"_ms": 0.25, "_us": 250.0, "_seconds": 0.00025}
+# Fewer runs than this per benchmark make --compare flag noise as regressions
+MIN_COMPARE_RUNS = 3
+
+
+def noise_floor(key: str) -> float:
+    """Smallest change of metric `key` that is not treated as noise."""
+    for suffix, floor in TIMING_NOISE_FLOORS.items():
+        if key.endswith(suffix):
+            return floor
+    return NOISE_FLOOR
+
+
+def metric_direction(key: str) -> int:
+    """+1 if higher is better, -1 if lower is better, 0 for informational metrics."""
+    if key.endswith(("_per_second", "speedup", "_ratio")):
+        return 1
+    if key.endswith(("_ms", "_us", "_seconds", "_mb")):
+        return -1
+    return 0
+
+
+def median_results(runs: list) -> Dict:
+    """Per-metric median of several runs of one benchmark; other values come from the last run."""
+    merged = dict(runs[-1])
+    for key, value in merged.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            median = float(np.median([run[key] for run in runs]))
+            merged[key] = type(value)(median) if isinstance(value, int) else round(median, 4)
+    return merged
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, tolerance: float) -> list:
+    """Metrics that got worse than the baseline by more than `tolerance` (a fraction).
+
+    Returns (benchmark, metric, baseline value, current value) tuples. Boolean
+    checks regress when they were True in the baseline and are not now.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for key, value in metrics.items():
+            expected = baseline.get(name, {}).get(key)
+            if expected is None:
+                continue
+            if isinstance(expected, bool):
+                if expected and value is not True:
+                    regressions.append((name, key, expected, value))
+                continue
+            direction = metric_direction(key)
+            if not direction or abs(value - expected) < noise_floor(key):
+                continue
+            if direction < 0 and value > expected * (1 + tolerance):
+                regressions.append((name, key, expected, value))
+            elif direction > 0 and value < expected * (1 - tolerance):
+                regressions.append((name, key, expected, value))
+    return regressions
+
+
+def main(argv) -> int:
+    import argparse
+    import json
+    import platform
+
+    parser = argparse.ArgumentParser(description="Run the performance benchmarks.")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write the results to a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a JSON baseline; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown as a fraction (default 0.25)")
+    parser.add_argument("--runs", type=int, default=1, help="run each benchmark this many times and report the median")
+    args = parser.parse_args(argv)
+    if args.compare and args.runs < MIN_COMPARE_RUNS:
+        print(f"Comparing {args.runs} run(s) against a baseline is noisy; use --runs {MIN_COMPARE_RUNS} or more")
+
+    selected = args.names or list(BENCHMARKS)
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmark(s): {', '.join(unknown)}. Available: {', '.join(BENCHMARKS)}")
+        return 2
+
+    results = {}
+    for name in selected:
+        print(f"\n=== {name} ===")
+        results[name] = median_results([BENCHMARKS[name]() for _ in range(args.runs)])
+        for key, value in results[name].items():
+            print(f"  {key:<44} {value}")
+
+    if args.save_baseline:
+        # Merge so a baseline can be built up one benchmark at a time
+        saved = {"machine": {}, "results": {}}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline) as f:
+                saved = json.load(f)
+        saved["machine"] = {"python": platform.python_version(), "cpu_count": os.cpu_count(), "platform": platform.platform()}
+        saved["results"].update(results)
+        with open(args.save_baseline, "w") as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        print(f"\nSaved baseline for {len(results)} benchmark(s) to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%} of {args.compare}:")
+            for name, key, expected, value in regressions:
+                print(f"  {name}.{key}: {expected} -> {value}")
+            return 1
+        print(f"\nNo regressions beyond {args.tolerance:.0%} of {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
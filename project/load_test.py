@@ -0,0 +1,220 @@
+"""Load test for the order pipeline server (`project_starter.py --serve`).
+
+By default it starts its own server on the offline StubModel, against a copy of
+`munder_difflin.db` in a temporary directory, so the real database is never
+touched and no model calls are made. Workers send order requests back to back
+over keep-alive connections for a fixed duration. The script reports sustained
+throughput and tail latency, together with the server's own /metrics.
+
+Run from the project/ directory:
+
+    python load_test.py                                   # 8 workers for 30s on a fresh stub server
+    python load_test.py --concurrency 32 --duration 60 --model-latency-ms 50
+    python load_test.py --url http://127.0.0.1:8765       # drive an already running server
+"""
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+import numpy as np
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# -----------------------------------------------------------------------------
+# Requests
+# -----------------------------------------------------------------------------
+
+def sample_requests(db_path: str, n_requests: int = 200, seed: int = 137) -> List[Dict]:
+    """Order requests for items in the ledger's inventory, dated in April 2025."""
+    with sqlite3.connect(db_path) as conn:
+        names = [row[0] for row in conn.execute("SELECT item_name FROM inventory")]
+    rng = np.random.default_rng(seed)
+    requests = []
+    for _ in range(n_requests):
+        first, second = rng.choice(len(names), 2, replace=False)
+        requests.append({
+            "request": (
+                f"I would like to order {int(rng.integers(10, 500))} units of {names[first]} "
+                f"and {int(rng.integers(10, 500))} units of {names[second]} for an upcoming meeting."
+            ),
+            "request_date": f"2025-04-{int(rng.integers(1, 29)):02d}",
+        })
+    return requests
+
+
+# -----------------------------------------------------------------------------
+# Server
+# -----------------------------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get_json(url: str, path: str, timeout: float = 5.0) -> Dict:
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+@contextmanager
+def stub_server(model_latency_ms: float = 0.0, startup_timeout: float = 120.0):
+    """Start `project_starter.py --serve --stub-model` on a copy of the database; yields its URL."""
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(PROJECT_DIR, "munder_difflin.db"), tmp)
+        port = _free_port()
+        env = dict(
+            os.environ,
+            STUB_MODEL_LATENCY_MS=str(model_latency_ms),
+            LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+            OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "offline-load-test"),
+        )
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(PROJECT_DIR, "project_starter.py"), f"--serve=127.0.0.1:{port}", "--stub-model"],
+            cwd=tmp, env=env, stdout=subprocess.DEVNULL,
+        )
+        url = f"http://127.0.0.1:{port}"
+        try:
+            started = time.perf_counter()
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"server exited with status {process.returncode}")
+                try:
+                    if _get_json(url, "/health")["status"] == "ok":
+                        break
+                except OSError:
+                    pass
+                if time.perf_counter() - started > startup_timeout:
+                    raise RuntimeError(f"server not healthy after {startup_timeout:.0f}s")
+                time.sleep(0.2)
+            yield url, time.perf_counter() - started
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+# -----------------------------------------------------------------------------
+# Load
+# -----------------------------------------------------------------------------
+
+def run_load(url: str, requests: List[Dict], concurrency: int, duration: float, warmup: float = 2.0) -> Dict:
+    """Closed-loop load: `concurrency` workers post requests back to back.
+
+    Requests finishing during the first `warmup` seconds are not counted;
+    throughput is measured over the remaining `duration` seconds.
+    """
+    parts = urlsplit(url)
+    start = time.perf_counter()
+    measure_from, stop_at = start + warmup, start + warmup + duration
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def worker(index: int) -> None:
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=600)
+        i = index
+        while time.perf_counter() < stop_at:
+            body = json.dumps(requests[i % len(requests)])
+            i += concurrency
+            sent = time.perf_counter()
+            try:
+                conn.request("POST", "/requests", body, {"Content-Type": "application/json"})
+                response = conn.getresponse()
+                response.read()
+                error = None if response.status == 200 else f"HTTP {response.status}"
+            except (OSError, http.client.HTTPException) as e:
+                error = type(e).__name__
+                conn.close()
+                conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=600)
+            finished = time.perf_counter()
+            if finished < measure_from or finished > stop_at:
+                continue
+            with lock:
+                if error:
+                    errors[error] = errors.get(error, 0) + 1
+                else:
+                    latencies.append(finished - sent)
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results = {
+        "concurrency": concurrency,
+        "duration_seconds": duration,
+        "completed": len(latencies),
+        "errors": sum(errors.values()),
+        "error_kinds": errors,
+        "requests_per_second": round(len(latencies) / duration, 2),
+    }
+    if latencies:
+        ms = np.array(latencies) * 1000
+        for q in (50, 95, 99):
+            results[f"p{q}_ms"] = round(float(np.percentile(ms, q)), 1)
+        results["max_ms"] = round(float(ms.max()), 1)
+    return results
+
+
+@contextmanager
+def _existing(url: str):
+    yield url.rstrip("/"), None
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description="Load test the order pipeline server.")
+    parser.add_argument("--url", help="server to drive (default: start a stub-model server on a database copy)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients (default 8)")
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds (default 30)")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds first (default 2)")
+    parser.add_argument("--model-latency-ms", type=float, default=0.0, help="stub model latency per call")
+    parser.add_argument("--requests", type=int, default=200, help="distinct requests to cycle through")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to a JSON file")
+    args = parser.parse_args(argv)
+
+    requests = sample_requests(os.path.join(PROJECT_DIR, "munder_difflin.db"), args.requests)
+    with (stub_server(args.model_latency_ms) if args.url is None else _existing(args.url)) as (url, startup):
+        print(f"Driving {url} with {args.concurrency} clients for {args.duration:.0f}s")
+        results = run_load(url, requests, args.concurrency, args.duration, args.warmup)
+        if startup is not None:
+            results["server_startup_seconds"] = round(startup, 2)
+        results["server_metrics"] = _get_json(url, "/metrics")
+
+    for key, value in results.items():
+        if key != "server_metrics":
+            print(f"  {key:<28} {value}")
+    server_requests = results["server_metrics"]["requests"]
+    print(f"  {'server_latency_ms':<28} {server_requests['latency_ms']}")
+    print(f"  {'server_window_rps':<28} {server_requests['window_requests_per_second']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if results["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -5,21 +5,177 @@ import time
 import dotenv
 import ast
 from sqlalchemy.sql import text
-from datetime import datetime, timedelta
-from typing import Dict, List, Union
-from sqlalchemy import create_engine, Engine
-
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+from sqlalchemy import create_engine, event, Engine
+from sqlalchemy.exc import IntegrityError
+
+import re
+import io
+import asyncio
+import atexit
+import cProfile
+import csv
 import sys
 import json
+import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.util
+import pstats
+import queue
+import shutil
+import sqlite3
+import threading
+import tracemalloc
+import uuid
+import weakref
+import zlib
+import hashlib
+import heapq
+import http.server
+import openai
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
 from smolagents import (
     tool,
+    ActionStep,
+    AgentMaxStepsError,
     ToolCallingAgent,
     CodeAgent,
+    Model,
     OpenAIServerModel,
 )
+from smolagents.memory import FinalAnswerStep
+from smolagents.models import (
+    ChatMessage,
+    ChatMessageStreamDelta,
+    ChatMessageToolCall,
+    ChatMessageToolCallFunction,
+    ChatMessageToolCallStreamDelta,
+    MessageRole,
+    agglomerate_stream_deltas,
+)
+from smolagents.monitoring import AgentLogger, LogLevel, TokenUsage
+from rich.console import Console
+
+# Module logger; handlers, level and output format are set by configure_logging() (see Logging)
+logger = logging.getLogger("beavers_choice")
+
+# Create an SQLite database (writers wait up to 30s for the write lock instead of failing)
+db_engine = create_engine("sqlite:///munder_difflin.db", connect_args={"timeout": 30})
+
+
+# Tenant routing - each store (tenant) keeps its ledger in its own SQLite shard.
+# Helpers resolve their engine through get_engine(), which follows the tenant bound
+# to the current context; without a tenant they use db_engine above.
+
+current_tenant: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_tenant", default=None)
+
+
+class ShardRouter:
+    """Maps tenant ids to SQLite shard files, keeping at most `max_open` engines open.
+
+    Args:
+        shard_dir: Directory holding one `<tenant>.db` file per tenant.
+        max_open: Engines kept open; beyond that the least recently used one is
+            disposed, together with the tenant's in-memory state (TenantLocal
+            instances and its ledger snapshot), which is rebuilt on next use.
+    """
+
+    def __init__(self, shard_dir: str = "shards", max_open: int = 256):
+        self.shard_dir = shard_dir
+        self.max_open = max_open
+        self._engines: "OrderedDict[str, Engine]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def shard_path(self, tenant: str) -> str:
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", tenant):
+            raise ValueError(f"Invalid tenant id: {tenant!r}")
+        return os.path.join(self.shard_dir, f"{tenant}.db")
+
+    def engine_for(self, tenant: str) -> Engine:
+        """Return the engine for a tenant's shard, opening it on first use."""
+        with self._lock:
+            engine = self._engines.get(tenant)
+            if engine is not None:
+                self._engines.move_to_end(tenant)
+                return engine
+            path = self.shard_path(tenant)
+            os.makedirs(self.shard_dir, exist_ok=True)
+            engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+            self._engines[tenant] = engine
+            evicted = [self._engines.popitem(last=False) for _ in range(len(self._engines) - self.max_open)]
+        # Outside the lock: TenantLocal factories open engines while holding their own locks
+        for evicted_tenant, evicted_engine in evicted:
+            evicted_engine.dispose()
+            TenantLocal.evict(evicted_tenant)
+            forget_ledger_snapshot(evicted_engine)
+        return engine
+
+    def tenants(self) -> List[str]:
+        """Tenants that already have a shard on disk."""
+        if not os.path.isdir(self.shard_dir):
+            return []
+        return sorted(name[:-3] for name in os.listdir(self.shard_dir) if name.endswith(".db"))
+
+    def dispose(self) -> None:
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+
+shard_router = ShardRouter()
+
+
+def get_engine() -> Engine:
+    """Engine of the current tenant's shard, or db_engine when no tenant is bound."""
+    tenant = current_tenant.get()
+    return db_engine if tenant is None else shard_router.engine_for(tenant)
+
+
+@contextmanager
+def tenant_scope(tenant: Optional[str]):
+    """Route every helper called inside the block to `tenant`'s ledger."""
+    token = current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        current_tenant.reset(token)
+
+
+class TenantLocal:
+    """One instance of some in-memory state per tenant, created on first use."""
 
-# Create an SQLite database
-db_engine = create_engine("sqlite:///munder_difflin.db")
+    _live: "weakref.WeakSet[TenantLocal]" = weakref.WeakSet()
+
+    def __init__(self, factory, default=None):
+        self._factory = factory
+        self._instances = {} if default is None else {None: default}
+        self._lock = threading.Lock()
+        TenantLocal._live.add(self)
+
+    @classmethod
+    def evict(cls, tenant: str) -> None:
+        """Drop `tenant`'s instance from every TenantLocal, e.g. once its shard is closed."""
+        for local in list(cls._live):
+            with local._lock:
+                local._instances.pop(tenant, None)
+
+    def get(self):
+        tenant = current_tenant.get()
+        with self._lock:
+            if tenant not in self._instances:
+                self._instances[tenant] = self._factory()
+            return self._instances[tenant]
+
+    def reset(self) -> None:
+        """Drop the current tenant's instance; the next get() builds a fresh one."""
+        with self._lock:
+            self._instances.pop(current_tenant.get(), None)
 
 # List containing the different kinds of papers 
 paper_supplies = [
@@ -78,6 +234,197 @@ paper_supplies = [
     {"item_name": "220 gsm poster paper",             "category": "specialty",    "unit_price": 0.35},
 ]
 
+
+# Compact Catalog - catalogs are stored column-wise: names in one fixed-width bytes
+# array with an open-addressing hash table for O(1) lookups, prices and minimum
+# stock levels in NumPy arrays, and categories as small integer codes. A 1M-SKU
+# catalog takes a fraction of the memory of a list of dicts and is searched
+# without rebuilding DataFrames.
+
+class CatalogItem:
+    """A single catalog row returned by CompactCatalog lookups."""
+
+    __slots__ = ("item_name", "category", "unit_price", "min_stock_level")
+
+    def __init__(self, item_name: str, category: str, unit_price: float, min_stock_level: int):
+        self.item_name = item_name
+        self.category = category
+        self.unit_price = unit_price
+        self.min_stock_level = min_stock_level
+
+    def __repr__(self) -> str:
+        return f"CatalogItem({self.item_name!r}, {self.category!r}, {self.unit_price}, {self.min_stock_level})"
+
+
+class CompactCatalog:
+    """Array-backed catalog with O(1) name-to-row lookup and vectorized price joins.
+
+    Args:
+        names: Item names, stored UTF-8 encoded in one fixed-width bytes array.
+        categories: Category per item, stored as int8 codes into `self.categories`.
+        unit_prices: Unit price per item.
+        min_stock_levels: Minimum stock level per item (0 when not tracked).
+    """
+
+    __slots__ = (
+        "name_bytes", "categories", "category_codes", "unit_prices", "min_stock_levels",
+        "_slots", "_mask", "_search_text", "_search_offsets",
+    )
+
+    def __init__(self, names, categories, unit_prices, min_stock_levels=None):
+        encoded = [str(name).encode("utf-8") for name in names]
+        self.name_bytes = np.array(encoded, dtype=bytes) if encoded else np.array([], dtype="S1")
+        codes, uniques = pd.factorize(pd.Series(list(categories), dtype=object))
+        self.category_codes = codes.astype(np.int8 if len(uniques) < 128 else np.int16)
+        self.categories = tuple(sys.intern(str(category)) for category in uniques)
+        self.unit_prices = np.asarray(unit_prices, dtype=np.float64)
+        self.min_stock_levels = (
+            np.zeros(len(encoded), dtype=np.int32) if min_stock_levels is None
+            else np.asarray(min_stock_levels, dtype=np.int32)
+        )
+        self._build_index(encoded)
+        self._search_text = None
+        self._search_offsets = None
+
+    def _build_index(self, encoded: List[bytes]) -> None:
+        # Linear-probing table of rows, at least twice the catalog size, filled in vectorized rounds
+        n = len(encoded)
+        size = 1 << max(3, (2 * n).bit_length())
+        self._mask = size - 1
+        self._slots = np.full(size, -1, dtype=np.int32 if n < 2**31 else np.int64)
+        positions = np.fromiter((hash(name) for name in encoded), dtype=np.int64, count=n) & self._mask
+        pending = np.arange(n)
+        while pending.size:
+            candidates = pending[self._slots[positions[pending]] == -1]
+            taken, first = np.unique(positions[candidates], return_index=True)
+            self._slots[taken] = candidates[first]
+            placed = np.zeros(n, dtype=bool)
+            placed[candidates[first]] = True
+            pending = pending[~placed[pending]]
+            positions[pending] = (positions[pending] + 1) & self._mask
+
+    @classmethod
+    def from_records(cls, records: List[Dict]) -> "CompactCatalog":
+        """Build from dicts with 'item_name', 'category', 'unit_price' (and optionally 'min_stock_level')."""
+        return cls(
+            [r["item_name"] for r in records],
+            [r["category"] for r in records],
+            [r["unit_price"] for r in records],
+            [r.get("min_stock_level", 0) for r in records],
+        )
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "CompactCatalog":
+        """Build from a DataFrame shaped like the `inventory` table."""
+        return cls(
+            df["item_name"],
+            df["category"],
+            df["unit_price"].to_numpy(),
+            df["min_stock_level"].to_numpy() if "min_stock_level" in df else None,
+        )
+
+    def __len__(self) -> int:
+        return len(self.name_bytes)
+
+    def __contains__(self, item_name: str) -> bool:
+        return self.row(item_name) >= 0
+
+    @property
+    def names(self) -> List[str]:
+        """All item names in catalog order (decoded and interned)."""
+        return [sys.intern(name.decode("utf-8")) for name in self.name_bytes.tolist()]
+
+    def name(self, row: int) -> str:
+        return sys.intern(self.name_bytes[row].decode("utf-8"))
+
+    def row(self, item_name: str) -> int:
+        """Row of `item_name`, or -1 if it is not in the catalog."""
+        key = item_name.encode("utf-8")
+        position = hash(key) & self._mask
+        while True:
+            row = int(self._slots[position])
+            if row < 0 or self.name_bytes[row] == key:
+                return row
+            position = (position + 1) & self._mask
+
+    def rows_for(self, item_names) -> np.ndarray:
+        """Rows for many names at once (-1 where missing), probing the table in vectorized rounds."""
+        keys = np.array([str(name).encode("utf-8") for name in item_names], dtype=bytes)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if not len(keys) or not len(self):
+            return rows
+        positions = np.fromiter((hash(key) for key in keys.tolist()), dtype=np.int64, count=len(keys)) & self._mask
+        pending = np.arange(len(keys))
+        while pending.size:
+            candidates = self._slots[positions[pending]].astype(np.int64)
+            found = candidates >= 0
+            matched = np.zeros(len(pending), dtype=bool)
+            matched[found] = self.name_bytes[candidates[found]] == keys[pending[found]]
+            rows[pending[matched]] = candidates[matched]
+            pending = pending[found & ~matched]
+            positions[pending] = (positions[pending] + 1) & self._mask
+        return rows
+
+    def item(self, row: int) -> CatalogItem:
+        return CatalogItem(
+            self.name(row),
+            self.categories[self.category_codes[row]],
+            float(self.unit_prices[row]),
+            int(self.min_stock_levels[row]),
+        )
+
+    def get(self, item_name: str) -> Optional[CatalogItem]:
+        row = self.row(item_name)
+        return None if row < 0 else self.item(row)
+
+    def price(self, item_name: str, default: Optional[float] = None) -> Optional[float]:
+        row = self.row(item_name)
+        return default if row < 0 else float(self.unit_prices[row])
+
+    def prices_for(self, item_names) -> np.ndarray:
+        """Vectorized price join: unit price per name, NaN where the name is missing."""
+        rows = self.rows_for(item_names)
+        prices = np.full(len(rows), np.nan)
+        prices[rows >= 0] = self.unit_prices[rows[rows >= 0]]
+        return prices
+
+    def search(self, fragment: str, limit: Optional[int] = None) -> List[int]:
+        """Rows whose name contains `fragment`, case-insensitively, in catalog order."""
+        if self._search_text is None:
+            lowered = [name.lower() for name in self.names]
+            self._search_text = "\n".join(lowered)
+            lengths = np.fromiter((len(name) + 1 for name in lowered), dtype=np.int64, count=len(lowered))
+            self._search_offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        fragment = fragment.lower()
+        if not fragment or "\n" in fragment:
+            return []
+        rows, position = [], self._search_text.find(fragment)
+        while position >= 0 and (limit is None or len(rows) < limit):
+            row = int(np.searchsorted(self._search_offsets, position, side="right")) - 1
+            rows.append(row)
+            next_start = self._search_offsets[row + 1] if row + 1 < len(self) else len(self._search_text)
+            position = self._search_text.find(fragment, int(next_start))
+        return rows
+
+
+product_catalog = CompactCatalog.from_records(paper_supplies)
+
+
+def load_inventory_catalog() -> CompactCatalog:
+    """Load the current tenant's `inventory` table into a CompactCatalog."""
+    return CompactCatalog.from_frame(pd.read_sql(
+        "SELECT item_name, category, unit_price, min_stock_level FROM inventory", get_engine()
+    ))
+
+
+# Loaded once per tenant; init_database resets it when the inventory table is rewritten
+inventory_catalogs = TenantLocal(load_inventory_catalog)
+
+
+def get_inventory_catalog() -> CompactCatalog:
+    """The current tenant's inventory catalog (stocked items with prices and minimum levels)."""
+    return inventory_catalogs.get()
+
 # Given below are some utility functions you can use to implement your multi-agent system
 
 def generate_sample_inventory(paper_supplies: list, coverage: float = 0.4, seed: int = 137) -> pd.DataFrame:
@@ -145,6 +492,7 @@ def init_database(db_engine: Engine, seed: int = 137) -> Engine:
     - Loads previous quotes from 'quotes.csv' into a 'quotes' table, extracting useful metadata
     - Generates a random subset of paper inventory using `generate_sample_inventory`
     - Inserts initial financial records including available cash and starting stock levels
+    - With QUOTE_ARCHIVE=1, moves the quote history into the compact quote archive
 
     Args:
         db_engine (Engine): A SQLAlchemy engine connected to the SQLite database.
@@ -168,6 +516,7 @@ def init_database(db_engine: Engine, seed: int = 137) -> Engine:
             "units": [],             # Quantity involved
             "price": [],             # Total price for the transaction
             "transaction_date": [],  # ISO-formatted date
+            "idempotency_key": [],   # Optional caller key; a repeated key never records twice
         })
         transactions_schema.to_sql("transactions", db_engine, if_exists="replace", index=False)
 
@@ -177,6 +526,7 @@ def init_database(db_engine: Engine, seed: int = 137) -> Engine:
         # ----------------------------
         # 2. Load and initialize 'quote_requests' table
         # ----------------------------
+        drop_quote_archive(db_engine)
         quote_requests_df = pd.read_csv("quote_requests.csv")
         quote_requests_df["id"] = range(1, len(quote_requests_df) + 1)
         quote_requests_df.to_sql("quote_requests", db_engine, if_exists="replace", index=False)
@@ -241,6 +591,22 @@ def init_database(db_engine: Engine, seed: int = 137) -> Engine:
 
         # Save the inventory reference table
         inventory_df.to_sql("inventory", db_engine, if_exists="replace", index=False)
+        inventory_catalogs.reset()
+        quote_templates.reset()
+        snapshot = get_ledger_snapshot(refresh=False, engine=db_engine)
+        if snapshot is not None:
+            snapshot.clear()
+
+        # ----------------------------
+        # 5. Index the ledger and create the run journal
+        # ----------------------------
+        ensure_ledger_schema(db_engine)
+
+        # ----------------------------
+        # 6. Optionally move the quote history into the compact archive
+        # ----------------------------
+        if QUOTE_ARCHIVE_ENABLED:
+            archive_quote_history(db_engine)
 
         return db_engine
 
@@ -248,12 +614,162 @@ def init_database(db_engine: Engine, seed: int = 137) -> Engine:
         print(f"Error initializing database: {e}")
         raise
 
+def ensure_ledger_schema(db_engine: Engine) -> None:
+    """
+    Bring an existing ledger up to the current schema. Safe to run repeatedly.
+
+    - Adds the 'idempotency_key' column to 'transactions' if it is missing
+    - Creates a covering index on (item_name, transaction_date, transaction_type, units)
+      so stock-level aggregations read only the index instead of the whole ledger
+    - Creates a unique index on 'idempotency_key'
+    - Creates 'ledger_revision', a counter that triggers bump whenever a ledger row
+      is updated or deleted, so copies of the ledger can tell it was edited
+    - Creates the run journal tables used to resume interrupted batch runs
+
+    Args:
+        db_engine (Engine): A SQLAlchemy engine connected to the SQLite database.
+    """
+    with db_engine.begin() as conn:
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(transactions)"))}
+        if "idempotency_key" not in columns:
+            conn.execute(text("ALTER TABLE transactions ADD COLUMN idempotency_key TEXT"))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_transactions_item_date
+            ON transactions (item_name, transaction_date, transaction_type, units)
+        """))
+        conn.execute(text("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_idempotency_key
+            ON transactions (idempotency_key) WHERE idempotency_key IS NOT NULL
+        """))
+        conn.execute(text("CREATE TABLE IF NOT EXISTS ledger_revision (revision INTEGER NOT NULL)"))
+        conn.execute(text("""
+            INSERT INTO ledger_revision (revision)
+            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM ledger_revision)
+        """))
+        for event in ("UPDATE", "DELETE"):
+            conn.execute(text(f"""
+                CREATE TRIGGER IF NOT EXISTS transactions_after_{event.lower()}
+                AFTER {event} ON transactions
+                BEGIN
+                    UPDATE ledger_revision SET revision = revision + 1;
+                END
+            """))
+    ensure_run_journal(db_engine)
+
+
+def ledger_revision(cursor) -> Optional[int]:
+    """The ledger's edit counter (see `ensure_ledger_schema`), or None if it has none.
+
+    Args:
+        cursor: A DB-API cursor on the ledger database.
+    """
+    try:
+        row = cursor.execute("SELECT revision FROM ledger_revision").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def ensure_run_journal(db_engine: Engine) -> None:
+    """
+    Create the run journal tables if they do not exist. Unlike the ledger tables,
+    they are never replaced by `init_database`.
+
+    - 'batch_runs': one row per batch run, with its start and finish times
+    - 'run_journal': one row per request of a run, with its status and the IDs of
+      the transactions it recorded
+
+    Args:
+        db_engine (Engine): A SQLAlchemy engine connected to the SQLite database.
+    """
+    with db_engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS batch_runs (
+                run_id TEXT PRIMARY KEY,
+                started_at TEXT NOT NULL,
+                finished_at TEXT
+            )
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS run_journal (
+                run_id TEXT NOT NULL,
+                request_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                transaction_ids TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (run_id, request_id)
+            )
+        """))
+
+# Callbacks invoked with the list of newly recorded transactions after every successful insert
+TRANSACTION_LISTENERS: List = []
+
+def register_transaction_listener(listener) -> None:
+    """
+    Register a callback that receives every transaction recorded by this module.
+
+    The callback is called with a list of dictionaries holding 'id', 'item_name',
+    'transaction_type', 'units', 'price' and 'transaction_date' after the insert commits.
+
+    Args:
+        listener (Callable[[List[Dict]], None]): The callback to register.
+    """
+    if listener not in TRANSACTION_LISTENERS:
+        TRANSACTION_LISTENERS.append(listener)
+
+def notify_transaction_listeners(records: List[Dict]) -> None:
+    """
+    Pass newly recorded transactions to every registered listener.
+
+    A failing listener is reported but never undoes or blocks the committed transaction.
+
+    Args:
+        records (List[Dict]): The recorded transactions, including their IDs.
+    """
+    for listener in TRANSACTION_LISTENERS:
+        try:
+            listener(records)
+        except Exception as e:
+            print(f"Error in transaction listener {getattr(listener, '__name__', listener)}: {e}")
+
+class IdempotencyConflictError(ValueError):
+    """A ledger write reused an idempotency key with other values than the transaction
+    recorded under it, e.g. a resumed request whose agent now chose another quantity.
+    The recorded transaction stands; `transaction_id` identifies it."""
+
+    def __init__(self, idempotency_key: str, transaction_id: int, differences: List[str]):
+        self.idempotency_key = idempotency_key
+        self.transaction_id = transaction_id
+        super().__init__(
+            f"transaction #{transaction_id} was already recorded under key '{idempotency_key}' "
+            f"with different values ({'; '.join(differences)})"
+        )
+
+
+# Ledger fields a replayed write must repeat exactly to reuse an idempotency key
+_IDEMPOTENT_FIELDS = ("item_name", "transaction_type", "units", "price", "transaction_date")
+
+
+def _payload_differences(recorded: Dict, requested: Dict) -> List[str]:
+    differences = []
+    for name in _IDEMPOTENT_FIELDS:
+        old, new = recorded.get(name), requested.get(name)
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+            same = abs(float(old) - float(new)) < 1e-9
+        else:
+            same = old == new
+        if not same:
+            differences.append(f"{name}: recorded {old!r}, now {new!r}")
+    return differences
+
+
 def create_transaction(
     item_name: str,
     transaction_type: str,
     quantity: int,
     price: float,
     date: Union[str, datetime],
+    idempotency_key: Optional[str] = None,
 ) -> int:
     """
     This function records a transaction of type 'stock_orders' or 'sales' with a specified
@@ -265,12 +781,15 @@ def create_transaction(
         quantity (int): Number of units involved in the transaction.
         price (float): Total price of the transaction.
         date (str or datetime): Date of the transaction in ISO 8601 format.
+        idempotency_key (str, optional): Caller-chosen unique key. If a transaction with this
+            key already exists, nothing is inserted and the existing ID is returned.
 
     Returns:
-        int: The ID of the newly inserted transaction.
+        int: The ID of the newly inserted (or previously recorded) transaction.
 
     Raises:
         ValueError: If `transaction_type` is not 'stock_orders' or 'sales'.
+        IdempotencyConflictError: If the key was recorded with different values.
         Exception: For other database or execution errors.
     """
     try:
@@ -281,26 +800,164 @@ def create_transaction(
         if transaction_type not in {"stock_orders", "sales"}:
             raise ValueError("Transaction type must be 'stock_orders' or 'sales'")
 
-        # Prepare transaction record as a single-row DataFrame
-        transaction = pd.DataFrame([{
+        # Prepare transaction record
+        transaction = {
             "item_name": item_name,
             "transaction_type": transaction_type,
-            "units": quantity,
-            "price": price,
+            "units": None if quantity is None else int(quantity),
+            "price": float(price),
             "transaction_date": date_str,
-        }])
+            "idempotency_key": idempotency_key,
+        }
 
-        # Insert the record into the database
-        transaction.to_sql("transactions", db_engine, if_exists="append", index=False)
+        if idempotency_key is not None:
+            existing_id = find_transaction_by_key(idempotency_key, transaction)
+            if existing_id is not None:
+                return existing_id
 
-        # Fetch and return the ID of the inserted row
-        result = pd.read_sql("SELECT last_insert_rowid() as id", db_engine)
-        return int(result.iloc[0]["id"])
+        # Insert the record and read its ID on the same connection
+        try:
+            with get_engine().begin() as conn:
+                conn.execute(text("""
+                    INSERT INTO transactions
+                        (item_name, transaction_type, units, price, transaction_date, idempotency_key)
+                    VALUES
+                        (:item_name, :transaction_type, :units, :price, :transaction_date, :idempotency_key)
+                """), transaction)
+                transaction_id = int(conn.execute(text("SELECT last_insert_rowid()")).scalar_one())
+        except IntegrityError:
+            # A concurrent writer recorded the same idempotency key first
+            existing_id = find_transaction_by_key(idempotency_key, transaction) if idempotency_key else None
+            if existing_id is None:
+                raise
+            return existing_id
+
+        notify_transaction_listeners([{"id": transaction_id, **transaction}])
+        return transaction_id
 
     except Exception as e:
         print(f"Error creating transaction: {e}")
         raise
 
+def find_transaction_by_key(idempotency_key: str, expected: Optional[Dict] = None) -> Optional[int]:
+    """
+    Look up the ID of the transaction recorded with an idempotency key.
+
+    Args:
+        idempotency_key (str): The key passed when the transaction was recorded.
+        expected (Dict, optional): The values of the write being replayed
+            ('item_name', 'transaction_type', 'units', 'price', 'transaction_date').
+
+    Returns:
+        Optional[int]: The transaction ID, or None if no transaction used this key.
+
+    Raises:
+        IdempotencyConflictError: If `expected` differs from the recorded transaction.
+    """
+    with get_engine().connect() as conn:
+        row = conn.execute(
+            text(f"SELECT rowid, {', '.join(_IDEMPOTENT_FIELDS)} FROM transactions WHERE idempotency_key = :key"),
+            {"key": idempotency_key},
+        ).mappings().first()
+    if row is None:
+        return None
+    if expected is not None:
+        differences = _payload_differences(row, expected)
+        if differences:
+            raise IdempotencyConflictError(idempotency_key, int(row["rowid"]), differences)
+    return int(row["rowid"])
+
+def create_transactions_bulk(transactions: Union[pd.DataFrame, List[Dict]]) -> List[int]:
+    """
+    Record a batch of 'stock_orders' or 'sales' transactions in a single database transaction.
+
+    All rows are inserted with one `executemany` call inside one SQLite write transaction,
+    so a batch of thousands of orders costs one commit instead of one per row.
+
+    Args:
+        transactions (pd.DataFrame or List[Dict]): Records with keys 'item_name',
+            'transaction_type', 'units', 'price', 'transaction_date' and optionally
+            'idempotency_key'. Records whose key was already recorded are skipped.
+
+    Returns:
+        List[int]: The IDs of the inserted (or previously recorded) transactions, in input order.
+        A record whose key was recorded with different values keeps the recorded
+        transaction, and the difference is logged.
+
+    Raises:
+        ValueError: If any record has a `transaction_type` other than 'stock_orders' or 'sales'.
+        Exception: For other database or execution errors.
+    """
+    try:
+        if isinstance(transactions, pd.DataFrame):
+            records = transactions.to_dict(orient="records")
+        else:
+            records = [dict(record) for record in transactions]
+        if not records:
+            return []
+
+        # Validate transaction types and normalize dates / numpy scalars
+        for record in records:
+            if record["transaction_type"] not in {"stock_orders", "sales"}:
+                raise ValueError("Transaction type must be 'stock_orders' or 'sales'")
+            if isinstance(record["transaction_date"], datetime):
+                record["transaction_date"] = record["transaction_date"].isoformat()
+            record["units"] = None if record["units"] is None else int(record["units"])
+            record["price"] = float(record["price"])
+            record.setdefault("idempotency_key", None)
+
+        insert_query = text("""
+            INSERT INTO transactions
+                (item_name, transaction_type, units, price, transaction_date, idempotency_key)
+            VALUES
+                (:item_name, :transaction_type, :units, :price, :transaction_date, :idempotency_key)
+        """)
+
+        with get_engine().begin() as conn:
+            # Skip records whose idempotency key was recorded by an earlier attempt
+            keys = [record["idempotency_key"] for record in records if record["idempotency_key"]]
+            existing, recorded = {}, {}
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ", ".join(f":k{i}" for i in range(len(chunk)))
+                for row in conn.execute(
+                    text(f"SELECT idempotency_key, rowid, {', '.join(_IDEMPOTENT_FIELDS)} FROM transactions "
+                         f"WHERE idempotency_key IN ({placeholders})"),
+                    {f"k{i}": key for i, key in enumerate(chunk)},
+                ).mappings():
+                    existing[row["idempotency_key"]] = row["rowid"]
+                    recorded[row["idempotency_key"]] = row
+            new_records = [record for record in records if record["idempotency_key"] not in existing]
+            for record in records:
+                key = record["idempotency_key"]
+                differences = _payload_differences(recorded[key], record) if key in recorded else []
+                if differences:
+                    logger.warning(
+                        "Not recording again: %s",
+                        IdempotencyConflictError(key, int(existing[key]), differences),
+                    )
+
+            # Rowids are assigned sequentially while this connection holds the write lock
+            new_ids = []
+            if new_records:
+                conn.execute(insert_query, new_records)
+                last_id = conn.execute(text("SELECT last_insert_rowid()")).scalar_one()
+                new_ids = list(range(last_id - len(new_records) + 1, last_id + 1))
+
+        notify_transaction_listeners([
+            {"id": txn_id, **record} for txn_id, record in zip(new_ids, new_records)
+        ])
+        new_id_iter = iter(new_ids)
+        return [
+            int(existing[record["idempotency_key"]])
+            if record["idempotency_key"] in existing else next(new_id_iter)
+            for record in records
+        ]
+
+    except Exception as e:
+        print(f"Error creating transactions in bulk: {e}")
+        raise
+
 def get_all_inventory(as_of_date: str) -> Dict[str, int]:
     """
     Retrieve a snapshot of available inventory as of a specific date.
@@ -333,7 +990,7 @@ def get_all_inventory(as_of_date: str) -> Dict[str, int]:
     """
 
     # Execute the query with the date parameter
-    result = pd.read_sql(query, db_engine, params={"as_of_date": as_of_date})
+    result = pd.read_sql(query, get_engine(), params={"as_of_date": as_of_date})
 
     # Convert the result into a dictionary {item_name: stock}
     return dict(zip(result["item_name"], result["stock"]))
@@ -373,10 +1030,116 @@ def get_stock_level(item_name: str, as_of_date: Union[str, datetime]) -> pd.Data
     # Execute query and return result as a DataFrame
     return pd.read_sql(
         stock_query,
-        db_engine,
+        get_engine(),
         params={"item_name": item_name, "as_of_date": as_of_date},
     )
 
+# Supplier lead-time tiers: orders up to each quantity bound arrive after the given number of days
+SUPPLIER_LEAD_TIME_BOUNDS = np.array([10, 100, 1000])
+SUPPLIER_LEAD_TIME_DAYS = np.array([0, 1, 4, 7])
+
+def get_supplier_lead_days(quantities: Union[int, np.ndarray]) -> Union[int, np.ndarray]:
+    """
+    Look up the supplier lead time in days for one or many order quantities.
+
+    Args:
+        quantities (int or np.ndarray): Order quantity, or an array of order quantities.
+
+    Returns:
+        int or np.ndarray: Lead time in days for each quantity (same shape as the input).
+    """
+    tier = np.searchsorted(SUPPLIER_LEAD_TIME_BOUNDS, quantities, side="left")
+    return SUPPLIER_LEAD_TIME_DAYS[tier]
+
+def make_supplier_calendar(weekmask: str = "1111100", holidays: Optional[List[str]] = None) -> np.busdaycalendar:
+    """
+    Build a supplier working-day calendar for `schedule_deliveries`.
+
+    Args:
+        weekmask (str): Seven 0/1 flags for Monday..Sunday; the default ships Monday to Friday.
+        holidays (List[str], optional): ISO dates on which the supplier does not ship.
+
+    Returns:
+        np.busdaycalendar: The calendar.
+    """
+    return np.busdaycalendar(weekmask=weekmask, holidays=list(holidays or []))
+
+def _supplier_calendar_from_env() -> Optional[np.busdaycalendar]:
+    weekmask = os.getenv("SUPPLIER_WEEKMASK")
+    holidays = os.getenv("SUPPLIER_HOLIDAYS")
+    if not weekmask and not holidays:
+        return None
+    return make_supplier_calendar(
+        weekmask or "1111111",
+        [day.strip() for day in holidays.split(",") if day.strip()] if holidays else None,
+    )
+
+# Supplier working days (SUPPLIER_WEEKMASK / SUPPLIER_HOLIDAYS); None counts every calendar day
+supplier_calendar = _supplier_calendar_from_env()
+
+def _parse_order_dates(order_dates) -> np.ndarray:
+    """Order dates as datetime64[D], parsed like `datetime.fromisoformat` (any time part is
+    ignored; compact forms such as '20250401' are accepted); invalid dates fall back to today."""
+    # numpy reads anything but YYYY-MM-DD differently from fromisoformat ('20250401' is a
+    # year), so only strings of exactly that shape take the fast paths
+    if isinstance(order_dates, str):
+        day = order_dates[:10]
+        if len(day) == 10 and day[4] == day[7] == "-":
+            try:
+                return np.array(day, dtype="datetime64[D]")
+            except ValueError:
+                pass
+    raw = np.asarray(order_dates, dtype=str)
+    days = raw.astype("U10")
+    chars = days.reshape(-1).view("U1").reshape(-1, 10) if days.size else np.empty((0, 10), dtype="U1")
+    if (chars[:, 4] == "-").all() and (chars[:, 7] == "-").all():
+        try:
+            parsed = days.astype("datetime64[D]")
+            if not np.isnat(parsed).any():
+                return parsed
+        except ValueError:
+            pass
+
+    today = np.datetime64(datetime.now().date(), "D")
+
+    def parse(day: str) -> np.datetime64:
+        try:
+            return np.datetime64(datetime.fromisoformat(day.split("T")[0]).date(), "D")
+        except ValueError:
+            logger.warning("Invalid date format '%s', using today as base.", day)
+            return today
+
+    return np.array([parse(day) for day in raw.ravel()], dtype="datetime64[D]").reshape(raw.shape)
+
+
+def schedule_deliveries(
+    order_dates: Union[str, List[str], np.ndarray],
+    quantities: Union[int, List[int], np.ndarray],
+    calendar: Optional[np.busdaycalendar] = None,
+) -> np.ndarray:
+    """
+    Compute supplier delivery dates for many orders at once.
+
+    Lead times come from the precomputed quantity tiers (`get_supplier_lead_days`).
+    Without a calendar they are calendar days, as in `get_supplier_delivery_date`.
+    With a calendar they are supplier working days, and an order placed on a
+    non-working day starts counting from the next working day.
+
+    Args:
+        order_dates (str, list or np.ndarray): ISO order date(s); a single date applies to every quantity.
+        quantities (int, list or np.ndarray): Order quantity or quantities.
+        calendar (np.busdaycalendar, optional): Supplier working days; defaults to `supplier_calendar`.
+
+    Returns:
+        np.ndarray: datetime64[D] delivery dates, broadcast to the shape of the inputs.
+    """
+    dates, quantities = np.broadcast_arrays(_parse_order_dates(order_dates), np.asarray(quantities))
+    lead_days = get_supplier_lead_days(quantities)
+    calendar = supplier_calendar if calendar is None else calendar
+    if calendar is None:
+        return dates + lead_days.astype("timedelta64[D]")
+    return np.busday_offset(dates, lead_days, roll="forward", busdaycal=calendar)
+
 def get_supplier_delivery_date(input_date_str: str, quantity: int) -> str:
     """
     Estimate the supplier delivery date based on the requested order quantity and a starting date.
@@ -394,32 +1157,8 @@ def get_supplier_delivery_date(input_date_str: str, quantity: int) -> str:
     Returns:
         str: Estimated delivery date in ISO format (YYYY-MM-DD).
     """
-    # Debug log (comment out in production if needed)
-    print(f"FUNC (get_supplier_delivery_date): Calculating for qty {quantity} from date string '{input_date_str}'")
-
-    # Attempt to parse the input date
-    try:
-        input_date_dt = datetime.fromisoformat(input_date_str.split("T")[0])
-    except (ValueError, TypeError):
-        # Fallback to current date on format error
-        print(f"WARN (get_supplier_delivery_date): Invalid date format '{input_date_str}', using today as base.")
-        input_date_dt = datetime.now()
-
-    # Determine delivery delay based on quantity
-    if quantity <= 10:
-        days = 0
-    elif quantity <= 100:
-        days = 1
-    elif quantity <= 1000:
-        days = 4
-    else:
-        days = 7
-
-    # Add delivery days to the starting date
-    delivery_date_dt = input_date_dt + timedelta(days=days)
-
-    # Return formatted delivery date
-    return delivery_date_dt.strftime("%Y-%m-%d")
+    logger.debug("Calculating for qty %s from date string '%s'", quantity, input_date_str)
+    return str(schedule_deliveries(input_date_str, quantity)[()])
 
 def get_cash_balance(as_of_date: Union[str, datetime]) -> float:
     """
@@ -439,10 +1178,15 @@ def get_cash_balance(as_of_date: Union[str, datetime]) -> float:
         if isinstance(as_of_date, datetime):
             as_of_date = as_of_date.isoformat()
 
+        # Served from the columnar snapshot when one is available
+        snapshot = get_ledger_snapshot()
+        if snapshot is not None:
+            return snapshot.cash_balance(as_of_date)
+
         # Query all transactions on or before the specified date
         transactions = pd.read_sql(
             "SELECT * FROM transactions WHERE transaction_date <= :as_of_date",
-            db_engine,
+            get_engine(),
             params={"as_of_date": as_of_date},
         )
 
@@ -486,39 +1230,94 @@ def generate_financial_report(as_of_date: Union[str, datetime]) -> Dict:
     if isinstance(as_of_date, datetime):
         as_of_date = as_of_date.isoformat()
 
-    # Get current cash balance
-    cash = get_cash_balance(as_of_date)
+    snapshot = get_ledger_snapshot()
+    if snapshot is not None:
+        return expand_financial_report(snapshot.financial_report_columns(as_of_date))
 
-    # Get current inventory snapshot
-    inventory_df = pd.read_sql("SELECT * FROM inventory", db_engine)
-    inventory_value = 0.0
-    inventory_summary = []
+    # Borrow the raw DB-API connection; the same queries run in the reporting workers
+    with get_engine().connect() as conn:
+        columns = financial_report_columns(conn.connection.dbapi_connection, as_of_date)
+    return expand_financial_report(columns)
 
-    # Compute total inventory value and summary by item
-    for _, item in inventory_df.iterrows():
-        stock_info = get_stock_level(item["item_name"], as_of_date)
-        stock = stock_info["current_stock"].iloc[0]
-        item_value = stock * item["unit_price"]
-        inventory_value += item_value
 
-        inventory_summary.append({
-            "item_name": item["item_name"],
-            "stock": stock,
-            "unit_price": item["unit_price"],
-            "value": item_value,
-        })
+def financial_report_columns(conn, as_of_date: str) -> tuple:
+    """
+    Run the financial report queries on a DB-API connection.
+
+    Stock for every catalog item comes from one grouped query instead of one
+    query per item. The result is a compact, picklable tuple so it can be
+    returned cheaply from a worker process.
+
+    Args:
+        conn: An open sqlite3 (DB-API) connection.
+        as_of_date (str): The cutoff date (inclusive) in ISO format.
+
+    Returns:
+        tuple: (as_of_date, cash, item_names, stock, unit_prices, top_sales) where
+        stock and unit_prices are float64 arrays aligned with item_names and
+        top_sales holds (item_name, total_units, total_revenue) rows. As in
+        get_cash_balance, cash is 0.0 if it cannot be computed.
+    """
+    cursor = conn.cursor()
+    try:
+        cash = cursor.execute("""
+            SELECT COALESCE(SUM(CASE
+                WHEN transaction_type = 'sales' THEN price
+                WHEN transaction_type = 'stock_orders' THEN -price
+                ELSE 0
+            END), 0)
+            FROM transactions
+            WHERE transaction_date <= :date
+        """, {"date": as_of_date}).fetchone()[0]
+    except Exception as e:
+        print(f"Error getting cash balance: {e}")
+        cash = 0.0
+
+    # Stock per item in catalog order; items without transactions have 0 stock
+    rows = cursor.execute("""
+        SELECT i.item_name, i.unit_price, COALESCE(SUM(CASE
+            WHEN t.transaction_type = 'stock_orders' THEN t.units
+            WHEN t.transaction_type = 'sales' THEN -t.units
+            ELSE 0
+        END), 0)
+        FROM inventory i
+        LEFT JOIN transactions t
+            ON t.item_name = i.item_name AND t.transaction_date <= :date
+        GROUP BY i.rowid
+        ORDER BY i.rowid
+    """, {"date": as_of_date}).fetchall()
 
     # Identify top-selling products by revenue
-    top_sales_query = """
+    top_sales = cursor.execute("""
         SELECT item_name, SUM(units) as total_units, SUM(price) as total_revenue
         FROM transactions
         WHERE transaction_type = 'sales' AND transaction_date <= :date
         GROUP BY item_name
         ORDER BY total_revenue DESC
         LIMIT 5
-    """
-    top_sales = pd.read_sql(top_sales_query, db_engine, params={"date": as_of_date})
-    top_selling_products = top_sales.to_dict(orient="records")
+    """, {"date": as_of_date}).fetchall()
+    cursor.close()
+
+    item_names = [row[0] for row in rows]
+    unit_prices = np.array([row[1] for row in rows], dtype=float)
+    stock = np.array([row[2] for row in rows], dtype=float)
+    return as_of_date, float(cash), item_names, stock, unit_prices, top_sales
+
+
+def expand_financial_report(columns: tuple) -> Dict:
+    """Turn the tuple from `financial_report_columns` into the report dictionary."""
+    as_of_date, cash, item_names, stock, unit_prices, top_sales = columns
+    values = stock * unit_prices
+    inventory_value = float(values.sum())
+    # Stock is carried as float64 for the arithmetic; units are whole numbers
+    inventory_summary = [
+        {"item_name": name, "stock": int(qty), "unit_price": price, "value": value}
+        for name, qty, price, value in zip(item_names, stock.tolist(), unit_prices.tolist(), values.tolist())
+    ]
+    top_selling_products = [
+        {"item_name": name, "total_units": units, "total_revenue": revenue}
+        for name, units, revenue in top_sales
+    ]
 
     return {
         "as_of_date": as_of_date,
@@ -530,122 +1329,1811 @@ def generate_financial_report(as_of_date: Union[str, datetime]) -> Dict:
     }
 
 
-def search_quote_history(search_terms: List[str], limit: int = 5) -> List[Dict]:
-    """
-    Retrieve a list of historical quotes that match any of the provided search terms.
+# Reporting workers - reports can run in a process pool instead of on the calling
+# thread. Each worker keeps one read-only SQLite connection per database file. No
+# speedup has been measured yet: on a single core the pool was no faster than inline.
 
-    The function searches both the original customer request (from `quote_requests`) and
-    the explanation for the quote (from `quotes`) for each keyword. Results are sorted by
-    most recent order date and limited by the `limit` parameter.
+_worker_connections: Dict[str, sqlite3.Connection] = {}
 
-    Args:
-        search_terms (List[str]): List of terms to match against customer requests and explanations.
-        limit (int, optional): Maximum number of quote records to return. Default is 5.
 
-    Returns:
-        List[Dict]: A list of matching quotes, each represented as a dictionary with fields:
-            - original_request
-            - total_amount
-            - quote_explanation
-            - job_type
-            - order_size
-            - event_type
-            - order_date
-    """
-    conditions = []
-    params = {}
+def _read_only_connection(db_path: str) -> sqlite3.Connection:
+    conn = _worker_connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+        _worker_connections[db_path] = conn
+    return conn
 
-    # Build SQL WHERE clause using LIKE filters for each search term
-    for i, term in enumerate(search_terms):
-        param_name = f"term_{i}"
-        conditions.append(
-            f"(LOWER(qr.response) LIKE :{param_name} OR "
-            f"LOWER(q.quote_explanation) LIKE :{param_name})"
-        )
-        params[param_name] = f"%{term.lower()}%"
 
-    # Combine conditions; fallback to always-true if no terms provided
-    where_clause = " AND ".join(conditions) if conditions else "1=1"
+def _financial_report_job(db_path: str, as_of_date: str) -> tuple:
+    return financial_report_columns(_read_only_connection(db_path), as_of_date)
 
-    # Final SQL query to join quotes with quote_requests
-    query = f"""
-        SELECT
-            qr.response AS original_request,
-            q.total_amount,
-            q.quote_explanation,
-            q.job_type,
-            q.order_size,
-            q.event_type,
-            q.order_date
-        FROM quotes q
-        JOIN quote_requests qr ON q.request_id = qr.id
-        WHERE {where_clause}
-        ORDER BY q.order_date DESC
-        LIMIT {limit}
+
+class ReportingBackend:
+    """Runs financial reports inline or on a pool of worker processes.
+
+    Args:
+        workers: Worker processes; 0 runs every report inline on the calling thread.
     """
 
-    # Execute parameterized query
-    with db_engine.connect() as conn:
-        result = conn.execute(text(query), params)
-        return [dict(row._mapping) for row in result]
+    def __init__(self, workers: int = 0):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
 
-########################
-########################
-########################
-# Multi Agent code Implementation
-########################
-########################
-########################
+    def _executor(self):
+        from concurrent.futures import ProcessPoolExecutor
 
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
 
-# Environment Setup and Model Initialization
-dotenv.load_dotenv("config.env")
+    def submit_financial_report(self, as_of_date: Union[str, datetime]):
+        """Start a report for the current tenant's ledger; returns a Future of the report dict."""
+        from concurrent.futures import Future
 
-model = OpenAIServerModel(
-    model_id="gpt-4o-mini",
-    api_key=os.getenv("OPENAI_API_KEY"),
-    api_base=os.getenv("OPENAI_BASE_URL"),
-)
+        if isinstance(as_of_date, datetime):
+            as_of_date = as_of_date.isoformat()
+        result = Future()
+        if self.workers <= 0:
+            result.set_result(generate_financial_report(as_of_date))
+            return result
 
+        db_path = os.path.abspath(get_engine().url.database)
+        job = self._executor().submit(_financial_report_job, db_path, as_of_date)
 
-# Terminal Animation - provides colored, real-time visibility 
-AGENT_COLORS = {
-    "orchestrator": "\033[95m",   # Magenta
-    "inventory":    "\033[94m",   # Blue
-    "quoting":      "\033[93m",   # Yellow
-    "sales":        "\033[92m",   # Green
-    "advisor":      "\033[96m",   # Cyan
-    "reset":        "\033[0m",
-    "bold":         "\033[1m",
-}
+        def expand(done) -> None:
+            try:
+                result.set_result(expand_financial_report(done.result()))
+            except Exception as e:
+                result.set_exception(e)
 
-def print_agent_banner(agent_name: str, action: str) -> None:
-    """Display a colored banner indicating the active agent and its current action."""
-    color = AGENT_COLORS.get(agent_name.lower(), AGENT_COLORS["reset"])
-    reset = AGENT_COLORS["reset"]
-    bold = AGENT_COLORS["bold"]
-    print(f"\n{color}{bold}{'─' * 60}")
-    print(f"[{agent_name.upper()} AGENT] {action}")
-    print(f"{'─' * 60}{reset}")
-    sys.stdout.flush()
+        job.add_done_callback(expand)
+        return result
 
+    def financial_report(self, as_of_date: Union[str, datetime]) -> Dict:
+        """Generate one report, blocking until it is ready."""
+        return self.submit_financial_report(as_of_date).result()
 
-def print_step(agent_name: str, message: str) -> None:
+    def financial_reports(self, dates: List[str]) -> List[Dict]:
+        """Generate reports for many dates, in parallel when workers are configured."""
+        futures = [self.submit_financial_report(date) for date in dates]
+        return [future.result() for future in futures]
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+reporting_backend = ReportingBackend(workers=int(os.getenv("REPORT_WORKERS", "0")))
+
+
+# Ledger snapshot - analytics (cash, stock valuation, top sellers) read a columnar,
+# memory-mapped copy of `transactions` kept next to the database file instead of
+# pulling rows out of SQLite. A refresh reads only the rows added since the last
+# one, so keeping it current costs an indexed range query. New rows are kept in an
+# in-memory tail until there are SNAPSHOT_EXPORT_ROWS of them, then exported as a new
+# segment of .npy columns; segments are merged once there are too many of them.
+
+# Columns copied from the ledger, and columns derived from them when a segment is written
+SNAPSHOT_BASE_COLUMNS = ("rowid", "item", "kind", "units", "price", "date")
+SNAPSHOT_DERIVED_COLUMNS = ("stock_delta", "revenue", "is_sale", "cash_total")
+SNAPSHOT_SALE, SNAPSHOT_STOCK_ORDER = 1, 2
+# New ledger rows held in memory before they are written out as a segment
+SNAPSHOT_EXPORT_ROWS = int(os.getenv("SNAPSHOT_EXPORT_ROWS", "512"))
+
+
+@contextmanager
+def exclusive_file_lock(path: str, timeout: float = 120.0):
+    """Hold an exclusive OS-level lock on `path` (created if missing), shared by every
+    process using the same path.
+
+    Raises:
+        TimeoutError: If the lock is not free within `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after about ten seconds
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Lock on {path} not free after {timeout:.0f}s")
+        else:
+            import fcntl
+            delay = 0.001
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Lock on {path} not free after {timeout:.0f}s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class LedgerSnapshot:
+    """Columnar, memory-mapped copy of the `transactions` table.
+
+    Items are stored as integer codes into `self.items`, transaction types as
+    int8 kinds and dates as fixed-width bytes, which order exactly like the ISO
+    strings SQLite compares. Each segment is sorted by date, so the rows up to a
+    cutoff date are a zero-copy prefix found by binary search; signed stock
+    movements, sales revenue and a running cash total are precomputed per row.
+
+    Rows are identified by SQLite rowid. The snapshot is rebuilt when the last
+    exported row no longer matches the ledger (it was re-initialized) or when the
+    ledger's revision changed (a row was edited or deleted, see
+    `ensure_ledger_schema`). Rows added since the last export live in an in-memory
+    tail segment, so reads after a write do not touch the files.
+
+    Several processes may share one snapshot directory (report workers, several
+    runs on one database). Files are only written under an exclusive file lock, and
+    a process taking it first reloads the manifest if another process changed it.
+
+    Args:
+        directory: Where segment directories and the manifest are written.
+        max_segments: Segments kept before they are merged into one.
+        export_rows: New rows kept in memory before they are exported as a segment.
+    """
+
+    def __init__(self, directory: str, max_segments: int = 16, export_rows: int = SNAPSHOT_EXPORT_ROWS):
+        self.directory = directory
+        self.max_segments = max_segments
+        self.export_rows = export_rows
+        self.last_rowid = 0
+        self.last_row: Optional[list] = None
+        self.revision: Optional[int] = None
+        self._tail_rows: list = []
+        self._tail: Optional[Dict[str, np.ndarray]] = None
+        self.items: List[Optional[str]] = []
+        self._codes: Dict[Optional[str], int] = {}
+        self._segments: tuple = ()
+        self._segment_names: List[str] = []
+        self._catalog_codes = None
+        self._manifest_version = None
+        self._lock = threading.Lock()
+        self._load_manifest()
+
+    # -- storage -----------------------------------------------------------------
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, "manifest.json")
+
+    def _manifest_stat(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self._manifest_path())
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive access to the files (caller holds self._lock), with the in-memory
+        state first brought in line with whatever other processes wrote."""
+        os.makedirs(self.directory, exist_ok=True)
+        with exclusive_file_lock(os.path.join(self.directory, "write.lock")):
+            if self._manifest_stat() != self._manifest_version:
+                self._reset()
+                self._load_manifest()
+            yield
+
+    def _open_segment(self, name: str) -> Dict[str, np.ndarray]:
+        return {
+            column: np.load(os.path.join(self.directory, name, f"{column}.npy"), mmap_mode="r")
+            for column in SNAPSHOT_BASE_COLUMNS + SNAPSHOT_DERIVED_COLUMNS
+        }
+
+    def _load_manifest(self) -> None:
+        self._manifest_version = self._manifest_stat()
+        try:
+            with open(self._manifest_path()) as f:
+                manifest = json.load(f)
+            segments = tuple(self._open_segment(name) for name in manifest["segments"])
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Ignoring unreadable ledger snapshot in {self.directory}: {e}")
+            return
+        self.last_rowid = manifest["last_rowid"]
+        self.last_row = manifest["last_row"]
+        self.revision = manifest.get("revision")
+        self.items = manifest["items"]
+        self._codes = {name: code for code, name in enumerate(self.items)}
+        self._segment_names = list(manifest["segments"])
+        self._segments = segments
+
+    def _write_manifest(self) -> None:
+        manifest = {
+            "last_rowid": self.last_rowid,
+            "last_row": self.last_row,
+            "revision": self.revision,
+            "items": self.items,
+            "segments": self._segment_names,
+        }
+        temp_path = self._manifest_path() + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self._manifest_path())
+        self._manifest_version = self._manifest_stat()
+
+    def _columns(self, rows: list) -> Dict[str, np.ndarray]:
+        """Base columns for ledger rows, adding new item names to the item codes."""
+        rowids, names, types, units, prices, dates = zip(*rows)
+        for name in set(names) - self._codes.keys():
+            self._codes[name] = len(self.items)
+            self.items.append(name)
+        return {
+            "rowid": np.array(rowids, dtype=np.int64),
+            "item": np.fromiter((self._codes[name] for name in names), dtype=np.int32, count=len(names)),
+            "kind": np.fromiter(
+                (SNAPSHOT_SALE if t == "sales" else SNAPSHOT_STOCK_ORDER if t == "stock_orders" else 0 for t in types),
+                dtype=np.int8, count=len(types),
+            ),
+            "units": np.nan_to_num(np.array(units, dtype=np.float64)),
+            "price": np.nan_to_num(np.array(prices, dtype=np.float64)),
+            "date": np.array([(d or "").encode("utf-8") for d in dates], dtype=bytes),
+        }
+
+    @staticmethod
+    def _segment_arrays(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Sort rows by date and derive the analytic columns."""
+        order = np.argsort(columns["date"], kind="stable")
+        columns = {column: np.asarray(columns[column])[order] for column in SNAPSHOT_BASE_COLUMNS}
+        is_sale = columns["kind"] == SNAPSHOT_SALE
+        is_order = columns["kind"] == SNAPSHOT_STOCK_ORDER
+        columns["stock_delta"] = np.where(is_order, columns["units"], np.where(is_sale, -columns["units"], 0.0))
+        columns["revenue"] = np.where(is_sale, columns["price"], 0.0)
+        columns["is_sale"] = is_sale.astype(np.int8)
+        columns["cash_total"] = np.cumsum(np.where(is_order, -columns["price"], columns["revenue"]))
+        return columns
+
+    def _write_segment(self, columns: Dict[str, np.ndarray]) -> str:
+        """Save a segment's base and derived columns as .npy files; returns its name."""
+        columns = self._segment_arrays(columns)
+        name = f"{int(columns['rowid'].min()):012d}-{int(columns['rowid'].max()):012d}"
+        temp_dir = os.path.join(self.directory, name + ".tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        for column, values in columns.items():
+            np.save(os.path.join(temp_dir, f"{column}.npy"), values)
+        final_dir = os.path.join(self.directory, name)
+        if os.path.exists(final_dir):
+            shutil.rmtree(final_dir)
+        os.replace(temp_dir, final_dir)
+        return name
+
+    def clear(self) -> None:
+        """Delete every exported segment; the next refresh re-exports the whole ledger."""
+        with self._lock, self._writing():
+            self._clear()
+            if os.path.exists(self._manifest_path()):
+                os.remove(self._manifest_path())
+            self._manifest_version = None
+
+    def _clear(self) -> None:
+        for name in self._segment_names:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        self._reset()
+
+    def _reset(self) -> None:
+        """Forget the loaded state without touching the files."""
+        self.last_rowid, self.last_row, self.revision = 0, None, None
+        self._tail_rows, self._tail = [], None
+        self.items, self._codes, self._catalog_codes = [], {}, None
+        self._segments, self._segment_names = (), []
+
+    def _compact(self) -> None:
+        merged = {
+            column: np.concatenate([segment[column] for segment in self._segments])
+            for column in SNAPSHOT_BASE_COLUMNS
+        }
+        old_names = self._segment_names
+        name = self._write_segment(merged)
+        self._segment_names = [name]
+        self._segments = (self._open_segment(name),)
+        self._write_manifest()
+        for old_name in old_names:
+            if old_name != name:
+                shutil.rmtree(os.path.join(self.directory, old_name), ignore_errors=True)
+
+    # -- refresh -----------------------------------------------------------------
+
+    def refresh(self, engine: Engine) -> int:
+        """
+        Bring the snapshot up to date with the ledger.
+
+        New rows are read into the in-memory tail without taking the file lock.
+        Once the tail holds `export_rows` rows, or the ledger was edited, the export
+        runs under the snapshot's file lock, after picking up anything another
+        process exported in the meantime.
+
+        Args:
+            engine (Engine): The ledger database to read from.
+
+        Returns:
+            int: Number of new rows read.
+        """
+        with self._lock:
+            if self.last_rowid:
+                after = int(self._tail_rows[-1][0]) if self._tail_rows else self.last_rowid
+                stale, rows, _ = self._pending_rows(engine, after)
+                if not stale and len(self._tail_rows) + len(rows) < self.export_rows:
+                    if rows:
+                        self._tail_rows.extend(rows)
+                        self._tail = self._segment_arrays(self._columns(self._tail_rows))
+                    return len(rows)
+            with self._writing():
+                self._tail_rows, self._tail = [], None
+                stale, rows, revision = self._pending_rows(engine, self.last_rowid)
+                if stale:
+                    self._clear()
+                    stale, rows, revision = self._pending_rows(engine, 0)
+                if rows:
+                    self.revision = revision
+                    self._export(rows)
+                return len(rows)
+
+    def _pending_rows(self, engine: Engine, after_rowid: int) -> tuple:
+        """(stale, rows, revision): whether the ledger no longer matches what was
+        exported, the ledger rows after `after_rowid`, and the ledger's revision."""
+        with engine.connect() as conn:
+            cursor = conn.connection.dbapi_connection.cursor()
+            revision = ledger_revision(cursor)
+            stale = False
+            if self.last_rowid:
+                last_row = cursor.execute(
+                    "SELECT item_name, price, transaction_date FROM transactions WHERE rowid = ?",
+                    (self.last_rowid,),
+                ).fetchone()
+                stale = last_row is None or list(last_row) != self.last_row or revision != self.revision
+            rows = [] if stale else cursor.execute(
+                "SELECT rowid, item_name, transaction_type, units, price, transaction_date "
+                "FROM transactions WHERE rowid > ? ORDER BY rowid",
+                (after_rowid,),
+            ).fetchall()
+            cursor.close()
+        return stale, rows, revision
+
+    def _export(self, rows: list) -> None:
+        """Write `rows` as a new segment and record it in the manifest (caller holds the file lock)."""
+        name = self._write_segment(self._columns(rows))
+        self._segment_names.append(name)
+        self._segments = self._segments + (self._open_segment(name),)
+        self.last_rowid = int(rows[-1][0])
+        self.last_row = [rows[-1][1], rows[-1][4], rows[-1][5]]
+        self._write_manifest()
+        if len(self._segments) > self.max_segments:
+            self._compact()
+
+    # -- analytics -----------------------------------------------------------------
+
+    def _prefixes(self, as_of_date: str):
+        """Each segment with the number of its rows dated on or before `as_of_date`, and the item count."""
+        with self._lock:
+            segments, n_items = self._segments + ((self._tail,) if self._tail is not None else ()), len(self.items)
+        cutoff = np.bytes_(as_of_date.encode("utf-8"))
+        return [(segment, int(np.searchsorted(segment["date"], cutoff, side="right"))) for segment in segments], n_items
+
+    def cash_balance(self, as_of_date: str) -> float:
+        """Sales revenue minus stock purchase costs up to `as_of_date` (inclusive)."""
+        prefixes, _ = self._prefixes(as_of_date)
+        return float(sum(segment["cash_total"][end - 1] for segment, end in prefixes if end))
+
+    def totals_by_item(self, as_of_date: str) -> Dict[str, np.ndarray]:
+        """
+        Per-item totals up to `as_of_date` (inclusive), aligned with `self.items`.
+
+        Returns:
+            Dict[str, np.ndarray]: 'stock' (net units), 'units_sold', 'revenue' and 'sales' (count).
+        """
+        prefixes, n_items = self._prefixes(as_of_date)
+        totals = {column: np.zeros(n_items) for column in ("stock", "units_sold", "revenue", "sales")}
+        for segment, end in prefixes:
+            items = segment["item"][:end]
+            totals["stock"] += np.bincount(items, segment["stock_delta"][:end], n_items)
+            totals["revenue"] += np.bincount(items, segment["revenue"][:end], n_items)
+            totals["sales"] += np.bincount(items, segment["is_sale"][:end], n_items)
+            # Sold units are the (negative) stock movements of sales rows
+            totals["units_sold"] -= np.bincount(items, segment["stock_delta"][:end] * segment["is_sale"][:end], n_items)
+        return totals
+
+    def _codes_for_catalog(self, catalog: CompactCatalog):
+        """Catalog names and their item codes, cached until the catalog or item list changes."""
+        cached = self._catalog_codes
+        if cached is None or cached[0] is not catalog or cached[1] != len(self.items):
+            names = catalog.names
+            codes = np.fromiter((self._codes.get(name, -1) for name in names), dtype=np.int64, count=len(names))
+            cached = self._catalog_codes = (catalog, len(self.items), names, codes)
+        return cached[2], cached[3]
+
+    def stock_levels(self, item_names: List[str], as_of_date: str) -> np.ndarray:
+        """Net units in stock per name as of `as_of_date`; 0 for items with no transactions."""
+        codes = np.fromiter((self._codes.get(name, -1) for name in item_names), dtype=np.int64, count=len(item_names))
+        return self._align(self.totals_by_item(as_of_date)["stock"], codes)
+
+    @staticmethod
+    def _align(values: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        aligned = np.zeros(len(codes))
+        known = (codes >= 0) & (codes < len(values))
+        aligned[known] = values[codes[known]]
+        return aligned
+
+    def _top_sellers(self, totals: Dict[str, np.ndarray], limit: int) -> List[tuple]:
+        sold = np.flatnonzero(totals["sales"])
+        ranked = sold[np.argsort(-totals["revenue"][sold], kind="stable")][:limit]
+        return [(self.items[code], float(totals["units_sold"][code]), float(totals["revenue"][code])) for code in ranked]
+
+    def top_sellers(self, as_of_date: str, limit: int = 5) -> List[tuple]:
+        """(item_name, total_units, total_revenue) of the best-selling items by revenue."""
+        return self._top_sellers(self.totals_by_item(as_of_date), limit)
+
+    def financial_report_columns(self, as_of_date: str) -> tuple:
+        """Same tuple as the module-level `financial_report_columns`, computed from the snapshot."""
+        catalog = get_inventory_catalog()
+        item_names, codes = self._codes_for_catalog(catalog)
+        totals = self.totals_by_item(as_of_date)
+        return (
+            as_of_date,
+            self.cash_balance(as_of_date),
+            item_names,
+            self._align(totals["stock"], codes),
+            np.array(catalog.unit_prices, dtype=float),
+            self._top_sellers(totals, 5),
+        )
+
+
+# Analytics use the snapshot unless LEDGER_SNAPSHOT=0; one snapshot per database file
+LEDGER_SNAPSHOT_ENABLED = os.getenv("LEDGER_SNAPSHOT", "1") != "0"
+_ledger_snapshots: Dict[str, LedgerSnapshot] = {}
+_ledger_snapshots_lock = threading.Lock()
+
+
+def get_ledger_snapshot(refresh: bool = True, engine: Optional[Engine] = None) -> Optional[LedgerSnapshot]:
+    """
+    The snapshot of a ledger (the current tenant's by default), brought up to date first.
+
+    Args:
+        refresh (bool): Read new transactions before returning (default True).
+        engine (Optional[Engine]): The ledger database; defaults to `get_engine()`.
+
+    Returns:
+        Optional[LedgerSnapshot]: None when snapshots are disabled or the ledger is
+        not a file-backed SQLite database.
+    """
+    engine = engine or get_engine()
+    database = engine.url.database
+    if not LEDGER_SNAPSHOT_ENABLED or engine.url.get_backend_name() != "sqlite" or database in (None, "", ":memory:"):
+        return None
+    directory = os.path.abspath(database) + ".snapshot"
+    with _ledger_snapshots_lock:
+        snapshot = _ledger_snapshots.get(directory)
+        if snapshot is None:
+            snapshot = _ledger_snapshots[directory] = LedgerSnapshot(directory)
+    if refresh:
+        snapshot.refresh(engine)
+    return snapshot
+
+
+def forget_ledger_snapshot(engine: Engine) -> None:
+    """Drop the in-memory snapshot of `engine`'s ledger; its files stay on disk for reuse."""
+    database = engine.url.database
+    if database in (None, "", ":memory:"):
+        return
+    with _ledger_snapshots_lock:
+        _ledger_snapshots.pop(os.path.abspath(database) + ".snapshot", None)
+
+
+# ======================================================================================
+# Quote archive - `quote_requests.response` and `quotes.quote_explanation` are mostly
+# boilerplate sentences ("Thank you for your order!", discount wording, delivery dates).
+# archive_quote_history() splits both texts into sentence fragments stored once in
+# `quote_fragments`, so each quote keeps only a list of fragment ids. Quotes from the
+# last QUOTE_HOT_DAYS stay one row per quote in `quote_history_hot`, older quotes are
+# packed newest-first into compressed pages of QUOTE_PAGE_SIZE quotes in
+# `quote_history_pages`, and the raw text tables are dropped. A search matches each
+# term against the (small) fragment dictionary, scans the in-memory hot index, and
+# only decompresses cold pages whose fragment set can satisfy every term, newest
+# first, until `limit` quotes are found.
+
+# Archive the quote history at the end of init_database when QUOTE_ARCHIVE=1
+QUOTE_ARCHIVE_ENABLED = os.getenv("QUOTE_ARCHIVE", "0") == "1"
+# Quotes up to this many days older than the newest quote stay in the hot index
+QUOTE_HOT_DAYS = int(os.getenv("QUOTE_HOT_DAYS", "90"))
+# Quotes per compressed cold page
+QUOTE_PAGE_SIZE = 4096
+# Decoded cold pages kept in memory per archive
+QUOTE_PAGE_CACHE_SIZE = 16
+
+QUOTE_ARCHIVE_TABLES = ("quote_fragments", "quote_history_hot", "quote_history_pages")
+_QUOTE_ARCHIVE_SCHEMA = (
+    "CREATE TABLE quote_fragments (id INTEGER PRIMARY KEY, text TEXT NOT NULL)",
+    """CREATE TABLE quote_history_hot (
+        request_id INTEGER PRIMARY KEY, order_date TEXT, total_amount, job_type TEXT,
+        order_size TEXT, event_type TEXT, request_fragments BLOB, explanation_fragments BLOB
+    )""",
+    """CREATE TABLE quote_history_pages (
+        page_id INTEGER PRIMARY KEY, first_date TEXT, last_date TEXT, quotes INTEGER,
+        fragment_set BLOB, payload BLOB
+    )""",
+)
+_QUOTE_META_COLUMNS = ("request_id", "order_date", "total_amount", "job_type", "order_size", "event_type")
+# A sentence with its trailing whitespace; a period inside a number ("$0.05") does not end one
+_FRAGMENT_PATTERN = re.compile(r".+?(?:[.!?]+(?:\s+|$)|$)", re.S)
+
+
+def split_fragments(text: Optional[str]) -> List[str]:
+    """Split `text` into sentence fragments whose concatenation is exactly `text`."""
+    return _FRAGMENT_PATTERN.findall(text) if text else []
+
+
+class _QuoteBlock:
+    """Quotes in newest-first order with their texts as fragment ids.
+
+    Quote i's fragments are `fragments[offsets[i]:offsets[i + 1]]`: request fragments
+    up to `splits[i]`, explanation fragments after it. Metadata columns are NumPy
+    arrays keyed by name.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], fragments: np.ndarray, offsets: np.ndarray, splits: np.ndarray):
+        self.columns = columns
+        self.fragments = fragments
+        self.offsets = offsets
+        self.splits = splits
+        # Owning quote of every fragment slot, for vectorized matching
+        self.owners = np.repeat(np.arange(len(splits), dtype=np.int32), np.diff(offsets))
+
+    @classmethod
+    def from_lists(cls, records, requests, explanations) -> "_QuoteBlock":
+        """Build from metadata tuples (in `_QUOTE_META_COLUMNS` order) and fragment id lists."""
+        fragments = np.fromiter(
+            (fragment for request, explanation in zip(requests, explanations) for fragment in request + explanation),
+            dtype=np.int32, count=sum(map(len, requests)) + sum(map(len, explanations)),
+        )
+        return cls._from_parts(records, list(map(len, requests)), list(map(len, explanations)), fragments)
+
+    @classmethod
+    def from_blobs(cls, records, requests: List[bytes], explanations: List[bytes]) -> "_QuoteBlock":
+        """Build from metadata tuples and int32 fragment id blobs, as stored in `quote_history_hot`."""
+        fragments = np.frombuffer(b"".join(blob for pair in zip(requests, explanations) for blob in pair), dtype=np.int32)
+        return cls._from_parts(
+            records, [len(blob) // 4 for blob in requests], [len(blob) // 4 for blob in explanations], fragments
+        )
+
+    @classmethod
+    def _from_parts(cls, records, request_lengths, explanation_lengths, fragments: np.ndarray) -> "_QuoteBlock":
+        columns = {}
+        for i, name in enumerate(_QUOTE_META_COLUMNS):
+            values = [record[i] for record in records]
+            if name in ("request_id", "total_amount"):
+                columns[name] = np.array([np.nan if value is None else value for value in values])
+            else:
+                columns[name] = np.array(["" if value is None else str(value) for value in values], dtype=str)
+        request_lengths = np.asarray(request_lengths, dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(request_lengths + np.asarray(explanation_lengths, dtype=np.int64))))
+        return cls(columns, fragments, offsets, offsets[:-1] + request_lengths)
+
+    @classmethod
+    def from_payload(cls, payload: bytes) -> "_QuoteBlock":
+        with np.load(io.BytesIO(payload)) as arrays:
+            columns = {name: arrays[name] for name in _QUOTE_META_COLUMNS}
+            return cls(columns, arrays["fragments"], arrays["offsets"], arrays["splits"])
+
+    def to_payload(self) -> bytes:
+        """Compressed page bytes (an .npz archive)."""
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, fragments=self.fragments, offsets=self.offsets, splits=self.splits, **self.columns)
+        return buffer.getvalue()
+
+    def __len__(self) -> int:
+        return len(self.splits)
+
+    def matches(self, masks: List[np.ndarray]) -> np.ndarray:
+        """Quotes with at least one matching fragment for every term mask."""
+        hits = np.ones(len(self), dtype=bool)
+        for mask in masks:
+            term_hits = np.zeros(len(self), dtype=bool)
+            term_hits[self.owners[mask[self.fragments]]] = True
+            hits &= term_hits
+        return hits
+
+    def records(self, rows, texts: List[str]) -> List[Dict]:
+        """Rows rebuilt into the dictionaries returned by search_quote_history."""
+        records = []
+        for row in rows:
+            ids = self.fragments[self.offsets[row]:self.offsets[row + 1]].tolist()
+            split = int(self.splits[row] - self.offsets[row])
+            records.append({
+                "original_request": "".join(texts[i] for i in ids[:split]),
+                "total_amount": self.columns["total_amount"][row].item(),
+                "quote_explanation": "".join(texts[i] for i in ids[split:]),
+                "job_type": str(self.columns["job_type"][row]),
+                "order_size": str(self.columns["order_size"][row]),
+                "event_type": str(self.columns["event_type"][row]),
+                "order_date": str(self.columns["order_date"][row]),
+            })
+        return records
+
+
+class QuoteArchive:
+    """Search side of an archived quote history: the fragment dictionary, the hot index
+    and one fragment set per cold page are held in memory; cold pages are read and
+    decompressed on demand.
+
+    Matching is case-insensitive substring matching within a fragment, like the LIKE
+    query over the raw tables, except that a term spanning two sentences does not match.
+
+    Args:
+        engine: Engine of the archived database.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        with engine.connect() as conn:
+            self.texts = [row[0] for row in conn.exec_driver_sql("SELECT text FROM quote_fragments ORDER BY id")]
+            hot = conn.exec_driver_sql(
+                f"SELECT {', '.join(_QUOTE_META_COLUMNS)}, request_fragments, explanation_fragments "
+                "FROM quote_history_hot ORDER BY order_date DESC, request_id"
+            ).fetchall()
+            pages = conn.exec_driver_sql(
+                "SELECT page_id, quotes, fragment_set FROM quote_history_pages ORDER BY page_id"
+            ).fetchall()
+        self.hot = _QuoteBlock.from_blobs([row[:6] for row in hot], [row[6] for row in hot], [row[7] for row in hot])
+        self.page_ids = [row[0] for row in pages]
+        self.cold_quotes = sum(row[1] for row in pages)
+        self.page_fragments = [
+            np.cumsum(np.frombuffer(zlib.decompress(row[2]), dtype=np.int32)) for row in pages
+        ]
+        lowered = [text.lower() for text in self.texts]
+        self._search_text = "\0".join(lowered)
+        lengths = np.fromiter((len(text) + 1 for text in lowered), dtype=np.int64, count=len(lowered))
+        self._search_offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        self._masks: Dict[str, np.ndarray] = {}
+        self._pages: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.hot) + self.cold_quotes
+
+    def fragment_mask(self, term: str) -> np.ndarray:
+        """Boolean mask of the fragments containing `term` (lowercase)."""
+        mask = self._masks.get(term)
+        if mask is not None:
+            return mask
+        mask = np.zeros(len(self.texts), dtype=bool)
+        if not term:
+            mask[:] = True
+        elif "\0" not in term:
+            position = self._search_text.find(term)
+            while position >= 0:
+                row = int(np.searchsorted(self._search_offsets, position, side="right")) - 1
+                mask[row] = True
+                next_start = self._search_offsets[row + 1] if row + 1 < len(self.texts) else len(self._search_text)
+                position = self._search_text.find(term, int(next_start))
+        if len(self._masks) >= 1024:
+            self._masks.clear()
+        self._masks[term] = mask
+        return mask
+
+    def _page(self, page_id: int) -> _QuoteBlock:
+        with self._lock:
+            block = self._pages.get(page_id)
+            if block is not None:
+                self._pages.move_to_end(page_id)
+                return block
+        with self.engine.connect() as conn:
+            payload = conn.execute(
+                text("SELECT payload FROM quote_history_pages WHERE page_id = :page_id"), {"page_id": page_id}
+            ).scalar()
+        block = _QuoteBlock.from_payload(payload)
+        with self._lock:
+            self._pages[page_id] = block
+            while len(self._pages) > QUOTE_PAGE_CACHE_SIZE:
+                self._pages.popitem(last=False)
+        return block
+
+    def search(self, search_terms: List[str], limit: int) -> List[Dict]:
+        """Newest quotes matching every term, in the shape of search_quote_history."""
+        masks = [self.fragment_mask(term.lower()) for term in search_terms]
+        results = self.hot.records(np.flatnonzero(self.hot.matches(masks))[:limit], self.texts)
+        for page_id, page_fragments in zip(self.page_ids, self.page_fragments):
+            if len(results) >= limit:
+                break
+            if not all(mask[page_fragments].any() for mask in masks):
+                continue
+            block = self._page(page_id)
+            rows = np.flatnonzero(block.matches(masks))[:limit - len(results)]
+            results.extend(block.records(rows, self.texts))
+        return results
+
+    def frame(self) -> pd.DataFrame:
+        """The whole history as a DataFrame with the search_quote_history columns."""
+        records = self.hot.records(range(len(self.hot)), self.texts)
+        for page_id in self.page_ids:
+            block = self._page(page_id)
+            records.extend(block.records(range(len(block)), self.texts))
+        return pd.DataFrame(records, columns=[
+            "original_request", "total_amount", "quote_explanation", "job_type", "order_size", "event_type", "order_date",
+        ])
+
+
+def _table_names(conn) -> set:
+    return {row[0] for row in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def _database_mb(conn) -> float:
+    pages = conn.exec_driver_sql("PRAGMA page_count").scalar()
+    return pages * conn.exec_driver_sql("PRAGMA page_size").scalar() / 1e6
+
+
+def _write_quote_page(conn, page_id: int, quotes: List[tuple]) -> None:
+    block = _QuoteBlock.from_lists(*zip(*quotes))
+    dates = block.columns["order_date"]
+    conn.execute(
+        text("""
+            INSERT INTO quote_history_pages (page_id, first_date, last_date, quotes, fragment_set, payload)
+            VALUES (:page_id, :first_date, :last_date, :quotes, :fragment_set, :payload)
+        """),
+        {
+            "page_id": page_id,
+            "first_date": str(dates[-1]),
+            "last_date": str(dates[0]),
+            "quotes": len(block),
+            # Sorted ids stored as zlib-compressed deltas
+            "fragment_set": zlib.compress(np.diff(np.unique(block.fragments), prepend=0).astype(np.int32).tobytes()),
+            "payload": block.to_payload(),
+        },
+    )
+
+
+def archive_quote_history(
+    engine: Optional[Engine] = None,
+    hot_days: int = QUOTE_HOT_DAYS,
+    page_size: int = QUOTE_PAGE_SIZE,
+) -> Dict:
+    """
+    Move `quotes` and `quote_requests` into the fragment-deduplicated quote archive.
+
+    Quotes are read newest first; quotes dated within `hot_days` of the newest quote
+    go to `quote_history_hot`, the rest into compressed pages of `page_size` quotes.
+    The raw tables are dropped and the database is vacuumed. search_quote_history
+    and the quote templates read the archive from then on; init_database drops it
+    when it reloads the raw tables.
+
+    Args:
+        engine (Engine, optional): Database to archive; defaults to get_engine().
+        hot_days (int): Age in days, relative to the newest quote, of the hot window.
+        page_size (int): Quotes per cold page.
+
+    Returns:
+        Dict: Counts of archived quotes, hot quotes, cold pages and distinct fragments,
+        with the database size in MB before and after. Empty if there is nothing to archive.
+    """
+    engine = engine or get_engine()
+    with engine.connect() as conn:
+        tables = _table_names(conn)
+        if "quote_fragments" in tables or not {"quotes", "quote_requests"} <= tables:
+            logger.info("Quote history is already archived or missing; nothing to do")
+            return {}
+        size_before = _database_mb(conn)
+        newest = conn.exec_driver_sql("SELECT MAX(order_date) FROM quotes").scalar()
+    # ISO dates compare as strings; a bare date sorts before any time on the same day
+    cutoff = (pd.Timestamp(newest) - pd.Timedelta(days=hot_days)).date().isoformat() if newest else ""
+
+    fragment_ids: Dict[str, int] = {}
+
+    def encode(value) -> List[int]:
+        return [fragment_ids.setdefault(fragment, len(fragment_ids)) for fragment in split_fragments(value)]
+
+    stats = {"quotes": 0, "hot_quotes": 0, "cold_pages": 0}
+    with engine.begin() as conn:
+        for statement in _QUOTE_ARCHIVE_SCHEMA:
+            conn.exec_driver_sql(statement)
+        result = conn.exec_driver_sql(f"""
+            SELECT {', '.join('q.' + column for column in _QUOTE_META_COLUMNS)}, qr.response, q.quote_explanation
+            FROM quotes q
+            JOIN quote_requests qr ON q.request_id = qr.id
+            ORDER BY q.order_date DESC, q.request_id
+        """)
+        cold: List[tuple] = []
+        while True:
+            rows = result.fetchmany(50_000)
+            if not rows:
+                break
+            hot = []
+            for row in rows:
+                requests, explanations = encode(row[6]), encode(row[7])
+                if str(row[1] or "") >= cutoff:
+                    hot.append(dict(
+                        zip(_QUOTE_META_COLUMNS, row[:6]),
+                        request_fragments=np.array(requests, dtype=np.int32).tobytes(),
+                        explanation_fragments=np.array(explanations, dtype=np.int32).tobytes(),
+                    ))
+                    continue
+                cold.append((tuple(row[:6]), requests, explanations))
+                if len(cold) == page_size:
+                    _write_quote_page(conn, stats["cold_pages"], cold)
+                    stats["cold_pages"] += 1
+                    cold = []
+            if hot:
+                conn.execute(text(f"""
+                    INSERT INTO quote_history_hot ({', '.join(_QUOTE_META_COLUMNS)}, request_fragments, explanation_fragments)
+                    VALUES ({', '.join(':' + column for column in _QUOTE_META_COLUMNS)}, :request_fragments, :explanation_fragments)
+                """), hot)
+            stats["quotes"] += len(rows)
+            stats["hot_quotes"] += len(hot)
+        if cold:
+            _write_quote_page(conn, stats["cold_pages"], cold)
+            stats["cold_pages"] += 1
+        conn.execute(
+            text("INSERT INTO quote_fragments (id, text) VALUES (:id, :text)"),
+            [{"id": i, "text": fragment} for fragment, i in fragment_ids.items()],
+        )
+        conn.exec_driver_sql("DROP TABLE quotes")
+        conn.exec_driver_sql("DROP TABLE quote_requests")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("VACUUM")
+        size_after = _database_mb(conn)
+    quote_archives.reset()
+    logger.info(
+        "Archived %d quotes (%d hot, %d cold pages, %d fragments): %.1f MB -> %.1f MB",
+        stats["quotes"], stats["hot_quotes"], stats["cold_pages"], len(fragment_ids), size_before, size_after,
+    )
+    return {**stats, "fragments": len(fragment_ids), "db_mb_before": size_before, "db_mb_after": size_after}
+
+
+def drop_quote_archive(engine: Engine) -> None:
+    """Remove the archive tables (init_database reloads the raw history instead)."""
+    with engine.begin() as conn:
+        for table in QUOTE_ARCHIVE_TABLES:
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {table}")
+    quote_archives.reset()
+
+
+def load_quote_archive() -> Optional[QuoteArchive]:
+    """Open the current tenant's quote archive, or None while the history is stored raw."""
+    engine = get_engine()
+    with engine.connect() as conn:
+        archived = "quote_fragments" in _table_names(conn)
+    return QuoteArchive(engine) if archived else None
+
+
+# Opened once per tenant; archive_quote_history and init_database reset it
+quote_archives = TenantLocal(load_quote_archive)
+
+
+def load_quote_history() -> pd.DataFrame:
+    """Every historical quote with the search_quote_history columns, from either storage."""
+    archive = quote_archives.get()
+    if archive is not None:
+        return archive.frame()
+    return pd.read_sql(
+        """
+        SELECT qr.response AS original_request, q.total_amount, q.quote_explanation,
+               q.job_type, q.order_size, q.event_type, q.order_date
+        FROM quotes q
+        JOIN quote_requests qr ON q.request_id = qr.id
+        """,
+        get_engine(),
+    )
+
+
+def search_quote_history(search_terms: List[str], limit: int = 5) -> List[Dict]:
+    """
+    Retrieve a list of historical quotes that match any of the provided search terms.
+
+    The function searches both the original customer request (from `quote_requests`) and
+    the explanation for the quote (from `quotes`) for each keyword. Results are sorted by
+    most recent order date and limited by the `limit` parameter.
+
+    Args:
+        search_terms (List[str]): List of terms to match against customer requests and explanations.
+        limit (int, optional): Maximum number of quote records to return. Default is 5.
+
+    Returns:
+        List[Dict]: A list of matching quotes, each represented as a dictionary with fields:
+            - original_request
+            - total_amount
+            - quote_explanation
+            - job_type
+            - order_size
+            - event_type
+            - order_date
+    """
+    # Concurrent searches for the same terms share one query
+    key = (tuple(sorted({term.lower() for term in search_terms})), limit)
+    rows, _ = single_flight.do("quote_history", key, _query_quote_history, search_terms, limit)
+    return [dict(row) for row in rows]
+
+
+def _query_quote_history(search_terms: List[str], limit: int) -> List[Dict]:
+    archive = quote_archives.get()
+    if archive is not None:
+        return archive.search(search_terms, limit)
+
+    conditions = []
+    params = {}
+
+    # Build SQL WHERE clause using LIKE filters for each search term
+    for i, term in enumerate(search_terms):
+        param_name = f"term_{i}"
+        conditions.append(
+            f"(LOWER(qr.response) LIKE :{param_name} OR "
+            f"LOWER(q.quote_explanation) LIKE :{param_name})"
+        )
+        params[param_name] = f"%{term.lower()}%"
+
+    # Combine conditions; fallback to always-true if no terms provided
+    where_clause = " AND ".join(conditions) if conditions else "1=1"
+
+    # Final SQL query to join quotes with quote_requests
+    query = f"""
+        SELECT
+            qr.response AS original_request,
+            q.total_amount,
+            q.quote_explanation,
+            q.job_type,
+            q.order_size,
+            q.event_type,
+            q.order_date
+        FROM quotes q
+        JOIN quote_requests qr ON q.request_id = qr.id
+        WHERE {where_clause}
+        ORDER BY q.order_date DESC
+        LIMIT {limit}
+    """
+
+    # Execute parameterized query
+    with get_engine().connect() as conn:
+        result = conn.execute(text(query), params)
+        return [dict(row._mapping) for row in result]
+
+########################
+########################
+########################
+# Multi Agent code Implementation
+########################
+########################
+########################
+
+
+# Environment Setup and Model Initialization
+dotenv.load_dotenv("config.env")
+
+
+class StubModel(Model):
+    """Deterministic, offline stand-in for the chat model.
+
+    On the first step of a run it calls the first available tool that only needs
+    an `as_of_date` (e.g. check_all_inventory, check_cash), using the first ISO
+    date in the task; on the next step it returns the observation through
+    `final_answer`. An agent that can call `record_sale` (the sales agent) instead
+    records a sale for each in-stock line of the task's STRUCTURED ORDER, one per
+    step, at the listed unit price. Agents, tools, caches and the database run for
+    real, so end-to-end timings reflect everything except the provider.
+
+    Args:
+        latency: Seconds to sleep per call, to simulate provider latency.
+        token_interval: Seconds between streamed chunks in `generate_stream`.
+    """
+
+    def __init__(self, latency: float = 0.0, model_id: str = "stub", token_interval: float = 0.0):
+        super().__init__(model_id=model_id)
+        self.latency = latency
+        self.token_interval = token_interval
+        self.calls = 0
+
+    @staticmethod
+    def _text(message) -> str:
+        content = message.get("content") if isinstance(message, dict) else message.content
+        if isinstance(content, list):
+            return "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+        return content or ""
+
+    @staticmethod
+    def _role(message) -> str:
+        role = message.get("role") if isinstance(message, dict) else message.role
+        return getattr(role, "value", role)
+
+    # An in-stock line of OrderLine rendering in ParsedOrder.to_prompt
+    _IN_STOCK_LINE = re.compile(
+        r"^  - (\d+) [^\n]*?(?:\(= (\d+) sheets\) )?of '[^\n]*' -> ([^:\n]+): (\d+) in stock, \$([\d.]+)/unit",
+        re.M,
+    )
+
+    def _sales(self, task: str) -> List[Dict]:
+        """record_sale arguments for every in-stock line of the structured order that the stock covers."""
+        request_date = re.search(r"Request date: (\d{4}-\d{2}-\d{2})", task)
+        if request_date is None:
+            return []
+        sales = []
+        for quantity, sheets, item_name, stock, unit_price in self._IN_STOCK_LINE.findall(task):
+            units = int(sheets or quantity)
+            if units <= int(stock):
+                sales.append({
+                    "item_name": item_name, "quantity": units,
+                    "total_price": round(units * float(unit_price), 2), "sale_date": request_date.group(1),
+                })
+        return sales
+
+    def _next_call(self, messages, tools_to_call_from) -> ChatMessageToolCallFunction:
+        observations = [self._text(m) for m in messages if self._role(m) == MessageRole.TOOL_RESPONSE.value]
+        task = "\n".join(self._text(m) for m in messages if self._role(m) == MessageRole.USER.value)
+        if any(candidate.name == "record_sale" for candidate in tools_to_call_from or []):
+            sales = self._sales(task)
+            if len(observations) < len(sales):
+                return ChatMessageToolCallFunction(name="record_sale", arguments=sales[len(observations)])
+            if sales:
+                return ChatMessageToolCallFunction(name="final_answer", arguments={"answer": "\n".join(observations)[:2000]})
+        if observations:
+            return ChatMessageToolCallFunction(name="final_answer", arguments={"answer": observations[-1][:2000]})
+        dates = re.findall(r"\d{4}-\d{2}-\d{2}", task)
+        for candidate in tools_to_call_from or []:
+            if set(candidate.inputs) == {"as_of_date"}:
+                return ChatMessageToolCallFunction(
+                    name=candidate.name, arguments={"as_of_date": dates[0] if dates else "2025-04-01"}
+                )
+        return ChatMessageToolCallFunction(name="final_answer", arguments={"answer": task[:2000]})
+
+    def _respond(self, messages, tools_to_call_from) -> ChatMessage:
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls += 1
+        function = self._next_call(messages, tools_to_call_from)
+        prompt_chars = sum(len(self._text(m)) for m in messages)
+        return ChatMessage(
+            role=MessageRole.ASSISTANT,
+            content=None,
+            tool_calls=[ChatMessageToolCall(function=function, id=f"stub-{self.calls}", type="function")],
+            token_usage=TokenUsage(input_tokens=prompt_chars // 4, output_tokens=len(json.dumps(function.arguments)) // 4),
+        )
+
+    def generate(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+        message = self._respond(messages, tools_to_call_from)
+        if self.token_interval:
+            # A blocking call returns once every chunk has been generated
+            time.sleep(self.token_interval * (message.token_usage.output_tokens - 1))
+        return message
+
+    def generate_stream(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+        """Stream the same tool call as `generate`, its JSON arguments in ~4-character chunks."""
+        message = self._respond(messages, tools_to_call_from)
+        call = message.tool_calls[0]
+        arguments = json.dumps(call.function.arguments)
+        for start in range(0, len(arguments), 4):
+            if self.token_interval and start:
+                time.sleep(self.token_interval)
+            yield ChatMessageStreamDelta(tool_calls=[ChatMessageToolCallStreamDelta(
+                index=0,
+                id=call.id if start == 0 else None,
+                type="function",
+                function=ChatMessageToolCallFunction(
+                    name=call.function.name if start == 0 else "", arguments=arguments[start:start + 4]
+                ),
+            )])
+        yield ChatMessageStreamDelta(token_usage=message.token_usage)
+
+
+# MODEL_PROVIDER=stub (or --stub-model on the command line) runs every agent on the
+# offline StubModel (no API key needed)
+if os.getenv("MODEL_PROVIDER", "openai") == "stub" or (__name__ == "__main__" and "--stub-model" in sys.argv[1:]):
+    model = StubModel(latency=float(os.getenv("STUB_MODEL_LATENCY_MS", "0")) / 1000)
+else:
+    model = OpenAIServerModel(
+        model_id="gpt-4o-mini",
+        api_key=os.getenv("OPENAI_API_KEY"),
+        api_base=os.getenv("OPENAI_BASE_URL"),
+        # Retries are owned by the AdaptiveRateLimiter below
+        retry=False,
+        client_kwargs={"max_retries": 0},
+    )
+
+
+# Model Call Scheduling - every agent's model calls go through one shared limiter.
+# A token bucket caps the request rate at the provider limit, AIMD adapts the number
+# of concurrent calls to observed 429s and latency, rate-limit and transient errors
+# are retried with jittered backoff, and waiting calls are served by agent priority.
+
+# Lower value = served first. Sales commits the order, so it is never starved.
+AGENT_PRIORITIES = {"sales": 0, "orchestrator": 1, "quoting": 2, "inventory": 3, "advisor": 4}
+
+
+def classify_model_error(error: BaseException) -> Optional[str]:
+    """Classify a model call failure.
+
+    Returns:
+        'throttled' for rate-limit errors, 'transient' for timeouts, connection
+        failures and 5xx responses, None for errors that should not be retried.
+    """
+    status = getattr(error, "status_code", None)
+    message = str(error).lower()
+    if status == 429 or isinstance(error, openai.RateLimitError) or "rate limit" in message:
+        return "throttled"
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return "transient"
+    if status is not None and (status >= 500 or status in (408, 409)):
+        return "transient"
+    return None
+
+
+class AdaptiveRateLimiter:
+    """Token-bucket scheduler with AIMD concurrency, priorities and jittered retries.
+
+    Args:
+        requests_per_minute: Provider request limit; the bucket refills at this rate.
+        max_concurrency: Upper bound on calls in flight.
+        target_latency: Seconds; slower calls shrink the concurrency limit.
+        max_retries: Retries per call for throttled or transient errors.
+        base_delay: First backoff delay in seconds (doubles per retry, full jitter).
+        max_delay: Cap on a single backoff delay in seconds.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 500,
+        max_concurrency: int = 8,
+        target_latency: float = 30.0,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.concurrency_limit = float(max_concurrency)
+        self._tokens = self.capacity
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._waiting = []        # heap of (priority, ticket)
+        self._tickets = 0
+        self._condition = threading.Condition()
+        self._rng = np.random.default_rng()
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "failed": 0, "wait_seconds": 0.0}
+        self.agent_calls: Dict[str, int] = {}
+
+    def set_rate(self, requests_per_minute: float) -> None:
+        """Change the request rate, e.g. to give each worker process its share."""
+        with self._condition:
+            self.rate = requests_per_minute / 60.0
+            self.capacity = max(1.0, self.rate)
+            self._tokens = min(self._tokens, self.capacity)
+            self._condition.notify_all()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self, priority: int = 0) -> None:
+        """Block until the call is at the head of the queue, a token is available
+        and the concurrency limit allows another call in flight."""
+        with self._condition:
+            self._tickets += 1
+            entry = (priority, self._tickets)
+            heapq.heappush(self._waiting, entry)
+            started = time.monotonic()
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._waiting[0] == entry and self._in_flight < int(self.concurrency_limit):
+                    wait = max(self._paused_until - now, (1.0 - self._tokens) / self.rate)
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._tokens -= 1.0
+            self._in_flight += 1
+            self.stats["wait_seconds"] += time.monotonic() - started
+            self._condition.notify_all()
+
+    def release(self, latency: float, throttled: bool = False, retry_after: float = 0.0) -> None:
+        """Return a concurrency slot and adapt the limit (AIMD).
+
+        Throttled or slow calls halve the limit; fast successful calls grow it by
+        1/limit, i.e. by about one slot per limit's worth of calls.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+                self._tokens = min(self._tokens, 0.0)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            elif latency > self.target_latency:
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+            else:
+                self.concurrency_limit = min(
+                    float(self.max_concurrency), self.concurrency_limit + 1.0 / self.concurrency_limit
+                )
+            self._condition.notify_all()
+
+    def backoff(self, attempt: int, retry_after: float = 0.0) -> float:
+        """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return max(retry_after, float(self._rng.uniform(0, ceiling)))
+
+    def _retry_delay(self, error: Exception, attempt: int, started: float, agent_name: str) -> Optional[float]:
+        """Release the slot of a failed call; return the backoff before retrying it, or
+        None if the error is not retryable or the retries are used up."""
+        kind = classify_model_error(error)
+        retry_after = _retry_after_seconds(error)
+        self.release(time.monotonic() - started, throttled=kind == "throttled", retry_after=retry_after)
+        with self._condition:
+            if kind == "throttled":
+                self.stats["throttled"] += 1
+            if kind is None or attempt == self.max_retries:
+                self.stats["failed"] += 1
+                return None
+            self.stats["retries"] += 1
+        delay = self.backoff(attempt, retry_after)
+        print_step(agent_name or "orchestrator", f"Model call {kind} ({error.__class__.__name__}), retrying in {delay:.1f}s")
+        return delay
+
+    def _succeeded(self, started: float, agent_name: str) -> None:
+        self.release(time.monotonic() - started)
+        with self._condition:
+            self.stats["calls"] += 1
+            self.agent_calls[agent_name] = self.agent_calls.get(agent_name, 0) + 1
+
+    def call(self, fn, *args, priority: int = 0, agent_name: str = "", **kwargs):
+        """Run `fn(*args, **kwargs)` under the limiter, retrying throttled and transient errors."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(priority)
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, started, agent_name)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._succeeded(started, agent_name)
+            return result
+
+    def call_stream(self, fn, *args, priority: int = 0, agent_name: str = "", **kwargs):
+        """Iterate `fn(*args, **kwargs)` under the limiter, holding one slot until the stream ends.
+
+        Errors raised before the first item are retried like `call`. A stream that
+        fails after yielding is not replayed (the consumer already has part of it);
+        its error is counted and re-raised.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(priority)
+            started = time.monotonic()
+            try:
+                stream = iter(fn(*args, **kwargs))
+                first = next(stream)
+            except StopIteration:
+                self._succeeded(started, agent_name)
+                return
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, started, agent_name)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            failure = None
+            try:
+                yield first
+                yield from stream
+            except Exception as e:
+                failure = e
+                raise
+            finally:
+                if failure is None:
+                    self._succeeded(started, agent_name)
+                else:
+                    throttled = classify_model_error(failure) == "throttled"
+                    self.release(time.monotonic() - started, throttled=throttled, retry_after=_retry_after_seconds(failure))
+                    with self._condition:
+                        self.stats["throttled"] += throttled
+                        self.stats["failed"] += 1
+            return
+
+
+def _retry_after_seconds(error: BaseException) -> float:
+    """Seconds requested by a Retry-After header on the error's response, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ThrottledModel(Model):
+    """A model that routes every call of one agent through the shared rate limiter."""
+
+    def __init__(self, model: Model, limiter: AdaptiveRateLimiter, agent_name: str):
+        super().__init__(
+            flatten_messages_as_text=model.flatten_messages_as_text,
+            tool_name_key=model.tool_name_key,
+            tool_arguments_key=model.tool_arguments_key,
+            model_id=model.model_id,
+        )
+        self.model = model
+        self.limiter = limiter
+        self.agent_name = agent_name
+        self.priority = AGENT_PRIORITIES.get(agent_name, len(AGENT_PRIORITIES))
+
+    def generate(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+        return self.limiter.call(
+            self.model.generate, messages,
+            stop_sequences=stop_sequences,
+            response_format=response_format,
+            tools_to_call_from=tools_to_call_from,
+            priority=self.priority,
+            agent_name=self.agent_name,
+            **kwargs,
+        )
+
+    def generate_stream(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+        yield from self.limiter.call_stream(
+            self.model.generate_stream, messages,
+            stop_sequences=stop_sequences,
+            response_format=response_format,
+            tools_to_call_from=tools_to_call_from,
+            priority=self.priority,
+            agent_name=self.agent_name,
+            **kwargs,
+        )
+
+
+model_rate_limiter = AdaptiveRateLimiter(
+    requests_per_minute=float(os.getenv("MODEL_REQUESTS_PER_MINUTE", "500")),
+    max_concurrency=int(os.getenv("MODEL_MAX_CONCURRENCY", "8")),
+)
+
+
+# Terminal Animation - provides colored, real-time visibility 
+AGENT_COLORS = {
+    "orchestrator": "\033[95m",   # Magenta
+    "inventory":    "\033[94m",   # Blue
+    "quoting":      "\033[93m",   # Yellow
+    "sales":        "\033[92m",   # Green
+    "advisor":      "\033[96m",   # Cyan
+    "reset":        "\033[0m",
+    "bold":         "\033[1m",
+}
+
+# Logging - progress lines, banners and diagnostics are records on the "beavers_choice"
+# logger. The calling thread only enqueues the record; a QueueListener thread formats
+# and writes it, so tools never wait on stdout. Every record carries the correlation id
+# of the request it belongs to. Sinks: the colored terminal view (LOG_FORMAT=console,
+# the default) or one JSON object per line (LOG_FORMAT=json), written to stdout or to
+# LOG_FILE. LOG_LEVEL=WARNING hides progress output; DEBUG adds helper diagnostics.
+
+progress_logger = logging.getLogger("beavers_choice.progress")
+
+correlation_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("correlation_id", default=None)
+
+
+@contextmanager
+def correlation_scope(request_correlation_id: Optional[str] = None):
+    """Tag log records emitted inside the block (and its worker threads) with one id.
+
+    Without an explicit id, batch requests use "<run_id>:<request_id>" so logs line
+    up with the run journal; other requests get a random id.
+    """
+    if request_correlation_id is None:
+        context = current_request.get()
+        request_correlation_id = f"{context.run_id}:{context.request_id}" if context else uuid.uuid4().hex[:12]
+    token = correlation_id.set(request_correlation_id)
+    try:
+        yield request_correlation_id
+    finally:
+        correlation_id.reset(token)
+
+
+class _CorrelationFilter(logging.Filter):
+    """Stamps the current correlation id on records before they leave the calling thread."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class ConsoleLogFormatter(logging.Formatter):
+    """The colored terminal view: agent banners, section headers and step lines."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        kind = getattr(record, "kind", None)
+        agent = getattr(record, "agent", "")
+        message = record.getMessage()
+        color = AGENT_COLORS.get(agent, AGENT_COLORS["reset"])
+        reset = AGENT_COLORS["reset"]
+        bold = AGENT_COLORS["bold"]
+        if kind == "banner":
+            return f"\n{color}{bold}{'─' * 60}\n[{agent.upper()} AGENT] {message}\n{'─' * 60}{reset}"
+        if kind == "header":
+            return f"\n{bold}{'=' * 60}\n{message}\n{'=' * 60}{reset}"
+        if kind == "step":
+            return f"{color}  > {message}{reset}"
+        if kind == "error":
+            return f"\033[91m  {message}{reset}"
+        line = f"{record.levelname} ({record.funcName}): {message}"
+        return f"{line}\n{record.exc_text}" if record.exc_text else line
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "correlation_id": getattr(record, "correlation_id", None),
+            "message": record.getMessage(),
+        }
+        for key in ("agent", "kind"):
+            if hasattr(record, key):
+                payload[key] = getattr(record, key)
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class _EnqueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler for a single consumer: renders the message in place instead of copying the record."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _LogListener(logging.handlers.QueueListener):
+    """QueueListener that acknowledges flush markers once everything before them is written."""
+
+    def handle(self, record) -> None:
+        if isinstance(record, threading.Event):
+            record.set()
+        else:
+            super().handle(record)
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is when the record is emitted, like print()."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value) -> None:
+        pass
+
+
+LOG_FORMATTERS = {"console": ConsoleLogFormatter, "json": JsonLogFormatter}
+
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_listener: Optional[_LogListener] = None
+_log_settings: Dict = {}
+
+
+def configure_logging(
+    level: Optional[str] = None,
+    fmt: Optional[str] = None,
+    path: Optional[str] = None,
+    stream=None,
+) -> logging.handlers.QueueListener:
+    """(Re)configure the logging sinks; arguments default to LOG_LEVEL, LOG_FORMAT and LOG_FILE.
+
+    Args:
+        level (str, optional): Minimum level, e.g. "DEBUG", "INFO" (default) or "WARNING".
+        fmt (str, optional): "console" (colored terminal view, default) or "json".
+        path (str, optional): Append to this file instead of writing to stdout.
+        stream (optional): Write to this stream instead of stdout.
+
+    Returns:
+        logging.handlers.QueueListener: The running listener that writes the records.
+    """
+    global _log_listener
+    flush_logs()
+    if _log_listener is not None:
+        _log_listener.stop()
+    _log_settings.update(level=level, fmt=fmt, path=path, stream=stream)
+
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    fmt = (fmt or os.getenv("LOG_FORMAT", "console")).lower()
+    path = path or os.getenv("LOG_FILE")
+    if fmt not in LOG_FORMATTERS:
+        raise ValueError(f"Unknown log format '{fmt}'; expected one of {sorted(LOG_FORMATTERS)}")
+
+    if path:
+        sink = logging.FileHandler(path, encoding="utf-8")
+    elif stream is not None:
+        sink = logging.StreamHandler(stream)
+    else:
+        sink = _StdoutHandler()
+    sink.setFormatter(LOG_FORMATTERS[fmt]())
+
+    enqueue = _EnqueueHandler(_log_queue)
+    enqueue.addFilter(_CorrelationFilter())
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(enqueue)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    _log_listener = _LogListener(_log_queue, sink)
+    _log_listener.start()
+    return _log_listener
+
+
+def _listener_running() -> bool:
+    return _log_listener is not None and _log_listener._thread is not None and _log_listener._thread.is_alive()
+
+
+def flush_logs() -> None:
+    """Block until every record enqueued so far has been written."""
+    if _listener_running():
+        written = threading.Event()
+        _log_queue.put(written)
+        written.wait()
+
+
+def _stop_logging() -> None:
+    if _listener_running():
+        _log_listener.stop()
+
+
+def _restart_logging_in_child() -> None:
+    """After a fork: the parent's listener thread does not exist in the child, so nothing
+    would drain the inherited queue. Give the child its own queue and listener with the
+    parent's settings, stopped (and so flushed) when the worker process exits."""
+    global _log_queue, _log_listener
+    _log_queue = queue.SimpleQueue()
+    _log_listener = None
+    configure_logging(**_log_settings)
+    # Worker processes end with os._exit, skipping atexit; multiprocessing runs its finalizers
+    multiprocessing.util.Finalize(None, _stop_logging, exitpriority=0)
+
+
+configure_logging()
+atexit.register(_stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_logging_in_child)
+if multiprocessing.parent_process() is not None:
+    # Spawned worker: this import configured logging; flush it when the worker exits
+    multiprocessing.util.Finalize(None, _stop_logging, exitpriority=0)
+
+
+def print_agent_banner(agent_name: str, action: str) -> None:
+    """Display a colored banner indicating the active agent and its current action."""
+    progress_logger.info(action, extra={"agent": agent_name.lower(), "kind": "banner"})
+
+
+def print_step(agent_name: str, message: str) -> None:
     """Print a colored progress message for an agent's internal step."""
-    color = AGENT_COLORS.get(agent_name.lower(), AGENT_COLORS["reset"])
-    reset = AGENT_COLORS["reset"]
-    print(f"{color}  > {message}{reset}")
-    sys.stdout.flush()
+    progress_logger.info(message, extra={"agent": agent_name.lower(), "kind": "step"})
 
 
 def print_section_header(title: str) -> None:
     """Print a prominent section header for major workflow transitions."""
-    bold = AGENT_COLORS["bold"]
-    reset = AGENT_COLORS["reset"]
-    print(f"\n{bold}{'=' * 60}")
-    print(f"{title}")
-    print(f"{'=' * 60}{reset}")
-    sys.stdout.flush()
+    progress_logger.info(title, extra={"kind": "header"})
+    flush_logs()
+
+
+# Tool Result Memoization - read-only tools answer repeated calls with identical
+# arguments from a cache scoped to the request being processed. Any ledger write
+# (record_sale, record_stock_order, auto-reorders) clears every live cache.
+
+class ToolCallCache:
+    """Results of read-only tool calls made while processing one request."""
+
+    _live = set()
+    _live_lock = threading.Lock()
+
+    def __init__(self):
+        self.agent_name = ""
+        self.saved: Dict[str, int] = {}
+        self._results: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, key: str):
+        with self._lock:
+            if key not in self._results:
+                return False, None
+            self.saved[self.agent_name] = self.saved.get(self.agent_name, 0) + 1
+            return True, self._results[key]
+
+    def store(self, key: str, result) -> None:
+        with self._lock:
+            self._results[key] = result
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+
+    @classmethod
+    def invalidate_all(cls, records: List[Dict]) -> None:
+        """Transaction listener: any ledger write may change stock, cash or history."""
+        with cls._live_lock:
+            caches = list(cls._live)
+        for cache in caches:
+            cache.clear()
+
+
+active_tool_cache: contextvars.ContextVar[Optional[ToolCallCache]] = contextvars.ContextVar(
+    "active_tool_cache", default=None
+)
+register_transaction_listener(ToolCallCache.invalidate_all)
+
+# Duplicate tool calls answered from the cache, per agent, across the whole run
+TOOL_CACHE_SAVINGS: Dict[str, int] = {}
+
+
+@contextmanager
+def tool_cache_scope():
+    """Memoize read-only tool calls made inside the block."""
+    cache = ToolCallCache()
+    with ToolCallCache._live_lock:
+        ToolCallCache._live.add(cache)
+    token = active_tool_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        active_tool_cache.reset(token)
+        with ToolCallCache._live_lock:
+            ToolCallCache._live.discard(cache)
+            for agent_name, saved in cache.saved.items():
+                TOOL_CACHE_SAVINGS[agent_name] = TOOL_CACHE_SAVINGS.get(agent_name, 0) + saved
+
+
+def memoize_tool(tool_instance):
+    """Make a read-only tool answer repeated calls from the request's cache.
+
+    Applied after the tool is built rather than as a decorator: smolagents reads
+    the tool's source and rejects decorators other than @tool. Outside a
+    `tool_cache_scope` the tool runs normally.
+    """
+    forward = tool_instance.forward
+
+    def memoized_forward(*args, **kwargs):
+        cache = active_tool_cache.get()
+        if cache is None:
+            return forward(*args, **kwargs)
+        key = json.dumps([tool_instance.name, args, kwargs], sort_keys=True, default=str)
+        hit, result = cache.lookup(key)
+        if hit:
+            print_step(cache.agent_name or "orchestrator", f"{tool_instance.name}: repeated call served from cache")
+            return result
+        result = forward(*args, **kwargs)
+        cache.store(key, result)
+        return result
+
+    tool_instance.forward = memoized_forward
+    return tool_instance
+
+
+# Request coalescing - concurrent identical (or equivalent) read-only work shares one
+# execution: the first caller for a key runs it, callers arriving while it is in
+# flight wait for and receive the same result. Nothing is cached after it completes.
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one execution.
+
+    Keys are scoped by group (e.g. a pipeline stage) and tenant. `stats` reports,
+    per group, how many calls were made and how many were coalesced into another
+    caller's execution.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._inflight: Dict[tuple, "Future"] = {}
+        self._lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.coalesced: Dict[str, int] = {}
+
+    def _join(self, group: str, key) -> tuple:
+        """(future, is_leader) for this call; the leader must settle the future."""
+        from concurrent.futures import Future
+
+        full_key = (group, current_tenant.get(), key)
+        with self._lock:
+            self.calls[group] = self.calls.get(group, 0) + 1
+            future = self._inflight.get(full_key)
+            if future is not None:
+                self.coalesced[group] = self.coalesced.get(group, 0) + 1
+                return future, False
+            future = self._inflight[full_key] = Future()
+            return future, True
+
+    def _settle(self, group: str, key, future, result=None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            self._inflight.pop((group, current_tenant.get(), key), None)
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def do(self, group: str, key, fn, *args, **kwargs) -> tuple:
+        """Run `fn(*args, **kwargs)` unless an identical call is in flight.
+
+        Returns:
+            tuple: (result, shared) where `shared` is True if another caller's result was reused.
+        """
+        if not self.enabled:
+            return fn(*args, **kwargs), False
+        future, leader = self._join(group, key)
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._settle(group, key, future, error=e)
+            raise
+        self._settle(group, key, future, result)
+        return result, False
+
+    async def do_async(self, group: str, key, coroutine_fn, *args, **kwargs) -> tuple:
+        """Like `do`, for a coroutine function; waiting callers do not block the event loop."""
+        if not self.enabled:
+            return await coroutine_fn(*args, **kwargs), False
+        future, leader = self._join(group, key)
+        if not leader:
+            # Shielded: a cancelled waiter must not cancel the shared future
+            return await asyncio.shield(asyncio.wrap_future(future)), True
+        # The run outlives a cancelled leader, so waiting callers still get its result
+        work = asyncio.ensure_future(coroutine_fn(*args, **kwargs))
+
+        def settle(work: asyncio.Future) -> None:
+            if work.cancelled():
+                self._settle(group, key, future, error=asyncio.CancelledError())
+            elif work.exception() is not None:
+                self._settle(group, key, future, error=work.exception())
+            else:
+                self._settle(group, key, future, work.result())
+
+        work.add_done_callback(settle)
+        return await asyncio.shield(work), False
+
+    @property
+    def stats(self) -> Dict[str, Dict]:
+        """Per group: calls, coalesced calls and the coalesced fraction."""
+        with self._lock:
+            return {
+                group: {
+                    "calls": calls,
+                    "coalesced": self.coalesced.get(group, 0),
+                    "coalesced_fraction": self.coalesced.get(group, 0) / calls,
+                }
+                for group, calls in self.calls.items()
+            }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.coalesced.clear()
+
+
+single_flight = SingleFlight()
 
 
 # Tool Definitions - Each tool wraps one or more of the provided helper functions from the starter
@@ -687,14 +3175,10 @@ def check_item_stock(item_name: str, as_of_date: str) -> str:
     print_step("inventory", f"Checking stock for '{item_name}' as of {as_of_date}")
     result_df = get_stock_level(item_name, as_of_date)
     stock = int(result_df["current_stock"].iloc[0])
-    inv_df = pd.read_sql(
-        "SELECT min_stock_level, unit_price FROM inventory WHERE item_name = :name",
-        db_engine,
-        params={"name": item_name},
-    )
-    if not inv_df.empty:
-        min_level = int(inv_df["min_stock_level"].iloc[0])
-        unit_price = float(inv_df["unit_price"].iloc[0])
+    item = get_inventory_catalog().get(item_name)
+    if item is not None:
+        min_level = item.min_stock_level
+        unit_price = item.unit_price
         needs_reorder = stock < min_level
         status = " -- BELOW MINIMUM, REORDER RECOMMENDED" if needs_reorder else " -- Stock OK"
         return (
@@ -722,6 +3206,29 @@ def get_delivery_estimate(order_date: str, quantity: int) -> str:
     return f"Supplier delivery for {quantity} units ordered on {order_date}: expected by {delivery}"
 
 
+@tool
+def get_delivery_estimates(order_date: str, quantities: List[int]) -> str:
+    """Estimate supplier delivery dates for several order quantities in one call.
+    Use this instead of calling get_delivery_estimate once per item.
+    Lead times: 10 or fewer units = same day, 11-100 = +1 day,
+    101-1000 = +4 days, more than 1000 = +7 days.
+
+    Args:
+        order_date: The date the orders would be placed, in YYYY-MM-DD format.
+        quantities: Number of units for each order, e.g. [500, 200, 50].
+
+    Returns:
+        One line per quantity with its expected delivery date.
+    """
+    print_step("inventory", f"Estimating delivery for {len(quantities)} order(s) from {order_date}")
+    if not quantities:
+        return "No quantities given."
+    deliveries = schedule_deliveries(order_date, quantities)
+    lines = [f"Supplier deliveries for orders placed on {order_date}:"]
+    lines += [f"  - {quantity} units: expected by {delivery}" for quantity, delivery in zip(quantities, deliveries.astype(str))]
+    return "\n".join(lines)
+
+
 @tool
 def get_item_unit_price(item_name: str) -> str:
     """Look up the catalog unit price and category for an item.
@@ -733,26 +3240,23 @@ def get_item_unit_price(item_name: str) -> str:
     Returns:
         Pricing information for matching items.
     """
-    inv_df = pd.read_sql(
-        "SELECT * FROM inventory WHERE LOWER(item_name) LIKE :name",
-        db_engine,
-        params={"name": f"%{item_name.lower()}%"},
-    )
-    if not inv_df.empty:
+    inventory = get_inventory_catalog()
+    matches = [inventory.item(row) for row in inventory.search(item_name)]
+    if matches:
         results = []
-        for _, row in inv_df.iterrows():
+        for item in matches:
             results.append(
-                f"  {row['item_name']}: ${row['unit_price']:.2f}/unit "
-                f"({row['category']}) [IN STOCK]"
+                f"  {item.item_name}: ${item.unit_price:.2f}/unit "
+                f"({item.category}) [IN STOCK]"
             )
         return "Matching items in inventory:\n" + "\n".join(results)
-    matches = [s for s in paper_supplies if item_name.lower() in s["item_name"].lower()]
+    matches = [product_catalog.item(row) for row in product_catalog.search(item_name)]
     if matches:
         results = []
         for item in matches:
             results.append(
-                f"  {item['item_name']}: ${item['unit_price']:.2f}/unit "
-                f"({item['category']}) [NOT CURRENTLY STOCKED]"
+                f"  {item.item_name}: ${item.unit_price:.2f}/unit "
+                f"({item.category}) [NOT CURRENTLY STOCKED]"
             )
         return "Catalog matches (not in current inventory):\n" + "\n".join(results)
     return f"No item matching '{item_name}' found in inventory or product catalog."
@@ -792,6 +3296,7 @@ def search_past_quotes(search_terms: str) -> str:
 def record_sale(item_name: str, quantity: int, total_price: float, sale_date: str) -> str:
     """Record a completed sale in the database. Deducts stock and adds revenue.
     Only call this AFTER confirming the item is in stock with sufficient quantity.
+    Stock is reserved atomically: a sale larger than the available stock is rejected.
 
     Args:
         item_name: Exact item name matching the inventory (e.g., 'A4 paper').
@@ -800,10 +3305,27 @@ def record_sale(item_name: str, quantity: int, total_price: float, sale_date: st
         sale_date: Date of sale in YYYY-MM-DD format.
 
     Returns:
-        Confirmation message with the transaction ID.
+        Confirmation message with the transaction ID, or the available stock if rejected.
     """
     print_step("sales", f"Recording sale: {quantity} x {item_name} for ${total_price:.2f}")
-    txn_id = create_transaction(item_name, "sales", quantity, total_price, sale_date)
+    try:
+        txn_id = reserve_and_sell(
+            item_name, quantity, sale_date, total_price,
+            idempotency_key=next_idempotency_key("sale", item_name),
+        )
+    except IdempotencyConflictError as e:
+        note_transactions([e.transaction_id])
+        return (
+            f"Sale NOT recorded: this step already recorded Txn #{e.transaction_id} in an "
+            f"earlier attempt and that sale stands; the new values were not recorded ({e})."
+        )
+    note_transactions([txn_id])
+    if txn_id is None:
+        available = int(get_stock_level(item_name, sale_date)["current_stock"].iloc[0])
+        return (
+            f"Sale REJECTED: only {available} units of '{item_name}' available as of "
+            f"{sale_date}. Retry with a quantity of at most {available}."
+        )
     return (
         f"Sale recorded (Txn #{txn_id}): "
         f"{quantity} units of '{item_name}' sold for ${total_price:.2f}"
@@ -827,7 +3349,18 @@ def record_stock_order(
         Confirmation message with the transaction ID.
     """
     print_step("sales", f"Recording restock: {quantity} x {item_name} for ${total_cost:.2f}")
-    txn_id = create_transaction(item_name, "stock_orders", quantity, total_cost, order_date)
+    try:
+        txn_id = create_transaction(
+            item_name, "stock_orders", quantity, total_cost, order_date,
+            idempotency_key=next_idempotency_key("stock_order", item_name),
+        )
+    except IdempotencyConflictError as e:
+        note_transactions([e.transaction_id])
+        return (
+            f"Stock order NOT recorded: this step already recorded Txn #{e.transaction_id} in an "
+            f"earlier attempt and that order stands; the new values were not recorded ({e})."
+        )
+    note_transactions([txn_id])
     return (
         f"Stock order recorded (Txn #{txn_id}): "
         f"{quantity} units of '{item_name}' purchased for ${total_cost:.2f}"
@@ -861,7 +3394,7 @@ def get_financial_summary(as_of_date: str) -> str:
         Comprehensive financial report as a formatted string.
     """
     print_step("advisor", f"Generating financial report for {as_of_date}")
-    report = generate_financial_report(as_of_date)
+    report = reporting_backend.financial_report(as_of_date)
     lines = [
         f"Financial Report ({report['as_of_date']})",
         f"  Cash Balance:     ${report['cash_balance']:>12,.2f}",
@@ -909,6 +3442,1035 @@ def get_financial_summary(as_of_date: str) -> str:
     return "\n".join(lines)
 
 
+# Read-only tools answer repeated calls within a request from its cache
+for _read_only_tool in (
+    check_all_inventory, check_item_stock, get_delivery_estimate, get_delivery_estimates,
+    get_item_unit_price, search_past_quotes, check_cash, get_financial_summary,
+):
+    memoize_tool(_read_only_tool)
+
+# ===================================================================================
+# Automated Reorder Planner
+# Scans every catalog item in one query, projects demand over the supplier lead
+# time from recent sales velocity, and places one consolidated batch of stock
+# orders instead of relying on the sales agent to call record_stock_order.
+# ===================================================================================
+
+REORDER_LOOKBACK_DAYS = 30   # Sales history window used to estimate daily velocity
+REORDER_COVER_DAYS = 14      # Days of demand a reorder should cover after it arrives
+
+
+def plan_stock_reorders(
+    as_of_date: str,
+    lookback_days: int = REORDER_LOOKBACK_DAYS,
+    cover_days: int = REORDER_COVER_DAYS,
+    max_spend: Optional[float] = None,
+) -> pd.DataFrame:
+    """Plan stock orders for every catalog item projected to run short before delivery.
+
+    Each item's reorder point is its minimum stock level plus the demand expected
+    during the supplier lead time; items whose stock plus orders still on their way
+    (dated after `as_of_date`) is below it are ordered up to the reorder point plus
+    `cover_days` of demand. Because the lead time itself depends on the
+    order quantity, every lead-time tier is evaluated at once and the first tier
+    whose quantity bound fits the computed quantity is chosen.
+
+    Args:
+        as_of_date: Date in YYYY-MM-DD format the orders would be placed on.
+        lookback_days: Number of days of sales history used to estimate velocity.
+        cover_days: Days of demand each order should cover once delivered.
+        max_spend: Optional budget. When set, the most urgent orders (fewest days
+            of stock left) are kept until the budget is exhausted.
+
+    Returns:
+        A DataFrame with one row per planned order: item_name, current_stock,
+        on_order, min_stock_level, daily_velocity, reorder_point, quantity,
+        lead_days, delivery_date, unit_price and total_cost.
+    """
+    as_of_day = np.datetime64(str(as_of_date)[:10], "D")
+    window_start = str(as_of_day - np.timedelta64(lookback_days, "D"))
+
+    # One pass over the ledger for stock and recent sales of every catalog item
+    ledger_query = """
+        WITH ledger AS (
+            SELECT
+                item_name,
+                SUM(CASE
+                    WHEN transaction_date > :as_of_date THEN 0
+                    WHEN transaction_type = 'stock_orders' THEN units
+                    WHEN transaction_type = 'sales' THEN -units
+                    ELSE 0
+                END) AS current_stock,
+                SUM(CASE
+                    WHEN transaction_type = 'stock_orders' AND transaction_date > :as_of_date THEN units
+                    ELSE 0
+                END) AS on_order,
+                SUM(CASE
+                    WHEN transaction_type = 'sales' AND transaction_date > :window_start
+                        AND transaction_date <= :as_of_date THEN units
+                    ELSE 0
+                END) AS recent_sales
+            FROM transactions
+            WHERE item_name IS NOT NULL
+            GROUP BY item_name
+        )
+        SELECT
+            i.item_name,
+            i.unit_price,
+            i.min_stock_level,
+            COALESCE(l.current_stock, 0) AS current_stock,
+            COALESCE(l.on_order, 0) AS on_order,
+            COALESCE(l.recent_sales, 0) AS recent_sales
+        FROM inventory i
+        LEFT JOIN ledger l ON l.item_name = i.item_name
+    """
+    # Read through the DB-API connection: SQLAlchemy row objects dominate at 100k+ rows
+    with get_engine().connect() as conn:
+        items = pd.read_sql(
+            ledger_query,
+            conn.connection.dbapi_connection,
+            params={"as_of_date": as_of_date, "window_start": window_start},
+        )
+
+    stock = items["current_stock"].to_numpy(dtype=float)
+    on_order = items["on_order"].to_numpy(dtype=float)
+    position = stock + on_order
+    min_level = items["min_stock_level"].to_numpy(dtype=float)
+    velocity = items["recent_sales"].to_numpy(dtype=float) / lookback_days
+
+    # Evaluate every lead-time tier at once: shape (n_items, n_tiers)
+    tier_days = SUPPLIER_LEAD_TIME_DAYS[np.newaxis, :]
+    tier_bounds = np.append(SUPPLIER_LEAD_TIME_BOUNDS, np.inf)[np.newaxis, :]
+    reorder_points = min_level[:, np.newaxis] + velocity[:, np.newaxis] * tier_days
+    order_up_to = reorder_points + velocity[:, np.newaxis] * cover_days
+    quantities = np.ceil(order_up_to - position[:, np.newaxis])
+
+    # The last tier has no upper bound, so every row has a consistent tier
+    tier = np.argmax(quantities <= tier_bounds, axis=1)
+    rows = np.arange(len(items))
+    quantity = quantities[rows, tier]
+    reorder_point = reorder_points[rows, tier]
+    needs_order = (position < reorder_point) & (quantity > 0)
+
+    plan = pd.DataFrame({
+        "item_name": items["item_name"],
+        "current_stock": stock.astype(int),
+        "on_order": on_order.astype(int),
+        "min_stock_level": min_level.astype(int),
+        "daily_velocity": velocity,
+        "reorder_point": reorder_point,
+        "quantity": quantity,
+        "lead_days": SUPPLIER_LEAD_TIME_DAYS[tier],
+        "unit_price": items["unit_price"],
+    })[needs_order]
+    plan["quantity"] = plan["quantity"].astype(int)
+    plan["delivery_date"] = np.datetime_as_string(
+        as_of_day + plan["lead_days"].to_numpy().astype("timedelta64[D]"), unit="D"
+    )
+    plan["total_cost"] = plan["quantity"] * plan["unit_price"]
+
+    if max_spend is not None and not plan.empty:
+        # Most urgent first: fewest days until stock reaches the minimum level
+        with np.errstate(divide="ignore", invalid="ignore"):
+            days_left = (plan["current_stock"] - plan["min_stock_level"]) / plan["daily_velocity"]
+        days_left = days_left.where(plan["daily_velocity"] > 0, 0.0)
+        plan = plan.assign(_days_left=days_left).sort_values("_days_left", kind="stable")
+        plan = plan[plan["total_cost"].cumsum() <= max_spend].drop(columns="_days_left")
+
+    return plan.reset_index(drop=True)
+
+
+def place_stock_orders(plan: pd.DataFrame) -> List[int]:
+    """Record every order in a reorder plan as one bulk batch of stock order transactions.
+
+    Each order is dated at its delivery date, so its stock counts as available only
+    once it has arrived. Inside a request scope each order gets an idempotency key,
+    so replaying the request after a crash does not reorder the same items twice.
+
+    Args:
+        plan: A reorder plan as returned by `plan_stock_reorders`.
+
+    Returns:
+        The transaction IDs of the recorded stock orders.
+    """
+    if plan.empty:
+        return []
+    orders = pd.DataFrame({
+        "item_name": plan["item_name"],
+        "transaction_type": "stock_orders",
+        "units": plan["quantity"],
+        "price": plan["total_cost"],
+        "transaction_date": plan["delivery_date"],
+        "idempotency_key": [next_idempotency_key("reorder", item) for item in plan["item_name"]],
+    })
+    transaction_ids = create_transactions_bulk(orders)
+    note_transactions(transaction_ids)
+    return transaction_ids
+
+
+# ===================================================================================
+# Demand Forecasting
+# Per-item simple moving average (SMA) and simple exponential smoothing (SES)
+# over daily sales. Both models are fitted for every item at once with weighted
+# bincounts over the sales history (no items x days matrix is materialized) and
+# are then kept current by observing each sale recorded through create_transaction.
+# ===================================================================================
+
+class DemandForecaster:
+    """Vectorized per-item demand models updated incrementally from new sales.
+
+    State per item: the SES level as of `last_day`, and a ring buffer holding
+    the last `window_days` days of sales for the moving average. Days are
+    integer day numbers (days since 1970-01-01).
+    """
+
+    def __init__(self, window_days: int = 28, alpha: float = 0.3):
+        self.window_days = window_days
+        self.alpha = alpha
+        self.item_index: Dict[str, int] = {}
+        self.item_names: List[str] = []
+        self.level = np.zeros(0)
+        self.window = np.zeros((0, window_days))
+        self.last_day: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def to_day(date: Union[str, datetime]) -> int:
+        """Convert an ISO date or datetime to an integer day number."""
+        return int(np.datetime64(str(date)[:10], "D").astype(np.int64))
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.last_day is not None
+
+    def fit(self, as_of_date: Optional[str] = None) -> "DemandForecaster":
+        """Fit both models for every item from the sales recorded in the database.
+
+        Args:
+            as_of_date: Optional cutoff date (inclusive). Defaults to the latest
+                transaction in the ledger, so an empty sales history is anchored to
+                the ledger's own dates rather than the wall clock.
+
+        Returns:
+            The fitted forecaster.
+        """
+        query = """
+            SELECT item_name, units, transaction_date
+            FROM transactions
+            WHERE transaction_type = 'sales'
+            AND item_name IS NOT NULL
+        """
+        params = {}
+        if as_of_date is not None:
+            # Stored dates may carry a time; compare the date part so same-day sales count
+            query += " AND substr(transaction_date, 1, 10) <= :as_of_date"
+            params["as_of_date"] = str(as_of_date)[:10]
+        sales = pd.read_sql(query, get_engine(), params=params)
+        catalog = get_inventory_catalog().names
+
+        item_names = pd.Index(catalog).append(pd.Index(sales["item_name"])).unique()
+        codes = item_names.get_indexer(sales["item_name"])
+        days = (
+            pd.to_datetime(sales["transaction_date"].str.slice(0, 10))
+            .to_numpy()
+            .astype("datetime64[D]")
+            .astype(np.int64)
+        )
+        if as_of_date is not None:
+            as_of_day = self.to_day(as_of_date)
+        elif len(days):
+            as_of_day = int(days.max())
+        else:
+            with get_engine().connect() as conn:
+                latest = conn.execute(text("SELECT MAX(transaction_date) FROM transactions")).scalar()
+            as_of_day = self.to_day(latest if latest else datetime.now())
+
+        return self.fit_arrays(
+            list(item_names), codes, days, sales["units"].to_numpy(dtype=float), as_of_day
+        )
+
+    def fit_arrays(
+        self,
+        item_names: List[str],
+        codes: np.ndarray,
+        days: np.ndarray,
+        units: np.ndarray,
+        as_of_day: int,
+    ) -> "DemandForecaster":
+        """Fit both models from parallel arrays of sales (item code, day number, units).
+
+        The SES level at day T is the closed form sum of alpha * (1 - alpha)^(T - t) * x_t,
+        so it is a single weighted bincount over all sales of all items.
+        """
+        n_items = len(item_names)
+        keep = days <= as_of_day
+        codes, days, units = codes[keep], days[keep], units[keep]
+        age = as_of_day - days
+
+        weights = units * self.alpha * np.power(1.0 - self.alpha, age)
+        # bincount of empty input is int64 even with weights; keep the state float
+        level = np.bincount(codes, weights=weights, minlength=n_items).astype(float)
+
+        recent = age < self.window_days
+        slots = codes[recent] * self.window_days + days[recent] % self.window_days
+        window = np.bincount(
+            slots, weights=units[recent], minlength=n_items * self.window_days
+        ).reshape(n_items, self.window_days).astype(float)
+
+        with self._lock:
+            self.item_names = list(item_names)
+            self.item_index = {name: i for i, name in enumerate(self.item_names)}
+            self.level = level
+            self.window = window
+            self.last_day = int(as_of_day)
+        return self
+
+    def _advance_to(self, day: int) -> None:
+        """Roll every item's state forward to `day` (caller holds the lock)."""
+        gap = day - self.last_day
+        if gap <= 0:
+            return
+        self.level *= (1.0 - self.alpha) ** gap
+        if gap >= self.window_days:
+            self.window[:] = 0.0
+        else:
+            for d in range(self.last_day + 1, day + 1):
+                self.window[:, d % self.window_days] = 0.0
+        self.last_day = day
+
+    def _code_for(self, item_name: str) -> int:
+        """Return the row for `item_name`, growing the state for new items (caller holds the lock)."""
+        code = self.item_index.get(item_name)
+        if code is None:
+            code = len(self.item_names)
+            self.item_names.append(item_name)
+            self.item_index[item_name] = code
+            self.level = np.append(self.level, 0.0)
+            self.window = np.vstack([self.window, np.zeros((1, self.window_days))])
+        return code
+
+    def observe(self, item_name: str, units: float, date: Union[str, datetime]) -> None:
+        """Fold one sale into the models without refitting."""
+        day = self.to_day(date)
+        with self._lock:
+            if not self.is_fitted:
+                return
+            self._advance_to(day)
+            code = self._code_for(item_name)
+            age = self.last_day - day
+            self.level[code] += units * self.alpha * (1.0 - self.alpha) ** age
+            if age < self.window_days:
+                self.window[code, day % self.window_days] += units
+
+    def observe_transactions(self, records: List[Dict]) -> None:
+        """Transaction listener: observe every newly recorded sale of a named item."""
+        for record in records:
+            if record["transaction_type"] == "sales" and record["item_name"] and record["units"]:
+                self.observe(record["item_name"], float(record["units"]), record["transaction_date"])
+
+    def daily_rates(self, as_of_date: Optional[str] = None) -> pd.DataFrame:
+        """Return the SMA and SES daily demand rate of every item as of a date.
+
+        Args:
+            as_of_date: Optional date. For a date before the latest observed day,
+                the rates are refit from the ledger's sales up to that date, so
+                later sales never leak into the forecast.
+
+        Returns:
+            A DataFrame indexed by item name with columns 'sma' and 'ses'.
+        """
+        if as_of_date is not None and self.is_fitted and self.to_day(as_of_date) < self.last_day:
+            return DemandForecaster(self.window_days, self.alpha).fit(as_of_date).daily_rates(as_of_date)
+        with self._lock:
+            level = self.level.copy()
+            window = self.window.copy()
+            last_day = self.last_day
+            names = list(self.item_names)
+
+        gap = 0 if as_of_date is None else max(0, self.to_day(as_of_date) - last_day)
+        ses = level * (1.0 - self.alpha) ** gap
+        if gap >= self.window_days:
+            sma = np.zeros(len(names))
+        else:
+            stale = [(last_day - k) % self.window_days for k in range(self.window_days - gap, self.window_days)]
+            window[:, stale] = 0.0
+            sma = window.sum(axis=1) / self.window_days
+        return pd.DataFrame({"sma": sma, "ses": ses}, index=pd.Index(names, name="item_name"))
+
+
+demand_forecaster = DemandForecaster()
+demand_forecasters = TenantLocal(DemandForecaster, default=demand_forecaster)
+register_transaction_listener(lambda records: demand_forecasters.get().observe_transactions(records))
+
+
+# Tools for inventory and advisor agents
+@tool
+def forecast_demand(item_name: str, horizon_days: int, as_of_date: str) -> str:
+    """Forecast customer demand for an item over the coming days from its sales history.
+    Uses both a moving average and exponential smoothing of daily sales.
+    Pass 'all' as the item name to list the items with the highest forecast demand.
+
+    Args:
+        item_name: Exact item name (e.g., 'A4 paper'), or 'all' for the top items.
+        horizon_days: Number of days ahead to forecast.
+        as_of_date: Date in YYYY-MM-DD format the forecast starts from.
+
+    Returns:
+        Forecast units over the horizon for the item(s).
+    """
+    print_step("inventory", f"Forecasting demand for '{item_name}' over {horizon_days} days")
+    forecaster = demand_forecasters.get()
+    if not forecaster.is_fitted:
+        forecaster.fit(as_of_date)
+    rates = forecaster.daily_rates(as_of_date) * horizon_days
+
+    if item_name.strip().lower() == "all":
+        top = rates.sort_values("ses", ascending=False).head(10)
+        top = top[(top[["ses", "sma"]] >= 0.5).any(axis=1)]
+        if top.empty:
+            return "No recent sales to forecast from."
+        lines = [f"Top forecast demand over the next {horizon_days} days from {as_of_date}:"]
+        for name, row in top.iterrows():
+            lines.append(
+                f"  - {name}: ~{row['ses']:.0f} units (smoothed), ~{row['sma']:.0f} units (moving avg)"
+            )
+        return "\n".join(lines)
+
+    if item_name not in rates.index:
+        return f"No sales history for '{item_name}'; expected demand is 0 units."
+    row = rates.loc[item_name]
+    return (
+        f"{item_name}: expected demand over the next {horizon_days} days from {as_of_date} is "
+        f"~{row['ses']:.0f} units (exponential smoothing) / ~{row['sma']:.0f} units "
+        f"({forecaster.window_days}-day moving average)"
+    )
+
+
+memoize_tool(forecast_demand)
+
+# ===================================================================================
+# Stock Reservations
+# record_sale used to insert a sale without re-checking stock, so two requests
+# for the same item could both pass their stock check and oversell. Sales now go
+# through reserve_and_sell: an in-memory per-item counter rejects obvious
+# oversells without touching the database, and the insert itself is conditional
+# on the ledger stock inside an IMMEDIATE (write-locked) SQLite transaction. Both
+# check the stock at the sale date and at every later date.
+# ===================================================================================
+
+class StockCounter:
+    """Thread-safe in-memory stock per item, loaded lazily from the ledger.
+
+    Each item keeps its net stock movement per transaction date, so a sale can be
+    checked the way the ledger checks it: the stock at the sale date and at every
+    later date must cover it. Counts are kept in step with every transaction
+    recorded through this module via the transaction listener hook. Sales
+    committed by `reserve_and_sell` were already deducted when reserved, so their
+    notifications are skipped.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._movements: Dict[str, Dict[str, int]] = {}
+        self._reserved_txn_ids = set()
+        self.stats = {"attempts": 0, "committed": 0, "fast_rejects": 0, "ledger_rejects": 0}
+
+    def reset(self) -> None:
+        """Forget every loaded count (after the ledger is rebuilt)."""
+        with self._lock:
+            self._movements.clear()
+            self._reserved_txn_ids.clear()
+
+    def _load(self, item_name: str) -> Dict[str, int]:
+        if item_name not in self._movements:
+            with get_engine().connect() as conn:
+                rows = conn.execute(text("""
+                    SELECT transaction_date, SUM(CASE
+                        WHEN transaction_type = 'stock_orders' THEN units
+                        WHEN transaction_type = 'sales' THEN -units
+                        ELSE 0
+                    END)
+                    FROM transactions
+                    WHERE item_name = :item_name
+                    GROUP BY transaction_date
+                """), {"item_name": item_name}).fetchall()
+            self._movements[item_name] = {day: int(delta or 0) for day, delta in rows}
+        return self._movements[item_name]
+
+    def available(self, item_name: str, date: Optional[str] = None) -> int:
+        """Stock of `item_name` that can be sold on `date` without any later date going
+        negative, net of reservations not yet committed (latest stock if no date)."""
+        with self._lock:
+            movements = self._load(item_name)
+            balance, lowest = 0, None
+            for day in sorted(movements):
+                if date is not None and day > date and lowest is None:
+                    lowest = balance
+                balance += movements[day]
+                if lowest is not None:
+                    lowest = min(lowest, balance)
+            return balance if lowest is None else lowest
+
+    def reserve(self, item_name: str, quantity: int, date: str) -> bool:
+        """Deduct `quantity` on `date` if that much stock is available; return whether it was."""
+        with self._lock:
+            self.stats["attempts"] += 1
+            if self.available(item_name, date) < quantity:
+                self.stats["fast_rejects"] += 1
+                return False
+            movements = self._movements[item_name]
+            movements[date] = movements.get(date, 0) - quantity
+            return True
+
+    def release(self, item_name: str, quantity: int, date: str, reload: bool = False) -> None:
+        """Return a reservation that was not committed (optionally reloading the item)."""
+        with self._lock:
+            if reload:
+                self._movements.pop(item_name, None)
+            elif item_name in self._movements:
+                movements = self._movements[item_name]
+                movements[date] = movements.get(date, 0) + quantity
+
+    def reject(self, item_name: str, quantity: int, date: str) -> None:
+        """Drop a reservation the ledger refused and reload the item on next use."""
+        with self._lock:
+            self.stats["ledger_rejects"] += 1
+            self.release(item_name, quantity, date, reload=True)
+
+    def confirm(self, item_name: str, transaction_id: int) -> None:
+        """Mark a reserved sale as committed so its listener notification is not re-applied."""
+        with self._lock:
+            self.stats["committed"] += 1
+            self._reserved_txn_ids.add(transaction_id)
+
+    def apply_transactions(self, records: List[Dict]) -> None:
+        """Transaction listener: apply stock orders and sales recorded outside reservations."""
+        with self._lock:
+            for record in records:
+                if record["id"] in self._reserved_txn_ids:
+                    self._reserved_txn_ids.discard(record["id"])
+                    continue
+                item_name = record["item_name"]
+                if item_name not in self._movements or not record["units"]:
+                    continue
+                sign = {"stock_orders": 1, "sales": -1}.get(record["transaction_type"], 0)
+                movements = self._movements[item_name]
+                day = record["transaction_date"]
+                movements[day] = movements.get(day, 0) + sign * int(record["units"])
+
+
+stock_counter = StockCounter()
+stock_counters = TenantLocal(StockCounter, default=stock_counter)
+register_transaction_listener(lambda records: stock_counters.get().apply_transactions(records))
+
+
+def reserve_and_sell(
+    item_name: str,
+    quantity: int,
+    date: Union[str, datetime],
+    total_price: Optional[float] = None,
+    idempotency_key: Optional[str] = None,
+) -> Optional[int]:
+    """Atomically record a sale only if enough stock is available.
+
+    The sale is first reserved against the in-memory counter, then inserted with
+    a conditional INSERT inside a `BEGIN IMMEDIATE` transaction, so the stock
+    check and the write cannot interleave with another writer.
+
+    Args:
+        item_name: Exact item name.
+        quantity: Number of units to sell (must be positive).
+        date: Date of the sale in ISO format.
+        total_price: Total sale price. Defaults to quantity x the catalog unit price.
+        idempotency_key: Optional unique key. If a sale with this key was already
+            recorded, its ID is returned and nothing is inserted.
+
+    Returns:
+        The transaction ID, or None if the stock on `date` or on any later date
+        would not cover the sale.
+
+    Raises:
+        ValueError: If `quantity` is not positive.
+        IdempotencyConflictError: If the key was recorded with different values.
+    """
+    if quantity <= 0:
+        raise ValueError("Quantity must be positive")
+    date_str = date.isoformat() if isinstance(date, datetime) else date
+    if total_price is None:
+        total_price = quantity * get_inventory_catalog().price(item_name, 0.0)
+    sale = {
+        "item_name": item_name,
+        "transaction_type": "sales",
+        "units": int(quantity),
+        "price": float(total_price),
+        "transaction_date": date_str,
+    }
+    if idempotency_key is not None:
+        existing_id = find_transaction_by_key(idempotency_key, sale)
+        if existing_id is not None:
+            return existing_id
+
+    counter = stock_counters.get()
+    if not counter.reserve(item_name, quantity, date_str):
+        return None
+
+    # The lowest running balance from the sale date on: a back-dated sale must not
+    # take stock that later sales already used
+    conditional_insert = """
+        INSERT INTO transactions
+            (item_name, transaction_type, units, price, transaction_date, idempotency_key)
+        SELECT :item_name, 'sales', :units, :price, :transaction_date, :idempotency_key
+        WHERE (
+            WITH daily AS (
+                SELECT transaction_date AS day, SUM(CASE
+                    WHEN transaction_type = 'stock_orders' THEN units
+                    WHEN transaction_type = 'sales' THEN -units
+                    ELSE 0
+                END) AS delta
+                FROM transactions
+                WHERE item_name = :item_name
+                GROUP BY transaction_date
+                UNION ALL
+                SELECT :transaction_date, 0
+            ),
+            balances AS (
+                SELECT day, SUM(delta) OVER (ORDER BY day) AS balance FROM daily
+            )
+            SELECT MIN(balance) FROM balances WHERE day >= :transaction_date
+        ) >= :units
+    """
+    params = {
+        "item_name": item_name,
+        "units": int(quantity),
+        "price": float(total_price),
+        "transaction_date": date_str,
+        "idempotency_key": idempotency_key,
+    }
+
+    try:
+        # AUTOCOMMIT stops the driver from issuing its own deferred BEGIN
+        with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                inserted = conn.execute(text(conditional_insert), params).rowcount
+                transaction_id = conn.execute(text("SELECT last_insert_rowid()")).scalar_one()
+                conn.exec_driver_sql("COMMIT")
+            except Exception:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+    except IntegrityError:
+        # A concurrent writer recorded the same idempotency key first
+        counter.release(item_name, quantity, date_str, reload=True)
+        return find_transaction_by_key(idempotency_key, sale)
+    except Exception as e:
+        counter.release(item_name, quantity, date_str, reload=True)
+        print(f"Error reserving stock: {e}")
+        raise
+
+    if not inserted:
+        # The ledger disagreed with the counter (e.g. a back-dated sale): resync the item
+        counter.reject(item_name, quantity, date_str)
+        return None
+
+    counter.confirm(item_name, transaction_id)
+    notify_transaction_listeners([{
+        "id": transaction_id,
+        "item_name": item_name,
+        "transaction_type": "sales",
+        "units": params["units"],
+        "price": params["price"],
+        "transaction_date": date_str,
+        "idempotency_key": idempotency_key,
+    }])
+    return transaction_id
+
+
+# ===================================================================================
+# Run Journal & Idempotency
+# A batch run records every request it starts and completes in the run journal,
+# together with the transactions the request created. Ledger writes made while a
+# request is processed carry an idempotency key derived from (run, request, action,
+# item, occurrence), so replaying an interrupted request returns the transactions
+# already recorded instead of inserting them again. A crash costs one request.
+# ===================================================================================
+
+@dataclass
+class RequestContext:
+    """The request currently being processed within a batch run (or by the server)."""
+    run_id: str
+    request_id: Union[int, str]
+    transaction_ids: List[int] = field(default_factory=list)
+    _occurrences: Dict[str, int] = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def idempotency_key(self, action: str, item_name: str) -> str:
+        """Key for the next `action` on `item_name`; the nth call always gets the nth key."""
+        slot = f"{action}:{item_name}"
+        with self._lock:
+            occurrence = self._occurrences.get(slot, 0)
+            self._occurrences[slot] = occurrence + 1
+        return f"{self.run_id}:{self.request_id}:{slot}:{occurrence}"
+
+    def record(self, transaction_ids: List[int]) -> None:
+        with self._lock:
+            for txn_id in transaction_ids:
+                if txn_id not in self.transaction_ids:
+                    self.transaction_ids.append(txn_id)
+
+
+current_request: contextvars.ContextVar[Optional[RequestContext]] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+@contextmanager
+def request_scope(run_id: str, request_id: Union[int, str]):
+    """Make ledger writes inside the block idempotent for (run_id, request_id)."""
+    context = RequestContext(run_id, request_id)
+    token = current_request.set(context)
+    try:
+        yield context
+    finally:
+        current_request.reset(token)
+
+
+def next_idempotency_key(action: str, item_name: str) -> Optional[str]:
+    """Idempotency key for a ledger write, or None outside a request scope."""
+    context = current_request.get()
+    return context.idempotency_key(action, item_name) if context else None
+
+
+def note_transactions(transaction_ids: List[Optional[int]]) -> None:
+    """Attribute recorded transactions to the current request, if any."""
+    context = current_request.get()
+    if context:
+        context.record([txn_id for txn_id in transaction_ids if txn_id is not None])
+
+
+def _journal_timestamp() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def start_batch_run() -> str:
+    """Register a new batch run in the journal and return its run id."""
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S") + "-" + os.urandom(3).hex()
+    with get_engine().begin() as conn:
+        conn.execute(
+            text("INSERT INTO batch_runs (run_id, started_at) VALUES (:run_id, :now)"),
+            {"run_id": run_id, "now": _journal_timestamp()},
+        )
+    return run_id
+
+
+def finish_batch_run(run_id: str) -> None:
+    """Mark a batch run as finished so it is no longer resumed."""
+    with get_engine().begin() as conn:
+        conn.execute(
+            text("UPDATE batch_runs SET finished_at = :now WHERE run_id = :run_id"),
+            {"run_id": run_id, "now": _journal_timestamp()},
+        )
+
+
+def close_unfinished_runs() -> int:
+    """Mark every unfinished batch run as finished, so a fresh run is not followed by a
+    resume of an older one. Returns the number of runs closed."""
+    with get_engine().begin() as conn:
+        return conn.execute(
+            text("UPDATE batch_runs SET finished_at = :now WHERE finished_at IS NULL"),
+            {"now": _journal_timestamp()},
+        ).rowcount
+
+
+def latest_unfinished_run() -> Optional[str]:
+    """Return the id of the most recent batch run that never finished, if any."""
+    with get_engine().connect() as conn:
+        return conn.execute(text("""
+            SELECT run_id FROM batch_runs
+            WHERE finished_at IS NULL
+            ORDER BY started_at DESC, rowid DESC
+            LIMIT 1
+        """)).scalar()
+
+
+def journal_request(
+    run_id: str, request_id: int, status: str, transaction_ids: Optional[List[int]] = None
+) -> None:
+    """Record the status ('started' or 'completed') of one request of a batch run.
+
+    Args:
+        run_id: Batch run id.
+        request_id: Request number within the run.
+        status: 'started' or 'completed'.
+        transaction_ids: IDs of the transactions the request recorded.
+    """
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            INSERT INTO run_journal (run_id, request_id, status, transaction_ids, updated_at)
+            VALUES (:run_id, :request_id, :status, :transaction_ids, :now)
+            ON CONFLICT (run_id, request_id) DO UPDATE SET
+                status = excluded.status,
+                transaction_ids = excluded.transaction_ids,
+                updated_at = excluded.updated_at
+        """), {
+            "run_id": run_id,
+            "request_id": int(request_id),
+            "status": status,
+            "transaction_ids": json.dumps(transaction_ids or []),
+            "now": _journal_timestamp(),
+        })
+
+
+def completed_journal_requests(run_id: str) -> set:
+    """Return the request ids a batch run has completed."""
+    with get_engine().connect() as conn:
+        rows = conn.execute(
+            text("SELECT request_id FROM run_journal WHERE run_id = :run_id AND status = 'completed'"),
+            {"run_id": run_id},
+        ).all()
+    return {int(row[0]) for row in rows}
+
+
+# ===================================================================================
+# Step Budget Profiling
+# Every agent run is traced (steps taken, tool-call sequence, whether it hit its
+# step cap, duplicate calls, sales recorded). Budgets are recommended from the
+# traces and applied from step_budgets.json at startup, and a step callback ends
+# runs that keep repeating tool calls they have already made.
+# ===================================================================================
+
+STEP_BUDGETS_PATH = "step_budgets.json"
+# Off until validated on real traces; STEP_EARLY_STOP=1 turns it on
+STEP_EARLY_STOP_ENABLED = os.getenv("STEP_EARLY_STOP", "0") == "1"
+REPEATED_CALL_LIMIT = 2     # Consecutive all-duplicate steps before a run is ended early
+LEDGER_WRITE_TOOLS = {"record_sale", "record_stock_order"}
+
+
+def _call_signature(call) -> str:
+    return json.dumps([call.name, call.arguments], sort_keys=True, default=str)
+
+
+def _productive_steps(steps: List[ActionStep]) -> List[bool]:
+    """For each step, whether it made at least one tool call not already made in the run.
+
+    A ledger write makes every earlier read worth repeating, so it resets the history.
+    Repeating a call whose output memory compaction has since cut short is a re-fetch
+    the compacted text asks for, not a duplicate.
+    """
+    seen: Dict[str, ActionStep] = {}
+    productive = []
+    for step in steps:
+        calls = [c for c in (step.tool_calls or []) if c.name != "final_answer"]
+        signatures = [_call_signature(c) for c in calls]
+        productive.append(any(
+            sig not in seen or _COMPACTED_PATTERN.search(seen[sig].observations or "")
+            for sig in signatures
+        ))
+        if any(c.name in LEDGER_WRITE_TOOLS for c in calls):
+            seen.clear()
+        else:
+            seen.update((sig, step) for sig in signatures)
+    return productive
+
+
+def stop_on_repeated_calls(memory_step, agent) -> None:
+    """Step callback: push the agent to its final answer once it stops making progress.
+
+    After REPEATED_CALL_LIMIT consecutive steps whose tool calls were all already
+    made earlier in the run (same tool, same arguments) with their output still in
+    memory, the run is ended as if it had reached max_steps, which asks the model
+    for a final answer right away.
+    """
+    if not STEP_EARLY_STOP_ENABLED or not isinstance(memory_step, ActionStep) or memory_step.is_final_answer:
+        return
+    if not any(c.name != "final_answer" for c in (memory_step.tool_calls or [])):
+        return
+    steps = [s for s in agent.memory.steps if isinstance(s, ActionStep)] + [memory_step]
+    recent = _productive_steps(steps)[-REPEATED_CALL_LIMIT:]
+    if len(recent) == REPEATED_CALL_LIMIT and not any(recent):
+        agent.step_number = agent.max_steps
+
+
+class StepProfiler:
+    """Collects per-agent run traces and recommends step budgets from them."""
+
+    def __init__(self):
+        self.traces: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def record(self, agent_name: str, agent: ToolCallingAgent) -> Dict:
+        """Trace the agent's last run."""
+        steps = [s for s in agent.memory.steps if isinstance(s, ActionStep)]
+        forced = bool(steps) and isinstance(steps[-1].error, AgentMaxStepsError)
+        action_steps = steps[:-1] if forced else steps
+        productive = _productive_steps(action_steps)
+        sale_steps = [
+            i for i, step in enumerate(action_steps)
+            if any(c.name == "record_sale" for c in (step.tool_calls or []))
+        ]
+        trace = {
+            "agent": agent_name,
+            "budget": agent.max_steps,
+            "steps": len(action_steps),
+            "hit_cap": forced and len(action_steps) >= agent.max_steps,
+            "stopped_early": forced and len(action_steps) < agent.max_steps,
+            "tool_sequence": [
+                c.name for step in action_steps for c in (step.tool_calls or []) if c.name != "final_answer"
+            ],
+            # The final-answer step makes no tool call and is not a duplicate
+            "duplicate_steps": sum(
+                1 for step, new in zip(action_steps, productive)
+                if not new and any(c.name != "final_answer" for c in (step.tool_calls or []))
+            ),
+            # Steps needed to reach the last productive step plus the final answer
+            "needed_steps": (max(i for i, p in enumerate(productive) if p) + 2) if any(productive) else 1,
+            "last_sale_step": (sale_steps[-1] + 1) if sale_steps else 0,
+            "sales_recorded": len(sale_steps),
+        }
+        with self._lock:
+            self.traces.append(trace)
+        return trace
+
+    def summary(self) -> pd.DataFrame:
+        """Per-agent runs, mean/p95 steps, cap hits, early stops, duplicate steps and sales."""
+        if not self.traces:
+            return pd.DataFrame()
+        traces = pd.DataFrame(self.traces)
+        return traces.groupby("agent").agg(
+            runs=("steps", "size"),
+            budget=("budget", "last"),
+            mean_steps=("steps", "mean"),
+            p95_steps=("steps", lambda x: x.quantile(0.95)),
+            cap_hits=("hit_cap", "sum"),
+            stopped_early=("stopped_early", "sum"),
+            duplicate_steps=("duplicate_steps", "sum"),
+            sales_recorded=("sales_recorded", "sum"),
+        ).round(2)
+
+    def recommend_budgets(self, percentile: float = 0.95, cap_hit_tolerance: float = 0.1) -> Dict[str, int]:
+        """Recommend a max_steps budget per agent from the recorded traces.
+
+        The budget covers the `percentile` of steps needed to reach each run's last
+        productive step plus its final answer, and never cuts below the latest step
+        at which a sale was recorded, so fulfilled sales are preserved. Agents that
+        hit their cap in more than `cap_hit_tolerance` of runs get 50% more steps.
+        """
+        budgets = {}
+        for agent_name, traces in pd.DataFrame(self.traces).groupby("agent"):
+            budget = max(
+                int(np.ceil(traces["needed_steps"].quantile(percentile))),
+                int(traces["last_sale_step"].max()) + 1,
+                2,
+            )
+            current = int(traces["budget"].iloc[-1])
+            if traces["hit_cap"].mean() > cap_hit_tolerance:
+                budget = max(budget, current + int(np.ceil(current / 2)))
+            budgets[agent_name] = budget
+        return budgets
+
+
+step_profiler = StepProfiler()
+
+
+def load_step_budgets(path: str = STEP_BUDGETS_PATH) -> Dict[str, int]:
+    """Read tuned step budgets, or return {} if none were saved."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return {name: int(steps) for name, steps in json.load(f).items()}
+
+
+def save_step_budgets(budgets: Dict[str, int], path: str = STEP_BUDGETS_PATH) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(budgets, f, indent=2, sort_keys=True)
+
+
+def apply_step_budgets(budgets: Dict[str, int]) -> None:
+    """Set max_steps on the named agents (names as in AGENTS)."""
+    for agent_name, steps in budgets.items():
+        if agent_name in AGENTS:
+            AGENTS[agent_name].max_steps = steps
+
+
+# ===================================================================================
+# Memory Compaction
+# Every tool observation stays in an agent's memory and is resent on each later step,
+# so long runs get slower step by step. A step callback keeps the latest observations
+# verbatim and compacts older ones: repeats of a later output become a back-reference,
+# long outputs are cut to their first lines, and if the history still exceeds its
+# token budget the oldest observations shrink to one line.
+# ===================================================================================
+
+MEMORY_COMPACTION_ENABLED = os.getenv("MEMORY_COMPACTION", "1") != "0"
+MEMORY_RECENT_STEPS = 2             # Steps whose observations are never compacted
+MEMORY_OBSERVATION_CHARS = 300      # Older observations are cut to about this length
+MEMORY_HISTORY_TOKENS = 800         # Budget for all compacted observations per step
+MEMORY_SUMMARY_CHARS = 120          # Length older observations shrink to when over budget
+_COMPACTED_MARK = "[compacted:"
+_COMPACTED_PATTERN = re.compile(r"\n?\[compacted: (\d+) more line")
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Rough token count (4 characters per token)."""
+    return len(text or "") // 4
+
+
+def _truncate_observation(observation: str, max_chars: int) -> str:
+    """Keep leading lines up to about `max_chars` and note how many lines were dropped.
+
+    Idempotent: truncating an already compacted observation to the same length returns it unchanged.
+    """
+    if len(observation) <= max_chars:
+        return observation
+    body, omitted = observation, 0
+    mark = _COMPACTED_PATTERN.search(observation)
+    if mark:
+        body, omitted = observation[:mark.start()], int(mark.group(1))
+    lines = body.splitlines()
+    kept, size = [], 0
+    for line in lines:
+        if kept and size + len(line) + 1 > max_chars:
+            break
+        kept.append(line[:max_chars])
+        size += len(line) + 1
+    omitted += len(lines) - len(kept)
+    if not omitted:
+        return "\n".join(kept)
+    return "\n".join(kept) + f"\n{_COMPACTED_MARK} {omitted} more line(s) omitted; call the tool again if needed]"
+
+
+def compact_memory(memory_step, agent) -> None:
+    """Step callback: compact the observations of the agent's older steps.
+
+    Observations of the last MEMORY_RECENT_STEPS steps (including this one) are left
+    as they are. Older ones that repeat a later observation are replaced by a reference
+    to it, the rest are cut to MEMORY_OBSERVATION_CHARS, and while their total exceeds
+    MEMORY_HISTORY_TOKENS the oldest are reduced to their first line. Short outputs such
+    as sale confirmations are never altered beyond deduplication.
+    """
+    if not MEMORY_COMPACTION_ENABLED or not isinstance(memory_step, ActionStep):
+        return
+    steps = [s for s in agent.memory.steps if isinstance(s, ActionStep)] + [memory_step]
+    older = [s for s in steps[:-MEMORY_RECENT_STEPS] if s.observations]
+    if not older:
+        return
+
+    latest_step = {}
+    for step in steps:
+        if step.observations and _COMPACTED_MARK not in step.observations:
+            latest_step[step.observations] = step.step_number
+    for step in older:
+        repeated_in = latest_step.get(step.observations)
+        if repeated_in is not None and repeated_in != step.step_number:
+            step.observations = f"{_COMPACTED_MARK} same output as step {repeated_in}]"
+        else:
+            step.observations = _truncate_observation(step.observations, MEMORY_OBSERVATION_CHARS)
+
+    for step in older:
+        if sum(estimate_tokens(s.observations) for s in older) <= MEMORY_HISTORY_TOKENS:
+            break
+        step.observations = _truncate_observation(step.observations, MEMORY_SUMMARY_CHARS)
+
+
 # ===================================================================================
 # Agen Creation
 # 1. Inventory Agent    – stock checking, reorder assessment, delivery estimates
@@ -918,10 +4480,27 @@ def get_financial_summary(as_of_date: str) -> str:
 # 5. Orchestrator       – customer-facing coordinator that delegates to 1-4
 # ===================================================================================
 
+# smolagents renders its own Rich panels (the task, every step, each model output) on the
+# calling thread. They are off unless AGENT_VERBOSITY asks for them; the progress log
+# records already report what each agent does.
+AGENT_VERBOSITY = LogLevel[os.getenv("AGENT_VERBOSITY", "OFF").upper()]
+
+
+def make_agent_logger() -> AgentLogger:
+    """smolagents console logger at AGENT_VERBOSITY. When OFF the console is silenced too,
+    so the live view that streamed outputs are rendered into prints nothing either."""
+    console = Console(highlight=False, quiet=AGENT_VERBOSITY == LogLevel.OFF)
+    return AgentLogger(level=AGENT_VERBOSITY, console=console)
+
+
 # Agent 1: Inventory Agent
 inventory_agent = ToolCallingAgent(
-    tools=[check_all_inventory, check_item_stock, get_delivery_estimate, get_item_unit_price],
-    model=model,
+    tools=[
+        check_all_inventory, check_item_stock, get_delivery_estimate, get_delivery_estimates,
+        get_item_unit_price, forecast_demand,
+    ],
+    model=ThrottledModel(model, model_rate_limiter, "inventory"),
+    logger=make_agent_logger(),
     name="inventory_agent",
     description=(
         "Manages inventory: checks stock levels for all items or specific items, "
@@ -935,18 +4514,21 @@ inventory_agent = ToolCallingAgent(
         "Your responsibilities:\n"
         "1. Check current stock levels accurately using check_item_stock or check_all_inventory\n"
         "2. Flag items that are below their minimum stock threshold for reorder\n"
-        "3. Estimate supplier delivery timelines using get_delivery_estimate\n"
-        "4. Look up item pricing using get_item_unit_price\n\n"
+        "3. Estimate supplier delivery timelines using get_delivery_estimates (all quantities in one call)\n"
+        "4. Look up item pricing using get_item_unit_price\n"
+        "5. Use forecast_demand to flag items whose expected demand exceeds stock\n\n"
         "Always provide precise numbers. When an item is not found in inventory, "
         "state clearly that it is not currently stocked. Do not guess stock levels."
     ),
     max_steps=6,
+    step_callbacks=[stop_on_repeated_calls, compact_memory],
 )
 
 # Agent 2: Quoting Agent
 quoting_agent = ToolCallingAgent(
     tools=[search_past_quotes, check_item_stock, check_all_inventory, get_item_unit_price],
-    model=model,
+    model=ThrottledModel(model, model_rate_limiter, "quoting"),
+    logger=make_agent_logger(),
     name="quoting_agent",
     description=(
         "Generates competitive price quotes for customer orders. Uses historical "
@@ -961,6 +4543,10 @@ quoting_agent = ToolCallingAgent(
         "  - 1,000 to 4,999 units: 15% discount\n"
         "  - 5,000+ units: 20% discount\n\n"
         "WORKFLOW:\n"
+        "0. If the task includes a QUOTE DRAFT, start from it: check it against the inventory "
+        "status, correct anything that is wrong and present it; skip steps 1-4. A QUOTE "
+        "REFERENCE is not a finished quote: follow steps 2-5 for every item in the request, "
+        "reusing the prices it lists\n"
         "1. Search historical quotes for similar orders for pricing reference\n"
         "2. Check if requested items exist in current inventory\n"
         "3. Look up unit prices for each item\n"
@@ -975,15 +4561,17 @@ quoting_agent = ToolCallingAgent(
         "- Present the quote in a professional, customer-friendly format"
     ),
     max_steps=10,
+    step_callbacks=[stop_on_repeated_calls, compact_memory],
 )
 
 # Agent 3: Sales Agent
 sales_agent = ToolCallingAgent(
     tools=[
         record_sale, record_stock_order, check_cash,
-        check_item_stock, get_delivery_estimate, get_item_unit_price,
+        check_item_stock, get_delivery_estimate, get_delivery_estimates, get_item_unit_price,
     ],
-    model=model,
+    model=ThrottledModel(model, model_rate_limiter, "sales"),
+    logger=make_agent_logger(),
     name="sales_agent",
     description=(
         "Finalizes sales transactions by recording orders in the database. "
@@ -1002,7 +4590,7 @@ sales_agent = ToolCallingAgent(
         "   - quantity: the requested amount (capped at available stock)\n"
         "   - total_price: quantity * unit_price (apply discount if mentioned in quote)\n"
         "   - sale_date: extract the YYYY-MM-DD date from the request text\n"
-        "3. After all record_sale calls, call get_delivery_estimate\n"
+        "3. After all record_sale calls, call get_delivery_estimates once for all sold quantities\n"
         "4. Report which sales were recorded and which items could not be filled\n\n"
         "CRITICAL RULES:\n"
         "- You MUST call record_sale for EACH fulfillable item. This is non-negotiable.\n"
@@ -1014,12 +4602,14 @@ sales_agent = ToolCallingAgent(
         "- Report the final total charged and any items that could not be filled"
     ),
     max_steps=15,
+    step_callbacks=[stop_on_repeated_calls, compact_memory],
 )
 
 # Agent 4: Business Advisor Agent
 advisor_agent = ToolCallingAgent(
-    tools=[get_financial_summary, check_cash, check_all_inventory],
-    model=model,
+    tools=[get_financial_summary, check_cash, check_all_inventory, forecast_demand],
+    model=ThrottledModel(model, model_rate_limiter, "advisor"),
+    logger=make_agent_logger(),
     name="advisor_agent",
     description=(
         "Business intelligence agent that analyzes financial performance, "
@@ -1032,11 +4622,13 @@ advisor_agent = ToolCallingAgent(
         "1. Analyze overall business performance using financial data\n"
         "2. Identify top-selling products and revenue trends\n"
         "3. Spot inventory items that need attention (low stock, overstock)\n"
-        "4. Recommend pricing, stocking, or operational improvements\n\n"
+        "4. Recommend pricing, stocking, or operational improvements\n"
+        "5. Use forecast_demand (item 'all') to anticipate upcoming demand\n\n"
         "Always provide data-driven insights with specific numbers. "
         "Be concise but actionable in your recommendations."
     ),
     max_steps=5,
+    step_callbacks=[stop_on_repeated_calls, compact_memory],
 )
 
 # ===================================================================================
@@ -1048,7 +4640,8 @@ advisor_agent = ToolCallingAgent(
 
 orchestrator = ToolCallingAgent(
     tools=[search_past_quotes, check_all_inventory],
-    model=model,
+    model=ThrottledModel(model, model_rate_limiter, "orchestrator"),
+    logger=make_agent_logger(),
     name="orchestrator",
     description=(
         "Customer Service Orchestrator that composes final responses by "
@@ -1068,8 +4661,27 @@ orchestrator = ToolCallingAgent(
         "- Start with a greeting and end with a professional sign-off"
     ),
     max_steps=5,
+    step_callbacks=[stop_on_repeated_calls, compact_memory],
 )
 
+AGENTS = {
+    "inventory": inventory_agent,
+    "quoting": quoting_agent,
+    "sales": sales_agent,
+    "advisor": advisor_agent,
+    "orchestrator": orchestrator,
+}
+# Budgets tuned by a previous run (see run_test_scenarios(tune_steps=True)) replace the defaults
+apply_step_budgets(load_step_budgets())
+
+
+def set_backing_model(new_model: Model) -> None:
+    """Run every agent on `new_model` (e.g. a StubModel), still behind the shared rate limiter."""
+    global model
+    model = new_model
+    for agent in AGENTS.values():
+        agent.model.model = new_model
+
 # ===================================================================================
 # Request processing pipeline - Deterministic pipeline
 # The orchestration follows a strict pipeline to ensure reliable processing:
@@ -1150,98 +4762,1298 @@ ITEM_NAME_MAP = {
 }
 
 
-def process_customer_request(request_text: str) -> str:
-    """Process a customer request through the multi-agent pipeline.
+# ===================================================================================
+# Structured Request Parser
+# Extracts line items, quantities and dates from the request text once, resolves
+# them against ITEM_NAME_MAP and the catalog, and prefetches stock and prices so
+# every pipeline stage starts from the same facts instead of re-deriving them.
+# ===================================================================================
+
+# Packaging units that convert to catalog units (catalog paper is priced per sheet)
+UNIT_MULTIPLIERS = {"ream": 500, "reams": 500}
+
+# Customer phrases -> exact item names. ITEM_NAME_MAP wins over plain catalog names.
+_ITEM_ALIASES = {
+    **{item["item_name"].lower(): item["item_name"] for item in paper_supplies},
+    **ITEM_NAME_MAP,
+}
+_ITEM_ALIAS_PATTERN = re.compile(
+    r"\b(" + "|".join(
+        re.escape(alias) for alias in sorted(_ITEM_ALIASES, key=len, reverse=True)
+    ) + r")\b"
+)
+_LINE_ITEM_PATTERN = re.compile(
+    r"(?<!\w)(?P<quantity>\d[\d,]*)\s+"
+    r"(?:(?P<unit>reams?|sheets?|boxes|box|packs?|rolls?|units?|pieces?|pads?|sets?)\s+)?"
+    r"(?:of\s+)?"
+    r"(?P<description>(?:\([^()\n]*\)|[^,.;:(\n]|\.(?=\d))+?)"
+    r"(?=\s*(?:,|\.(?!\d)|;|\n|\s[-\u2013\u2022*]\s|\band\b|\bfor\b|\bto\b|$))",
+    re.IGNORECASE,
+)
+_REQUEST_DATE_PATTERN = re.compile(r"\(Date of request:\s*(\d{4}-\d{2}-\d{2})\)")
+_NEEDED_BY_PATTERN = re.compile(r"\bby\s+([A-Z][a-z]+ \d{1,2}, \d{4})")
+
+# Coverage: numbers in dates are not quantities, words that only join list items
+# are not items, and product nouns outside a recognized line are a missed item
+_DATE_PATTERN = re.compile(
+    r"\b[A-Z][a-z]+\.? \d{1,2}(?:st|nd|rd|th)?,? \d{4}\b|\b\d{4}-\d{2}-\d{2}\b|\b(?:19|20)\d{2}\b"
+)
+_LIST_CONTINUATION_PATTERN = re.compile(r"\s*(?:,|&|\b(?:and|plus|along with|as well as)\b)", re.IGNORECASE)
+_LIST_JOINERS_PATTERN = re.compile(
+    r"(?:[\s,;&\-\u2013\u2022*]|\b(?:and|also|plus|along with|as well as|additionally|including)\b)*",
+    re.IGNORECASE,
+)
+_TRAILING_JOINERS_PATTERN = re.compile(r"(?:[\s,;&]|\b(?:and|also|plus)\b)+$", re.IGNORECASE)
+_CLAUSE_END_PATTERN = re.compile(r"\.(?!\d)|[;:\n]|$")
+_ITEM_NOUNS = {
+    re.sub(r"\s*\(.*\)", "", alias).split()[-1] for alias in _ITEM_ALIASES
+} - {"paper", "stock", "cover", "roll"}
+_ITEM_NOUN_PATTERN = re.compile(
+    r"\b(" + "|".join(sorted(_ITEM_NOUNS, key=len, reverse=True)) + r")\b", re.IGNORECASE
+)
+_PURPOSE_PATTERN = re.compile(r"\bfor\s+(?:[\w-]+\s+)?$", re.IGNORECASE)
+
+
+@dataclass
+class OrderLine:
+    """One requested line item, resolved against the catalog and current stock."""
+    description: str
+    quantity: int
+    unit: str
+    catalog_quantity: int
+    item_name: Optional[str] = None
+    in_inventory: bool = False
+    stock: int = 0
+    unit_price: Optional[float] = None
+    delivery_date: Optional[str] = None
+
+
+@dataclass
+class ParsedOrder:
+    """The structured form of a customer request shared by every pipeline stage."""
+    request_text: str
+    request_date: Optional[str]
+    needed_by: Optional[str]
+    lines: List[OrderLine] = field(default_factory=list)
+    unparsed: List[str] = field(default_factory=list)
+
+    def to_prompt(self) -> str:
+        """Render the order as a compact block for agent task prompts."""
+        lines = [
+            "STRUCTURED ORDER (pre-extracted; stock and prices below are current, do not "
+            "look them up again, but check the request text for items missing here):",
+            f"  Request date: {self.request_date or 'unknown'}",
+            f"  Needed by: {self.needed_by or 'not specified'}",
+        ]
+        for line in self.lines:
+            requested = f"{line.quantity} {line.unit}"
+            if line.catalog_quantity != line.quantity:
+                requested += f" (= {line.catalog_quantity} sheets)"
+            if line.item_name is None:
+                lines.append(f"  - {requested} of '{line.description}': NOT IN CATALOG")
+            elif not line.in_inventory:
+                lines.append(
+                    f"  - {requested} of '{line.description}' -> {line.item_name}: "
+                    f"not currently stocked (catalog price ${line.unit_price:.2f}/unit, "
+                    f"supplier delivery by {line.delivery_date})"
+                )
+            else:
+                lines.append(
+                    f"  - {requested} of '{line.description}' -> {line.item_name}: "
+                    f"{line.stock} in stock, ${line.unit_price:.2f}/unit, "
+                    f"supplier delivery by {line.delivery_date}"
+                )
+        for text in self.unparsed:
+            lines.append(f"  - NOT PARSED: '{text}' (read it in the request text)")
+        if not self.lines:
+            lines.append("  (no line items recognized; read the request text)")
+        return "\n".join(lines)
+
+    @property
+    def is_complete(self) -> bool:
+        """Whether the lines account for the whole request: every extracted line
+        matched a catalog item and no item-like text was left unparsed."""
+        return bool(self.lines) and not self.unparsed and all(line.item_name for line in self.lines)
+
+    def signature(self) -> tuple:
+        """Canonical form of the order: equal for requests asking for the same items,
+        quantities and dates, however they are worded."""
+        return (
+            self.request_date,
+            self.needed_by,
+            tuple(sorted(
+                (line.item_name or line.description.lower(), line.catalog_quantity,
+                 line.in_inventory, line.stock, line.unit_price)
+                for line in self.lines
+            )),
+        )
+
+
+def parse_customer_request(request_text: str) -> ParsedOrder:
+    """Extract line items, quantities and dates from a customer request.
+
+    Quantities keep the customer's unit; `catalog_quantity` converts reams to
+    sheets (catalog paper is priced per sheet). Item descriptions are mapped to
+    exact names with ITEM_NAME_MAP first and the product catalog second; lines
+    that match neither keep `item_name=None`. Text that looks like a requested
+    item but is not part of any line ("50 balloons", "and a banner with our
+    logo", a product noun in another sentence) goes to `unparsed`.
+
+    Args:
+        request_text: The customer request, optionally ending with
+            "(Date of request: YYYY-MM-DD)".
+
+    Returns:
+        The parsed order without stock or price information.
+    """
+    date_match = _REQUEST_DATE_PATTERN.search(request_text)
+    request_date = date_match.group(1) if date_match else None
+    body = request_text[:date_match.start()] if date_match else request_text
+
+    needed_by = None
+    needed_match = _NEEDED_BY_PATTERN.search(body)
+    if needed_match:
+        try:
+            needed_by = datetime.strptime(needed_match.group(1), "%B %d, %Y").strftime("%Y-%m-%d")
+        except ValueError:
+            needed_by = None
+
+    lines, matches, unparsed = [], [], []
+    dates = [match.span() for match in _DATE_PATTERN.finditer(body)]
+    for match in _LINE_ITEM_PATTERN.finditer(body):
+        description = match.group("description").strip()
+        # Search from the unit on, so "rolls of banner paper" is not read as "banner paper"
+        phrase = body[match.start("unit") if match.group("unit") else match.start("description"):match.end()]
+        alias = _ITEM_ALIAS_PATTERN.search(phrase.lower())
+        if alias is None and not match.group("unit"):
+            # A bare number not followed by a known item: part of a date, or an item we cannot name
+            in_date = any(start <= match.start() < end for start, end in dates)
+            if not in_date and re.search(r"[A-Za-z]", description):
+                unparsed.append(match.group(0).strip())
+            continue
+        matches.append(match)
+        unit = (match.group("unit") or "units").lower()
+        quantity = int(match.group("quantity").replace(",", ""))
+        lines.append(OrderLine(
+            description=description,
+            quantity=quantity,
+            unit=unit,
+            catalog_quantity=quantity * UNIT_MULTIPLIERS.get(unit, 1),
+            item_name=_ITEM_ALIASES[alias.group(1)] if alias else None,
+        ))
+
+    for i, match in enumerate(matches):
+        # "500 sheets of A4 paper and a banner with our logo": the list goes on past the line
+        next_start = matches[i + 1].start() if i + 1 < len(matches) else len(body)
+        gap = body[match.end():min(next_start, _CLAUSE_END_PATTERN.search(body, match.end()).start())]
+        ends_in_date = any(start < match.end() <= end for start, end in dates)
+        if not ends_in_date and _LIST_CONTINUATION_PATTERN.match(gap):
+            rest = _TRAILING_JOINERS_PATTERN.sub("", gap[_LIST_JOINERS_PATTERN.match(gap).end():]).strip()
+            if rest:
+                unparsed.append(rest)
+
+    outside = list(body)
+    for match in matches:
+        outside[match.start():match.end()] = " " * (match.end() - match.start())
+    outside = "".join(outside)
+    for noun in _ITEM_NOUN_PATTERN.finditer(outside):
+        # "cardstock for invitations" names a purpose, not another item
+        if not _PURPOSE_PATTERN.search(outside, 0, noun.start()):
+            unparsed.append(noun.group(0))
+
+    return ParsedOrder(request_text, request_date, needed_by, lines, list(dict.fromkeys(unparsed)))
+
+
+def _unit_prices_for(names: List[str]) -> tuple:
+    """(inventory prices with NaN for unstocked items, unit prices falling back to the product catalog)."""
+    inventory_prices = get_inventory_catalog().prices_for(names)
+    catalog_prices = product_catalog.prices_for(names)
+    return inventory_prices, np.where(np.isnan(inventory_prices), np.nan_to_num(catalog_prices), inventory_prices)
+
+
+def resolve_order_availability(order: ParsedOrder) -> ParsedOrder:
+    """Fill in stock, unit price and supplier delivery date for every recognized line
+    with one stock query and one batch delivery schedule."""
+    if not any(line.item_name for line in order.lines):
+        return order
+    as_of_date = order.request_date or datetime.now().strftime("%Y-%m-%d")
+    stock = get_all_inventory(as_of_date)
+    lines = [line for line in order.lines if line.item_name is not None]
+    inventory_prices, unit_prices = _unit_prices_for([line.item_name for line in lines])
+
+    deliveries = schedule_deliveries(as_of_date, [line.catalog_quantity for line in lines]).astype(str)
+
+    for line, inventory_price, unit_price, delivery in zip(lines, inventory_prices, unit_prices, deliveries):
+        line.in_inventory = not np.isnan(inventory_price)
+        line.stock = int(stock.get(line.item_name, 0))
+        line.unit_price = float(unit_price)
+        line.delivery_date = str(delivery)
+    return order
+
+
+# ===================================================================================
+# Quote Drafts
+# Historical quotes are grouped into request archetypes by (job_type, order_size,
+# event_type). An offline build prices each archetype's typical basket against the
+# catalog, current stock and the bulk discount tiers. Ledger writes mark only the
+# templates containing the written items stale, and those are re-priced on next use.
+# The quoting stage starts from a ready draft (the order priced line by line plus the
+# archetype's precedents) instead of searching history and computing prices itself.
+# ===================================================================================
+
+QUOTE_DRAFTS_ENABLED = os.getenv("QUOTE_DRAFTS", "1") != "0"
+
+# Bulk discount tiers by line quantity, as in the quoting agent's DISCOUNT STRATEGY
+QUOTE_DISCOUNT_BOUNDS = np.array([100, 500, 1000, 5000])
+QUOTE_DISCOUNT_RATES = np.array([0.0, 0.05, 0.10, 0.15, 0.20])
+
+# Basket items per template, and precedents quoted in a draft
+QUOTE_TEMPLATE_BASKET_SIZE = 5
+QUOTE_TEMPLATE_PRECEDENTS = 2
+
+_ORDER_SIZE_PATTERN = re.compile(r"\b(small|medium|large)\b")
+_DISCOUNT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*%\s*(?:bulk\s+)?discount", re.IGNORECASE)
+
+
+def get_quote_discount_rates(quantities: Union[int, List[int], np.ndarray]) -> np.ndarray:
+    """Bulk discount rate for each line quantity (0.05 for 100-499 units, ..., 0.20 for 5,000+)."""
+    return QUOTE_DISCOUNT_RATES[np.searchsorted(QUOTE_DISCOUNT_BOUNDS, quantities, side="right")]
+
+
+def _priced_line(item_name: str, quantity: int, unit_price: float, discount: float, note: str = "") -> tuple:
+    """Render one priced quote line; returns (line, discounted total)."""
+    subtotal = quantity * unit_price
+    total = subtotal * (1 - discount)
+    rendered = f"  - {quantity} units {item_name} @ ${unit_price:.2f} = ${subtotal:,.2f}"
+    if discount:
+        rendered += f", {discount:.0%} bulk discount -> ${total:,.2f}"
+    return rendered + (f" [{note}]" if note else ""), total
+
+
+def _shortage_note(available: int) -> str:
+    return f"only {available} in stock" if available > 0 else "out of stock"
+
+
+@dataclass
+class QuoteTemplate:
+    """A priced starting quote for one request archetype; None fields in `archetype` match anything."""
+    archetype: tuple
+    n_quotes: int
+    median_total: float
+    typical_discount: Optional[float]
+    precedents: List[str]
+    basket: List[tuple]
+    priced_lines: List[str] = field(default_factory=list)
+    basket_total: float = 0.0
+    stale: bool = True
+
+    @property
+    def label(self) -> str:
+        job_type, order_size, event_type = self.archetype
+        parts = [part for part in (order_size, event_type) if part]
+        label = " ".join(parts) if parts else "any"
+        return f"{label} ({job_type})" if job_type else label
+
+
+class QuoteTemplates:
+    """Quote templates for the current tenant's request archetypes.
+
+    `build()` is the offline job: it parses every historical request, groups the
+    quotes into archetypes at three levels of detail and records each one's typical
+    basket, discount and precedents. Templates are re-priced lazily: `mark_stale`
+    (called by the transaction listener, or with no items after a price change)
+    flags the affected templates, which are re-priced from the in-memory stock
+    counters when next used (or all at once by `refresh`).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._templates: Dict[tuple, QuoteTemplate] = {}
+        self._by_item: Dict[str, set] = {}
+        self._size_centers: Dict[str, float] = {}
+        self._event_pattern: Optional[re.Pattern] = None
+        self._job_pattern: Optional[re.Pattern] = None
+        self._built = False
+        self.stats = {"builds": 0, "repriced": 0, "drafts": 0, "misses": 0}
+
+    @staticmethod
+    def _keys(job_type, order_size, event_type) -> List[tuple]:
+        """Archetype keys from most to least specific."""
+        return [
+            (job_type, order_size, event_type),
+            (None, order_size, event_type),
+            (None, order_size, None),
+            (None, None, event_type),
+        ]
+
+    @staticmethod
+    def _word_pattern(words) -> Optional[re.Pattern]:
+        words = sorted({word.lower() for word in words if word}, key=len, reverse=True)
+        if not words:
+            return None
+        return re.compile(r"\b(" + "|".join(re.escape(word) for word in words) + r")s?\b")
+
+    def build(self) -> "QuoteTemplates":
+        """Group historical quotes into archetypes and price every template."""
+        try:
+            history = load_quote_history().rename(columns={"original_request": "request"})
+        except Exception as e:
+            logger.warning("No quote history for templates: %s", e)
+            history = pd.DataFrame(columns=[
+                "request", "total_amount", "quote_explanation", "job_type", "order_size", "event_type",
+            ])
+        members: Dict[tuple, List[Dict]] = {}
+        log_quantities: Dict[str, List[float]] = {}
+        for row in history.itertuples(index=False):
+            job_type, order_size, event_type = (
+                (value or "").strip().lower() or None for value in (row.job_type, row.order_size, row.event_type)
+            )
+            lines = [line for line in parse_customer_request(row.request or "").lines if line.item_name]
+            discount = _DISCOUNT_PATTERN.search(row.quote_explanation or "")
+            quote = {
+                "total": float(row.total_amount or 0),
+                "discount": float(discount.group(1)) / 100 if discount else None,
+                "explanation": row.quote_explanation or "",
+                "lines": lines,
+            }
+            if order_size and lines:
+                log_quantities.setdefault(order_size, []).append(
+                    float(np.log10(sum(line.catalog_quantity for line in lines)))
+                )
+            for key in set(self._keys(job_type, order_size, event_type)):
+                if any(key):
+                    members.setdefault(key, []).append(quote)
+
+        templates, by_item = {}, {}
+        for key, quotes in members.items():
+            counts: Dict[str, int] = {}
+            quantities: Dict[str, List[int]] = {}
+            for quote in quotes:
+                for line in quote["lines"]:
+                    counts[line.item_name] = counts.get(line.item_name, 0) + 1
+                    quantities.setdefault(line.item_name, []).append(line.catalog_quantity)
+            top = sorted(counts, key=lambda name: (-counts[name], name))[:QUOTE_TEMPLATE_BASKET_SIZE]
+            basket = [(name, int(np.median(quantities[name]))) for name in top]
+            discounts = [quote["discount"] for quote in quotes if quote["discount"] is not None]
+            templates[key] = QuoteTemplate(
+                archetype=key,
+                n_quotes=len(quotes),
+                median_total=float(np.median([quote["total"] for quote in quotes])),
+                typical_discount=float(np.median(discounts)) if discounts else None,
+                precedents=[
+                    f"${quote['total']:,.0f}: {quote['explanation'][:200]}"
+                    for quote in quotes[:QUOTE_TEMPLATE_PRECEDENTS]
+                ],
+                basket=basket,
+            )
+            for name, _ in basket:
+                by_item.setdefault(name, set()).add(key)
+
+        with self._lock:
+            self._templates = templates
+            self._by_item = by_item
+            self._size_centers = {size: float(np.median(values)) for size, values in log_quantities.items()}
+            self._event_pattern = self._word_pattern(history["event_type"].dropna())
+            self._job_pattern = self._word_pattern(history["job_type"].dropna())
+            self._built = True
+            self.stats["builds"] += 1
+            self.refresh()
+        return self
+
+    def _ensure_built(self) -> None:
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self.build()
+
+    def mark_stale(self, item_names: Optional[List[str]] = None) -> None:
+        """Flag templates whose basket contains any of `item_names` (all templates if None)."""
+        with self._lock:
+            if item_names is None:
+                keys = self._templates.keys()
+            else:
+                keys = set().union(*(self._by_item.get(name, ()) for name in item_names))
+            for key in keys:
+                self._templates[key].stale = True
+
+    def on_transactions(self, records: List[Dict]) -> None:
+        """Transaction listener: stock moved for the written items."""
+        if self._built:
+            self.mark_stale([record["item_name"] for record in records if record["item_name"]])
+
+    def _reprice(self, templates: List[QuoteTemplate]) -> None:
+        counter = stock_counters.get()
+        names = sorted({name for template in templates for name, _ in template.basket})
+        unit_prices = dict(zip(names, _unit_prices_for(names)[1].tolist()))
+        for template in templates:
+            discounts = get_quote_discount_rates([quantity for _, quantity in template.basket]).tolist()
+            template.priced_lines, template.basket_total = [], 0.0
+            for (name, quantity), discount in zip(template.basket, discounts):
+                available = counter.available(name)
+                note = "" if available >= quantity else _shortage_note(available)
+                rendered, total = _priced_line(name, quantity, unit_prices[name], discount, note)
+                template.priced_lines.append(rendered)
+                template.basket_total += total
+            template.stale = False
+        self.stats["repriced"] += len(templates)
+
+    def refresh(self) -> int:
+        """Re-price every stale template against current prices and stock; returns how many."""
+        with self._lock:
+            stale = [template for template in self._templates.values() if template.stale]
+            if stale:
+                self._reprice(stale)
+            return len(stale)
+
+    def classify(self, order: ParsedOrder) -> tuple:
+        """The (job_type, order_size, event_type) archetype a request most likely belongs to."""
+        self._ensure_built()
+        text = order.request_text.lower()
+        job = self._job_pattern.search(text) if self._job_pattern else None
+        event = self._event_pattern.search(text) if self._event_pattern else None
+        quantity = sum(line.catalog_quantity for line in order.lines if line.item_name)
+        order_size = None
+        if quantity and self._size_centers:
+            log_quantity = np.log10(quantity)
+            order_size = min(self._size_centers, key=lambda size: abs(self._size_centers[size] - log_quantity))
+        elif not quantity:
+            # No recognized quantities; fall back to the customer's own words ("a large order")
+            stated = _ORDER_SIZE_PATTERN.search(text)
+            order_size = stated.group(1) if stated else None
+        return (job.group(1) if job else None, order_size, event.group(1) if event else None)
+
+    def template_for(self, archetype: tuple) -> Optional[QuoteTemplate]:
+        """The most specific template matching `archetype`, re-priced first if it is stale."""
+        self._ensure_built()
+        with self._lock:
+            for key in self._keys(*archetype):
+                template = self._templates.get(key) if any(key) else None
+                if template is not None:
+                    if template.stale:
+                        self._reprice([template])
+                    return template
+        return None
+
+    def draft(self, order: ParsedOrder) -> Optional[str]:
+        """A priced draft quote for the order, or None when there is nothing to start from.
+
+        Only an order the parser accounted for in full gets a QUOTE DRAFT the agent
+        may present as is. Otherwise the draft is a QUOTE REFERENCE: prices for the
+        recognized lines (no total) and the archetype's past quotes, and the agent
+        quotes the request text itself.
+        """
+        template = self.template_for(self.classify(order))
+        lines = [line for line in order.lines if line.item_name]
+        if not lines and (template is None or not template.precedents):
+            self.stats["misses"] += 1
+            return None
+        self.stats["drafts"] += 1
+
+        if order.is_complete:
+            out = [
+                "QUOTE DRAFT (precomputed from current prices, stock and the bulk discount tiers; "
+                "verify it against the inventory status and present it - no need to search past "
+                "quotes or look up prices again):"
+            ]
+        elif lines:
+            out = [
+                "QUOTE REFERENCE (the request has items that were not recognized, so this is not "
+                "a finished quote; quote every item in the request text, reusing these prices):"
+            ]
+        else:
+            out = [
+                "QUOTE REFERENCE (no line items were recognized in the request, so nothing is "
+                "priced here; identify the items from the request text and quote them as usual):"
+            ]
+        if template is not None:
+            summary = f"  Archetype: {template.label} orders, {template.n_quotes} past quote(s), median total ${template.median_total:,.0f}"
+            if template.typical_discount is not None:
+                summary += f", typical discount {template.typical_discount:.0%}"
+            out.append(summary)
+
+        if lines:
+            discounts = get_quote_discount_rates([line.catalog_quantity for line in lines])
+            draft_total = 0.0
+            for line, discount in zip(lines, discounts):
+                if not line.in_inventory:
+                    note = f"not stocked; supplier delivery by {line.delivery_date}"
+                elif line.stock < line.catalog_quantity:
+                    note = _shortage_note(line.stock)
+                else:
+                    note = ""
+                rendered, total = _priced_line(
+                    line.item_name, line.catalog_quantity, line.unit_price, float(discount), note
+                )
+                out.append(rendered)
+                draft_total += total
+            for line in order.lines:
+                if not line.item_name:
+                    out.append(f"  - '{line.description}': not in catalog; suggest an alternative")
+            for text in order.unparsed:
+                out.append(f"  - '{text}': not priced; quote it from the request text")
+            if order.is_complete:
+                out.append(f"  Draft total: ${draft_total:,.2f} (quote ${round(draft_total):,})")
+
+        if template is not None and template.precedents:
+            out.append("  Similar past quotes:")
+            out.extend(f"    - {precedent}" for precedent in template.precedents)
+        return "\n".join(out)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                "templates": len(self._templates),
+                "stale": sum(template.stale for template in self._templates.values()),
+                **self.stats,
+            }
+
+
+quote_templates = TenantLocal(QuoteTemplates)
+register_transaction_listener(lambda records: quote_templates.get().on_transactions(records))
+
+
+def count_tool_calls(agent: ToolCallingAgent) -> int:
+    """Count the tool calls (excluding final_answer) made during the agent's last run."""
+    return sum(
+        1
+        for step in agent.memory.steps
+        if isinstance(step, ActionStep)
+        for call in (step.tool_calls or [])
+        if call.name != "final_answer"
+    )
+
+
+def process_customer_request(
+    request_text: str,
+    use_parser: bool = True,
+    metrics: Optional[Dict] = None,
+) -> str:
+    """Process a customer request through the multi-agent pipeline.
+
+    Implements a deterministic orchestration pipeline that ensures each agent
+    is called in the correct order. The orchestrator coordinates:
+      0. Request Parser — extracts line items, dates, stock and prices once
+      1. Inventory Agent — checks item availability
+      2. Quoting Agent — generates competitive pricing
+      3. Sales Agent — records transactions for available items
+      4. Orchestrator — composes the final customer response
+
+    Args:
+        request_text: The full customer request text including date context.
+        use_parser: Share the structured order with every stage. When False, each
+            agent works from the raw request text (the original behaviour).
+        metrics: Optional dict filled with per-stage tool call counts
+            ('tool_calls') and the repeated read-only tool calls
+            answered from the request's cache ('duplicate_calls_saved'), the
+            read-only stages shared with an identical request in flight
+            ('coalesced_stages'), the id tagging the request's log
+            records ('correlation_id'), and whether the quoting stage started
+            from a precomputed draft ('quote_draft').
+
+    Returns:
+        A polished, customer-facing response string.
+    """
+    with correlation_scope(), tool_cache_scope() as tool_cache:
+        metrics = _start_request(request_text, metrics)
+        metrics["duplicate_calls_saved"] = tool_cache.saved
+        return _run_pipeline(request_text, use_parser, metrics, tool_cache)
+
+
+def process_customer_request_stream(
+    request_text: str,
+    use_parser: bool = True,
+    metrics: Optional[Dict] = None,
+):
+    """Streaming variant of `process_customer_request`.
+
+    The pipeline runs on a worker thread; this generator yields its events as
+    they happen:
+      - {"event": "stage", "stage": ..., "status": "started"}, then "finished"
+        (or "shared" for a coalesced stage) with the stage's "seconds"
+      - {"event": "token", "text": ...} for each piece of the composed response,
+        streamed from the model as it is generated
+      - {"event": "response", "text": ...} with the complete response, last
+
+    The request completes even if the caller stops iterating early.
+
+    Args:
+        request_text: The full customer request text including date context.
+        use_parser: See `process_customer_request`.
+        metrics: See `process_customer_request`; additionally receives
+            'time_to_first_token' and 'total_seconds' as seen by the caller.
+
+    Yields:
+        Dict: Pipeline events, in order.
+    """
+    metrics = {} if metrics is None else metrics
+    events = queue.SimpleQueue()
+
+    def produce() -> None:
+        try:
+            with correlation_scope(), tool_cache_scope() as tool_cache:
+                _start_request(request_text, metrics)
+                metrics["duplicate_calls_saved"] = tool_cache.saved
+                response = _run_pipeline(request_text, use_parser, metrics, tool_cache, on_event=events.put)
+            events.put({"event": "response", "text": response})
+        finally:
+            events.put(None)
+
+    start = time.perf_counter()
+    worker = threading.Thread(target=contextvars.copy_context().run, args=(produce,), name="response-stream", daemon=True)
+    worker.start()
+    first_token = None
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        if first_token is None and event["event"] == "token":
+            first_token = time.perf_counter() - start
+            metrics["time_to_first_token"] = first_token
+        yield event
+    metrics["total_seconds"] = time.perf_counter() - start
+    worker.join()
+
+
+def _start_request(request_text: str, metrics: Optional[Dict]) -> Dict:
+    """Print the request banner and reset the per-request metrics."""
+    print_agent_banner("Orchestrator", "Processing new customer request")
+    print_step("orchestrator", f"Request preview: {request_text[:120]}...")
+    if metrics is None:
+        metrics = {}
+    metrics["correlation_id"] = correlation_id.get()
+    metrics["tool_calls"] = {}
+    metrics["duplicate_calls_saved"] = {}
+    metrics["coalesced_stages"] = []
+    return metrics
+
+
+def _order_context(request_text: str, use_parser: bool, metrics: Dict) -> tuple:
+    """Step 0: parse the request once and render the structured order shared with every stage.
+
+    Returns:
+        (order_context, order_key, quote_draft) where equivalent requests have equal
+        order keys and quote_draft is the quoting stage's starting point, if any. Only
+        a request the parser accounted for in full is keyed by its order signature;
+        any other request is keyed by its text, normalized for case and whitespace.
+    """
+    text_key = " ".join(request_text.lower().split())
+    if not use_parser:
+        return f"Customer request: {request_text}", text_key, None
+    order = resolve_order_availability(parse_customer_request(request_text))
+    print_step(
+        "orchestrator",
+        f"Parsed {len(order.lines)} line item(s), request date {order.request_date}",
+    )
+    quote_draft = quote_templates.get().draft(order) if QUOTE_DRAFTS_ENABLED else None
+    metrics["quote_draft"] = quote_draft is not None
+    # The raw text always goes along: the parser can miss items, and agents must still see them
+    order_context = f"{order.to_prompt()}\n\nCustomer request: {request_text}"
+    if not order.is_complete:
+        return order_context, text_key, quote_draft
+    return order_context, order.signature(), quote_draft
+
+
+def _inventory_task(order_context: str) -> str:
+    return (
+        f"Check inventory for this customer request. For each item mentioned, "
+        f"check if it exists in stock and report the stock level and unit price.\n\n"
+        f"{order_context}"
+    )
+
+
+def _quote_task(order_context: str, inv_result: str, quote_draft: Optional[str] = None) -> str:
+    task = (
+        f"Generate a competitive price quote for a customer order. "
+        f"Apply bulk discounts where applicable.\n\n"
+        f"{order_context}\n\n"
+        f"Inventory status: {inv_result}"
+    )
+    return f"{task}\n\n{quote_draft}" if quote_draft else task
+
+
+def _sales_task(order_context: str, inv_result: str, quote_result: str) -> str:
+    return (
+        f"Process and record sales transactions for all available items. "
+        f"You MUST call record_sale for each item that is in stock. "
+        f"Use the EXACT inventory item names.\n\n"
+        f"{order_context}\n\n"
+        f"Inventory status: {inv_result}\n\n"
+        f"Approved quote: {quote_result}"
+    )
+
+
+def _compose_task(request_text: str, inv_result: str, quote_result: str, sales_result: str) -> str:
+    return (
+        f"Compose a professional customer-facing response for this request. "
+        f"Synthesize the information below into a warm, clear message.\n\n"
+        f"Customer request: {request_text}\n\n"
+        f"What we found in inventory: {inv_result}\n\n"
+        f"Price quote generated: {quote_result}\n\n"
+        f"Sales transactions processed: {sales_result}\n\n"
+        f"Include: items fulfilled, pricing, discounts applied, delivery dates, "
+        f"and any items we could not fulfill. Do NOT reveal internal system details."
+    )
+
+
+# Banner shown when each pipeline stage starts
+STAGE_BANNERS = {
+    "inventory": ("Inventory", "Checking item availability"),
+    "quoting": ("Quoting", "Generating competitive quote"),
+    "sales": ("Sales", "Recording transactions"),
+    "orchestrator": ("Orchestrator", "Composing customer response"),
+}
+
+
+def _run_stage(stage: str, task: str, metrics: Dict, tool_cache: ToolCallCache) -> str:
+    """Run one agent stage and record its tool calls and step profile."""
+    agent = AGENTS[stage]
+    print_agent_banner(*STAGE_BANNERS[stage])
+    tool_cache.agent_name = stage
+    result = str(agent.run(task))
+    metrics["tool_calls"][stage] = count_tool_calls(agent)
+    step_profiler.record(stage, agent)
+    return result
+
+
+def _note_coalesced(stage: str, shared: bool, metrics: Dict) -> None:
+    if shared:
+        metrics["tool_calls"][stage] = 0
+        metrics["coalesced_stages"].append(stage)
+        print_step("orchestrator", f"{stage} stage shared with an identical request in flight")
+
+
+def _run_read_only_stage(stage: str, key, task: str, metrics: Dict, tool_cache: ToolCallCache) -> str:
+    """Run a read-only stage, sharing the result with concurrent requests that have the same key."""
+    result, shared = single_flight.do(stage, key, _run_stage, stage, task, metrics, tool_cache)
+    _note_coalesced(stage, shared, metrics)
+    return result
+
+
+class _AnswerStreamDecoder:
+    """Incrementally decodes the `answer` string of streamed final_answer JSON arguments."""
+
+    _START = re.compile(r'"answer"\s*:\s*"')
+    _ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+
+    def __init__(self):
+        self.raw = ""
+        self._pos: Optional[int] = None
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """Add a chunk of arguments; returns the newly decoded answer text."""
+        self.raw += chunk
+        if self._pos is None:
+            match = self._START.search(self.raw)
+            if match is None:
+                return ""
+            self._pos = match.end()
+        decoded, raw, i = [], self.raw, self._pos
+        while i < len(raw) and not self.done:
+            char = raw[i]
+            if char == '"':
+                self.done = True
+            elif char != "\\":
+                decoded.append(char)
+                i += 1
+                continue
+            elif i + 1 >= len(raw):
+                break
+            elif raw[i + 1] == "u":
+                # \uXXXX, or a surrogate pair \uXXXX\uXXXX
+                width = 12 if i + 6 <= len(raw) and 0xD800 <= int(raw[i + 2:i + 6], 16) < 0xDC00 else 6
+                if i + width > len(raw):
+                    break
+                decoded.append(json.loads(f'"{raw[i:i + width]}"'))
+                i += width
+                continue
+            else:
+                decoded.append(self._ESCAPES.get(raw[i + 1], raw[i + 1]))
+                i += 2
+                continue
+        self._pos = i
+        return "".join(decoded)
+
+
+def _run_streaming_stage(stage: str, task: str, metrics: Dict, tool_cache: ToolCallCache, on_event) -> str:
+    """Like `_run_stage`, but streams the agent's final answer to `on_event` as token events."""
+    agent = AGENTS[stage]
+    print_agent_banner(*STAGE_BANNERS[stage])
+    tool_cache.agent_name = stage
+    decoders: Dict[int, _AnswerStreamDecoder] = {}
+    streamed, result = "", None
+    streaming = agent.stream_outputs
+    agent.stream_outputs = True
+    try:
+        for event in agent.run(task, stream=True):
+            if isinstance(event, ChatMessageStreamDelta):
+                for delta in event.tool_calls or []:
+                    if delta.function is None:
+                        continue
+                    if delta.function.name == "final_answer":
+                        decoders[delta.index] = _AnswerStreamDecoder()
+                    decoder = decoders.get(delta.index)
+                    text = decoder.feed(delta.function.arguments or "") if decoder else ""
+                    if text:
+                        streamed += text
+                        on_event({"event": "token", "text": text})
+            elif isinstance(event, ActionStep):
+                decoders.clear()
+            elif isinstance(event, FinalAnswerStep):
+                result = event.output
+    finally:
+        agent.stream_outputs = streaming
+    result = str(result)
+    # Answers that were not streamed (e.g. the max-steps fallback) arrive in one piece
+    if result.startswith(streamed) and len(result) > len(streamed):
+        on_event({"event": "token", "text": result[len(streamed):]})
+    metrics["tool_calls"][stage] = count_tool_calls(agent)
+    step_profiler.record(stage, agent)
+    return result
+
+
+@contextmanager
+def _stage_events(stage: str, metrics: Dict, on_event):
+    """Send 'started' and 'finished' (or 'shared') events for a pipeline stage to `on_event`,
+    and profile the stage separately while a ProfilingSession is active."""
+    with active_profile.stage(stage) if active_profile is not None else nullcontext():
+        if on_event is None:
+            yield
+            return
+        start = time.perf_counter()
+        on_event({"event": "stage", "stage": stage, "status": "started"})
+        yield
+        status = "shared" if stage in metrics["coalesced_stages"] else "finished"
+        on_event({"event": "stage", "stage": stage, "status": status, "seconds": round(time.perf_counter() - start, 3)})
+
+
+PIPELINE_ERROR_MESSAGE = (
+    "We apologize, but we were unable to fully process your request "
+    "at this time. Please try again or contact our support team."
+)
 
-    Implements a deterministic orchestration pipeline that ensures each agent
-    is called in the correct order. The orchestrator coordinates:
-      1. Inventory Agent — checks item availability
-      2. Quoting Agent — generates competitive pricing
-      3. Sales Agent — records transactions for available items
-      4. Orchestrator — composes the final customer response
 
-    Args:
-        request_text: The full customer request text including date context.
+def _run_pipeline(
+    request_text: str, use_parser: bool, metrics: Dict, tool_cache: ToolCallCache, on_event=None
+) -> str:
+    """Stages 0-4 of process_customer_request; `tool_cache.agent_name` tracks the active stage.
 
-    Returns:
-        A polished, customer-facing response string.
+    With `on_event`, stage progress is reported to it and the final response is
+    streamed to it token by token.
     """
-    print_agent_banner("Orchestrator", "Processing new customer request")
-    print_step("orchestrator", f"Request preview: {request_text[:120]}...")
-
     try:
+        with _stage_events("parse", metrics, on_event):
+            order_context, order_key, quote_draft = _order_context(request_text, use_parser, metrics)
+
         # Step 1: Inventory Check
-        print_agent_banner("Inventory", "Checking item availability")
-        inv_task = (
-            f"Check inventory for this customer request. For each item mentioned, "
-            f"check if it exists in stock and report the stock level and unit price. "
-            f"Request: {request_text}"
-        )
-        inv_result = str(inventory_agent.run(inv_task))
+        with _stage_events("inventory", metrics, on_event):
+            inv_result = _run_read_only_stage(
+                "inventory", order_key, _inventory_task(order_context), metrics, tool_cache
+            )
         print_step("orchestrator", f"Inventory result: {inv_result[:200]}...")
 
         # Step 2: Quote Generation
-        print_agent_banner("Quoting", "Generating competitive quote")
-        quote_task = (
-            f"Generate a competitive price quote for a customer order. "
-            f"Apply bulk discounts where applicable.\n\n"
-            f"Customer request: {request_text}\n\n"
-            f"Inventory status: {inv_result}"
-        )
-        quote_result = str(quoting_agent.run(quote_task))
+        with _stage_events("quoting", metrics, on_event):
+            quote_result = _run_read_only_stage(
+                "quoting",
+                (order_key, inv_result),
+                _quote_task(order_context, inv_result, quote_draft),
+                metrics,
+                tool_cache,
+            )
         print_step("orchestrator", f"Quote result: {quote_result[:200]}...")
 
         # Step 3: Sales Processing
-        print_agent_banner("Sales", "Recording transactions")
-        sales_task = (
-            f"Process and record sales transactions for all available items. "
-            f"You MUST call record_sale for each item that is in stock. "
-            f"Use the EXACT inventory item names.\n\n"
-            f"Customer request: {request_text}\n\n"
-            f"Inventory status: {inv_result}\n\n"
-            f"Approved quote: {quote_result}"
-        )
-        sales_result = str(sales_agent.run(sales_task))
+        with _stage_events("sales", metrics, on_event):
+            sales_result = _run_stage(
+                "sales", _sales_task(order_context, inv_result, quote_result), metrics, tool_cache
+            )
         print_step("orchestrator", f"Sales result: {sales_result[:200]}...")
 
         # Step 4: Compose Final Response
-        print_agent_banner("Orchestrator", "Composing customer response")
-        compose_task = (
-            f"Compose a professional customer-facing response for this request. "
-            f"Synthesize the information below into a warm, clear message.\n\n"
-            f"Customer request: {request_text}\n\n"
-            f"What we found in inventory: {inv_result}\n\n"
-            f"Price quote generated: {quote_result}\n\n"
-            f"Sales transactions processed: {sales_result}\n\n"
-            f"Include: items fulfilled, pricing, discounts applied, delivery dates, "
-            f"and any items we could not fulfill. Do NOT reveal internal system details."
-        )
-        response = str(orchestrator.run(compose_task))
-        return response
+        compose_task = _compose_task(request_text, inv_result, quote_result, sales_result)
+        with _stage_events("orchestrator", metrics, on_event):
+            if on_event is None:
+                return _run_stage("orchestrator", compose_task, metrics, tool_cache)
+            return _run_streaming_stage("orchestrator", compose_task, metrics, tool_cache, on_event)
     except Exception as e:
-        error_msg = (
-            "We apologize, but we were unable to fully process your request "
-            "at this time. Please try again or contact our support team."
-        )
-        print(f"\033[91m  Error during processing: {e}\033[0m")
-        return error_msg
+        progress_logger.error(f"Error during processing: {e}", extra={"kind": "error"})
+        return PIPELINE_ERROR_MESSAGE
+
+
+# ===================================================================================
+# Async Pipeline
+# Blocking SQLite helpers run on one dedicated database thread fed by a request queue,
+# and agent stages run in worker threads behind one asyncio lock per agent (the agents
+# keep per-run memory and cannot run two tasks at once). Requests waiting for the
+# database or an agent are plain coroutines, so thousands can be in flight on a single
+# core while the event loop stays responsive.
+# ===================================================================================
+
+class DatabaseThread:
+    """Runs blocking database calls on one dedicated thread, in submission order.
+
+    Each call runs in a copy of the caller's context, so the tenant, request and
+    tool-cache context variables apply on the database thread as well.
+    """
+
+    def __init__(self, name: str = "ledger-db"):
+        self.name = name
+        self._queue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.completed = 0
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._serve, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _serve(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            future, context, fn, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = context.run(fn, *args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            self.completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue `fn(*args, **kwargs)`; returns a concurrent.futures.Future of its result."""
+        from concurrent.futures import Future
+
+        self._ensure_started()
+        future = Future()
+        self._queue.put((future, contextvars.copy_context(), fn, args, kwargs))
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Await `fn(*args, **kwargs)` run on the database thread."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
+
+
+database_thread = DatabaseThread()
+
+
+async def get_stock_level_async(item_name: str, as_of_date: Union[str, datetime]) -> pd.DataFrame:
+    """Async variant of `get_stock_level`, run on the database thread."""
+    return await database_thread.run(get_stock_level, item_name, as_of_date)
+
+
+async def get_all_inventory_async(as_of_date: str) -> Dict[str, int]:
+    """Async variant of `get_all_inventory`, run on the database thread."""
+    return await database_thread.run(get_all_inventory, as_of_date)
+
+
+async def get_cash_balance_async(as_of_date: Union[str, datetime]) -> float:
+    """Async variant of `get_cash_balance`, run on the database thread."""
+    return await database_thread.run(get_cash_balance, as_of_date)
+
+
+async def create_transaction_async(
+    item_name: str,
+    transaction_type: str,
+    quantity: int,
+    price: float,
+    date: Union[str, datetime],
+    idempotency_key: Optional[str] = None,
+) -> int:
+    """Async variant of `create_transaction`, run on the database thread."""
+    return await database_thread.run(
+        create_transaction, item_name, transaction_type, quantity, price, date, idempotency_key
+    )
+
+
+async def search_quote_history_async(search_terms: List[str], limit: int = 5) -> List[Dict]:
+    """Async variant of `search_quote_history`, run on the database thread."""
+    return await database_thread.run(search_quote_history, search_terms, limit)
+
+
+class LoopLatencyMonitor:
+    """Measures event-loop lag: how late a timer set every `interval` seconds fires.
+
+    Use as `async with LoopLatencyMonitor() as monitor:` around the work to observe.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    async def _sample(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    async def __aenter__(self) -> "LoopLatencyMonitor":
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def summary(self) -> Dict[str, float]:
+        """p50, p99 and max lag in milliseconds."""
+        if not self.samples:
+            return {"samples": 0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+        lags = np.array(self.samples) * 1000
+        return {
+            "samples": len(lags),
+            "p50_ms": round(float(np.percentile(lags, 50)), 3),
+            "p99_ms": round(float(np.percentile(lags, 99)), 3),
+            "max_ms": round(float(lags.max()), 3),
+        }
+
+
+# Agent locks are created per event loop (asyncio locks cannot be shared across loops)
+_stage_locks: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _stage_lock(stage: str) -> asyncio.Lock:
+    locks = _stage_locks.setdefault(asyncio.get_running_loop(), {})
+    if stage not in locks:
+        locks[stage] = asyncio.Lock()
+    return locks[stage]
+
+
+async def _run_stage_async(stage: str, task: str, metrics: Dict, tool_cache: ToolCallCache) -> str:
+    async with _stage_lock(stage):
+        worker = asyncio.ensure_future(asyncio.to_thread(_run_stage, stage, task, metrics, tool_cache))
+        try:
+            return await asyncio.shield(worker)
+        finally:
+            # A cancelled request (e.g. a server timeout) cannot stop the agent's
+            # thread, so keep the agent locked until the thread is done with it
+            while not worker.done():
+                try:
+                    await asyncio.wait({worker})
+                except asyncio.CancelledError:
+                    pass
+            if not worker.cancelled():
+                worker.exception()
+
+
+async def _run_read_only_stage_async(stage: str, key, task: str, metrics: Dict, tool_cache: ToolCallCache) -> str:
+    result, shared = await single_flight.do_async(stage, key, _run_stage_async, stage, task, metrics, tool_cache)
+    _note_coalesced(stage, shared, metrics)
+    return result
+
+
+async def process_customer_request_async(
+    request_text: str,
+    use_parser: bool = True,
+    metrics: Optional[Dict] = None,
+) -> str:
+    """Asyncio variant of `process_customer_request`.
+
+    Parsing and the stock lookup run on the database thread; each agent stage
+    runs in a worker thread while holding that agent's lock, so concurrent
+    requests overlap across stages (one request quoting while the next checks
+    inventory) without sharing an agent's memory.
+
+    Args:
+        request_text: The full customer request text including date context.
+        use_parser: See `process_customer_request`.
+        metrics: See `process_customer_request`.
+
+    Returns:
+        A polished, customer-facing response string.
+    """
+    with correlation_scope(), tool_cache_scope() as tool_cache:
+        metrics = _start_request(request_text, metrics)
+        metrics["duplicate_calls_saved"] = tool_cache.saved
+        try:
+            order_context, order_key, quote_draft = await database_thread.run(
+                _order_context, request_text, use_parser, metrics
+            )
+
+            inv_result = await _run_read_only_stage_async(
+                "inventory", order_key, _inventory_task(order_context), metrics, tool_cache
+            )
+            print_step("orchestrator", f"Inventory result: {inv_result[:200]}...")
+
+            quote_result = await _run_read_only_stage_async(
+                "quoting",
+                (order_key, inv_result),
+                _quote_task(order_context, inv_result, quote_draft),
+                metrics,
+                tool_cache,
+            )
+            print_step("orchestrator", f"Quote result: {quote_result[:200]}...")
+
+            sales_result = await _run_stage_async(
+                "sales", _sales_task(order_context, inv_result, quote_result), metrics, tool_cache
+            )
+            print_step("orchestrator", f"Sales result: {sales_result[:200]}...")
+
+            return await _run_stage_async(
+                "orchestrator",
+                _compose_task(request_text, inv_result, quote_result, sales_result),
+                metrics,
+                tool_cache,
+            )
+        except Exception as e:
+            progress_logger.error(f"Error during processing: {e}", extra={"kind": "error"})
+            return PIPELINE_ERROR_MESSAGE
+
+
+# ===================================================================================
+# Result Persistence
+# Results are appended to test_results.csv as each request completes instead of
+# being buffered in memory until the end of the batch, so a crash loses at most
+# the request in flight and memory stays flat regardless of batch size.
+# ===================================================================================
+
+RESULT_COLUMNS = [
+    "request_id", "request_date", "customer_role", "event_type", "order_size",
+    "cash_balance", "inventory_value", "response", "tool_calls", "parser",
+]
+
+
+class ResultsWriter:
+    """Append-only CSV sink that makes every result durable as soon as it is written."""
+
+    def __init__(self, path: str = "test_results.csv", resume: bool = False):
+        self.path = path
+        self.rows_written = 0
+        fresh = not resume or not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "w" if fresh else "a", newline="", encoding="utf-8")
+        if fresh:
+            self._write_line(RESULT_COLUMNS, header=True)
+
+    def _write_line(self, values: List, header: bool = False) -> None:
+        # Render the whole row first so it reaches the file in a single write
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        self._file.write(buffer.getvalue())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if not header:
+            self.rows_written += 1
+
+    def append(self, result: Dict) -> None:
+        """Persist one result row (keys from RESULT_COLUMNS)."""
+        self._write_line([result.get(column, "") for column in RESULT_COLUMNS])
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "ResultsWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def iter_results(path: str = "test_results.csv", chunksize: int = 1000):
+    """Stream saved results as DataFrames of at most `chunksize` rows.
+
+    Args:
+        path: Results CSV written by ResultsWriter.
+        chunksize: Maximum rows held in memory at once.
+
+    Yields:
+        pd.DataFrame chunks in file order.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    yield from pd.read_csv(path, chunksize=chunksize)
+
+
+def completed_request_ids(path: str = "test_results.csv") -> set:
+    """Return the request ids already recorded in a results file."""
+    completed = set()
+    for chunk in iter_results(path):
+        completed.update(int(request_id) for request_id in chunk["request_id"])
+    return completed
 
 
 # Test Runner
 
-def run_test_scenarios():
+def run_test_scenarios(
+    resume: bool = False,
+    results_path: str = "test_results.csv",
+    tune_steps: bool = False,
+    requests_path: str = "quote_requests_sample.csv",
+    use_parser: bool = True,
+    auto_reorder: bool = False,
+) -> List[Dict]:
     """Execute the full test suite using quote_requests_sample.csv.
 
     Processes each customer request through the multi-agent system,
-    tracks financial changes, and saves results to test_results.csv.
+    tracks financial changes, and appends each result to test_results.csv
+    as soon as the request completes. Every request is journaled, so an
+    interrupted run picks up where it stopped.
+
+    Args:
+        resume: Continue the latest unfinished run: keep the existing ledger and skip
+            the requests the journal or the results file marks completed. By
+            default the run starts over.
+        results_path: Where results are streamed.
+        tune_steps: Save the step budgets recommended from this run's agent traces
+            to step_budgets.json, which is applied on startup.
+        requests_path: CSV of customer requests to process.
+        use_parser: Passed to process_customer_request. Recording a run with and
+            without the parser measures the tool calls the parser saves.
+        auto_reorder: After each request, also place the stock orders planned by
+            plan_stock_reorders. Off by default: the agents' own orders are the
+            only ones recorded.
+
+    Returns:
+        List[Dict]: Every result in the results file, one dict per request, read back
+        from disk once the run ends (including those of a resumed run's earlier launch).
     """
-    
-    print("Initializing Database...")
-    init_database(db_engine)
+
+    engine = get_engine()
+    ensure_run_journal(engine)
+    run_id = latest_unfinished_run() if resume else None
+    completed = set()
+    if resume:
+        completed = completed_request_ids(results_path)
+        if run_id:
+            completed |= completed_journal_requests(run_id)
+    if run_id or completed:
+        print(f"Resuming: {len(completed)} request(s) already completed, keeping the existing database")
+        ensure_ledger_schema(engine)
+    else:
+        # Starting over abandons any interrupted run; left open, a later --resume would pick it up
+        closed = close_unfinished_runs()
+        if closed:
+            print(f"Closed {closed} unfinished run(s)")
+        print("Initializing Database...")
+        init_database(engine)
+    run_id = run_id or start_batch_run()
+    demand_forecasters.get().fit()
+    stock_counters.get().reset()
 
     # Load and prepare test data
     try:
-        quote_requests_sample = pd.read_csv("quote_requests_sample.csv")
+        quote_requests_sample = pd.read_csv(requests_path)
         quote_requests_sample["request_date"] = pd.to_datetime(
             quote_requests_sample["request_date"], format="%m/%d/%y", errors="coerce"
         )
@@ -1249,60 +6061,83 @@ def run_test_scenarios():
         quote_requests_sample = quote_requests_sample.sort_values("request_date")
     except Exception as e:
         print(f"FATAL: Error loading test data: {e}")
-        return
+        return 0
 
     # Get initial state
     initial_date = quote_requests_sample["request_date"].min().strftime("%Y-%m-%d")
-    report = generate_financial_report(initial_date)
+    report = reporting_backend.financial_report(initial_date)
     current_cash = report["cash_balance"]
     current_inventory = report["inventory_value"]
 
     print(f"\nInitial Cash Balance: ${current_cash:,.2f}")
     print(f"Initial Inventory Value: ${current_inventory:,.2f}")
-    print(f"Total Requests to Process: {len(quote_requests_sample)}")
-
-    # Process each customer request
-    results = []
-    for idx, row in quote_requests_sample.iterrows():
-        request_date = row["request_date"].strftime("%Y-%m-%d")
-
-        print(f"\n=== Request {idx+1} ===")
-        print(f"Context: {row['job']} organizing {row['event']} Size: {row['need_size']}")
-        print(f"Request Date: {request_date}")
-        print(f"Cash Balance: ${current_cash:.2f}")
-        print(f"Inventory Value: ${current_inventory:.2f}")
-
-        # Process request
-        request_with_date = f"{row['request']} (Date of request: {request_date})"
-
-        # Process through multi-agent system
-        response = process_customer_request(request_with_date)
-
-        # Update state
-        report = generate_financial_report(request_date)
-        current_cash = report["cash_balance"]
-        current_inventory = report["inventory_value"]
-
-        print(f"Response: {response}")
-        print(f"Updated Cash: ${current_cash:.2f}")
-        print(f"Updated Inventory: ${current_inventory:.2f}")
-
-        results.append({
-            "request_id": len(results) + 1,
-            "request_date": request_date,
-            "customer_role": row["job"],
-            "event_type": row["event"],
-            "order_size": row["need_size"],
-            "cash_balance": current_cash,
-            "inventory_value": current_inventory,
-            "response": response,
-        })
-
-        time.sleep(1)
+    print(f"Total Requests to Process: {len(quote_requests_sample) - len(completed)}")
+
+    # Process each customer request, persisting each result as it completes
+    with ResultsWriter(results_path, resume=bool(completed)) as results_writer:
+        for request_id, (idx, row) in enumerate(quote_requests_sample.iterrows(), start=1):
+            if request_id in completed:
+                continue
+            request_date = row["request_date"].strftime("%Y-%m-%d")
+
+            print(f"\n=== Request {idx+1} ===")
+            print(f"Context: {row['job']} organizing {row['event']} Size: {row['need_size']}")
+            print(f"Request Date: {request_date}")
+            print(f"Cash Balance: ${current_cash:.2f}")
+            print(f"Inventory Value: ${current_inventory:.2f}")
+
+            # Process request
+            request_with_date = f"{row['request']} (Date of request: {request_date})"
+
+            # Process through multi-agent system; ledger writes are keyed to this request
+            journal_request(run_id, request_id, "started")
+            request_metrics = {}
+            with request_scope(run_id, request_id) as request_context:
+                response = process_customer_request(request_with_date, use_parser=use_parser, metrics=request_metrics)
+
+                if auto_reorder:
+                    # Restock every item projected to run short before a supplier delivery
+                    # arrives. Orders still on their way are dated at their delivery, so the
+                    # budget is the cash left once every order placed so far has been paid
+                    committed_through = str(
+                        np.datetime64(request_date, "D") + np.timedelta64(int(SUPPLIER_LEAD_TIME_DAYS.max()), "D")
+                    )
+                    reorder_plan = plan_stock_reorders(request_date, max_spend=get_cash_balance(committed_through))
+                    if not reorder_plan.empty:
+                        place_stock_orders(reorder_plan)
+                        print(
+                            f"Auto-reorder: {len(reorder_plan)} item(s) for "
+                            f"${reorder_plan['total_cost'].sum():,.2f}"
+                        )
+
+            # Update state
+            report = reporting_backend.financial_report(request_date)
+            current_cash = report["cash_balance"]
+            current_inventory = report["inventory_value"]
+
+            flush_logs()
+            print(f"Response: {response}")
+            print(f"Updated Cash: ${current_cash:.2f}")
+            print(f"Updated Inventory: ${current_inventory:.2f}")
+
+            results_writer.append({
+                "request_id": request_id,
+                "request_date": request_date,
+                "customer_role": row["job"],
+                "event_type": row["event"],
+                "order_size": row["need_size"],
+                "cash_balance": current_cash,
+                "inventory_value": current_inventory,
+                "response": response,
+                "tool_calls": sum(request_metrics["tool_calls"].values()),
+                "parser": use_parser,
+            })
+            journal_request(run_id, request_id, "completed", request_context.transaction_ids)
+    finish_batch_run(run_id)
 
     # Final report
     final_date = quote_requests_sample["request_date"].max().strftime("%Y-%m-%d")
-    final_report = generate_financial_report(final_date)
+    final_report = reporting_backend.financial_report(final_date)
     print("\n===== FINAL FINANCIAL REPORT =====")
     print(f"Final Cash: ${final_report['cash_balance']:.2f}")
     print(f"Final Inventory: ${final_report['inventory_value']:.2f}")
@@ -1326,24 +6161,1093 @@ def run_test_scenarios():
             print(f"    - {name}: {units} units, ${revenue:,.2f}")
 
 
-    # Save results
-    pd.DataFrame(results).to_csv("test_results.csv", index=False)
+    # Summarize saved results without loading them all at once
+    total_results, total_tool_calls = 0, 0
+    for chunk in iter_results(results_path):
+        total_results += len(chunk)
+        total_tool_calls += chunk["tool_calls"].sum()
+    if total_results:
+        # Compare against a --no-parser run of the same requests for the calls the parser saves
+        print(
+            f"\n  Tool calls per request: {total_tool_calls / total_results:.1f} "
+            f"(request parser {'on' if use_parser else 'off'})"
+        )
+    if TOOL_CACHE_SAVINGS:
+        saved = ", ".join(f"{agent}: {count}" for agent, count in sorted(TOOL_CACHE_SAVINGS.items()))
+        print(f"  Duplicate tool calls saved by memoization: {sum(TOOL_CACHE_SAVINGS.values())} ({saved})")
+    coalescing = {group: stats for group, stats in single_flight.stats.items() if stats["coalesced"]}
+    if coalescing:
+        shared = ", ".join(
+            f"{group}: {stats['coalesced']}/{stats['calls']} ({stats['coalesced_fraction']:.0%})"
+            for group, stats in sorted(coalescing.items())
+        )
+        print(f"  Concurrent calls coalesced: {shared}")
+    limiter_stats = model_rate_limiter.stats
+    print(
+        f"  Model calls: {limiter_stats['calls']} "
+        f"(retried: {limiter_stats['retries']}, rate-limited: {limiter_stats['throttled']}, "
+        f"failed: {limiter_stats['failed']}, queued: {limiter_stats['wait_seconds']:.1f}s)"
+    )
 
     # Business Advisor analysis after all requests (Stand-out Feature)
     print_section_header("Business Advisor Analysis")
     try:
         advisor_insights = advisor_agent.run(
             f"Analyze the business performance as of {final_date}. "
-            f"We just processed {len(results)} customer orders. "
+            f"We just processed {total_results} customer orders. "
             "Provide key insights on revenue, inventory status, and two "
             "actionable recommendations for improving operations."
         )
+        flush_logs()
         print(f"\n{advisor_insights}")
+        step_profiler.record("advisor", advisor_agent)
     except Exception as e:
         print(f"  Advisor analysis unavailable: {e}")
 
+    # Step usage per agent; with tune_steps the recommended budgets apply from the next run
+    step_summary = step_profiler.summary()
+    if not step_summary.empty:
+        print_section_header("Agent Step Profile")
+        print(step_summary.to_string())
+        recommended = step_profiler.recommend_budgets()
+        print(f"\n  Recommended step budgets: {recommended}")
+        if tune_steps:
+            save_step_budgets(recommended)
+            print(f"  Saved to {STEP_BUDGETS_PATH}; they apply from the next run")
+
+    return [record for chunk in iter_results(results_path) for record in chunk.to_dict(orient="records")]
+
+
+# ===================================================================================
+# Record / Replay
+# A cassette (JSON lines) captures every model request/response and every tool call
+# with its output during a batch run, plus fingerprints of the final ledger and the
+# results file. Replaying serves the model from the cassette (no network, no rate
+# limit) while tools, caches and the database run for real, so pipeline changes can
+# be timed in isolation; the run fails verification if its tool outputs, ledger or
+# results differ from the recording.
+# ===================================================================================
+
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(Exception):
+    """Replay asked for a model response the cassette does not contain."""
+
+
+def _message_dict(message) -> Dict:
+    """The parts of a chat message that identify a request or reproduce a response."""
+    if isinstance(message, dict):
+        role, content, tool_calls = message.get("role"), message.get("content"), message.get("tool_calls")
+    else:
+        role, content, tool_calls = message.role, message.content, message.tool_calls
+    return {
+        "role": getattr(role, "value", role),
+        "content": content,
+        "tool_calls": [
+            {
+                "id": call.id,
+                "type": call.type,
+                "function": {"name": call.function.name, "arguments": call.function.arguments},
+            }
+            for call in tool_calls or []
+        ] or None,
+    }
+
+
+def _usage_dict(token_usage: Optional[TokenUsage]) -> Optional[Dict]:
+    if token_usage is None:
+        return None
+    return {"input_tokens": token_usage.input_tokens, "output_tokens": token_usage.output_tokens}
+
+
+def _usage_from_dict(data: Optional[Dict]) -> Optional[TokenUsage]:
+    return TokenUsage(**data) if data else None
+
+
+def _delta_dict(delta: ChatMessageStreamDelta) -> Dict:
+    return {
+        "content": delta.content,
+        "tool_calls": [
+            {
+                "index": call.index,
+                "id": call.id,
+                "type": call.type,
+                "function": {"name": call.function.name, "arguments": call.function.arguments}
+                if call.function else None,
+            }
+            for call in delta.tool_calls or []
+        ] or None,
+        "token_usage": _usage_dict(delta.token_usage),
+    }
+
+
+def _delta_from_dict(data: Dict) -> ChatMessageStreamDelta:
+    return ChatMessageStreamDelta(
+        content=data["content"],
+        tool_calls=[
+            ChatMessageToolCallStreamDelta(
+                index=call["index"],
+                id=call["id"],
+                type=call["type"],
+                function=ChatMessageToolCallFunction(**call["function"]) if call["function"] else None,
+            )
+            for call in data["tool_calls"] or []
+        ] or None,
+        token_usage=_usage_from_dict(data["token_usage"]),
+    )
+
+
+def _deltas_from_message(message: ChatMessage) -> List[ChatMessageStreamDelta]:
+    """Stream deltas that agglomerate back into `message`: its content, then each tool call whole."""
+    deltas = [ChatMessageStreamDelta(content=message.content)] if message.content else []
+    for index, call in enumerate(message.tool_calls or []):
+        arguments = call.function.arguments
+        deltas.append(ChatMessageStreamDelta(tool_calls=[ChatMessageToolCallStreamDelta(
+            index=index,
+            id=call.id,
+            type=call.type,
+            function=ChatMessageToolCallFunction(
+                name=call.function.name,
+                arguments=arguments if isinstance(arguments, str) else json.dumps(arguments),
+            ),
+        )]))
+    deltas.append(ChatMessageStreamDelta(token_usage=message.token_usage))
+    return deltas
+
+
+class Cassette:
+    """Model calls and tool I/O of one run, recorded to or replayed from a JSON-lines file.
+
+    Model responses are looked up by a hash of the request (messages and tools).
+    When a request was not recorded verbatim (e.g. a prompt changed), replay falls
+    back to the calling agent's next unused response, in recorded order, and counts
+    it in `stats["unmatched_model_calls"]`; with `strict=True` it raises CassetteMiss.
+    """
+
+    def __init__(self, path: str, mode: str = "replay", strict: bool = False):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode '{mode}'")
+        self.path = path
+        self.mode = mode
+        self.strict = strict
+        self._lock = threading.Lock()
+        self.stats = {"model_calls": 0, "unmatched_model_calls": 0, "tool_calls": 0, "tool_mismatches": 0}
+        self.mismatches: List[Dict] = []
+        self.fingerprints: Dict[str, str] = {}
+        self._file = None
+        self._by_request: Dict[str, List[Dict]] = {}
+        self._by_agent: Dict[str, List[Dict]] = {}
+        self._tool_outputs: Dict[str, List[str]] = {}
+        if mode == "record":
+            self._file = open(path, "w", encoding="utf-8")
+            self._write({"type": "cassette", "version": CASSETTE_VERSION, "created": _journal_timestamp()})
+        else:
+            self._load()
+
+    def _write(self, entry: Dict) -> None:
+        self._file.write(json.dumps(entry, default=str) + "\n")
+        self._file.flush()
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["type"] == "model":
+                    entry["used"] = False
+                    self._by_request.setdefault(entry["request"], []).append(entry)
+                    self._by_agent.setdefault(entry["agent"], []).append(entry)
+                elif entry["type"] == "tool":
+                    self._tool_outputs.setdefault(entry["call"], []).append(entry["output"])
+                elif entry["type"] == "fingerprints":
+                    self.fingerprints = entry["fingerprints"]
+
+    @staticmethod
+    def request_key(messages, tools_to_call_from) -> tuple:
+        """(agent key, request hash): agents are told apart by the tools they may call."""
+        tool_names = sorted(tool.name for tool in tools_to_call_from or [])
+        agent = hashlib.sha1(",".join(tool_names).encode()).hexdigest()[:12]
+        payload = json.dumps([[_message_dict(m) for m in messages], tool_names], sort_keys=True, default=str)
+        return agent, hashlib.sha256(payload.encode()).hexdigest()
+
+    def record_model(self, key: tuple, response: Optional[ChatMessage] = None, deltas=None) -> None:
+        entry = {"type": "model", "agent": key[0], "request": key[1]}
+        if deltas is not None:
+            entry["deltas"] = [_delta_dict(delta) for delta in deltas]
+        else:
+            entry["response"] = _message_dict(response)
+            entry["token_usage"] = _usage_dict(response.token_usage)
+        with self._lock:
+            self.stats["model_calls"] += 1
+            self._write(entry)
+
+    def replay_model(self, key: tuple) -> Dict:
+        """The recorded entry answering this request."""
+        with self._lock:
+            self.stats["model_calls"] += 1
+            for entry in self._by_request.get(key[1], ()):
+                if not entry["used"]:
+                    entry["used"] = True
+                    return entry
+            if not self.strict:
+                for entry in self._by_agent.get(key[0], ()):
+                    if not entry["used"]:
+                        entry["used"] = True
+                        self.stats["unmatched_model_calls"] += 1
+                        return entry
+        raise CassetteMiss(f"No recorded model response for request {key[1][:12]}")
+
+    def tool_call(self, call: str, output) -> None:
+        """Record a tool's output, or check it against the recording."""
+        output = str(output)
+        with self._lock:
+            self.stats["tool_calls"] += 1
+            if self.mode == "record":
+                self._write({"type": "tool", "call": call, "output": output})
+                return
+            recorded = self._tool_outputs.get(call)
+            expected = recorded.pop(0) if recorded else None
+            if expected != output:
+                self.stats["tool_mismatches"] += 1
+                if len(self.mismatches) < 10:
+                    self.mismatches.append({"call": call, "recorded": expected, "replayed": output})
+
+    def close(self, fingerprints: Optional[Dict[str, str]] = None) -> None:
+        if self._file is not None:
+            if fingerprints:
+                self._write({"type": "fingerprints", "fingerprints": fingerprints})
+            self._file.close()
+            self._file = None
+
+
+class CassetteModel(Model):
+    """Backing model that records every call to a cassette, or answers from it on replay."""
+
+    def __init__(self, cassette: Cassette, model: Optional[Model] = None):
+        super().__init__(model_id=getattr(model, "model_id", None) or "cassette")
+        if cassette.mode == "record" and model is None:
+            raise ValueError("Recording needs the model to record")
+        self.cassette = cassette
+        self.model = model
+
+    def generate(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+        key = Cassette.request_key(messages, tools_to_call_from)
+        if self.cassette.mode == "replay":
+            entry = self.cassette.replay_model(key)
+            if "deltas" in entry:
+                return agglomerate_stream_deltas([_delta_from_dict(delta) for delta in entry["deltas"]])
+            return ChatMessage.from_dict(dict(entry["response"]), token_usage=_usage_from_dict(entry["token_usage"]))
+        response = self.model.generate(
+            messages, stop_sequences=stop_sequences, response_format=response_format,
+            tools_to_call_from=tools_to_call_from, **kwargs,
+        )
+        self.cassette.record_model(key, response)
+        return response
+
+    def generate_stream(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+        key = Cassette.request_key(messages, tools_to_call_from)
+        if self.cassette.mode == "replay":
+            entry = self.cassette.replay_model(key)
+            if "deltas" in entry:
+                for delta in entry["deltas"]:
+                    yield _delta_from_dict(delta)
+                return
+            # Recorded through generate(): stream the whole message, tool calls included
+            response = ChatMessage.from_dict(dict(entry["response"]), token_usage=_usage_from_dict(entry["token_usage"]))
+            yield from _deltas_from_message(response)
+            return
+        deltas = []
+        for delta in self.model.generate_stream(
+            messages, stop_sequences=stop_sequences, response_format=response_format,
+            tools_to_call_from=tools_to_call_from, **kwargs,
+        ):
+            deltas.append(delta)
+            yield delta
+        self.cassette.record_model(key, deltas=deltas)
+
+
+# The cassette tools report to while a run is recorded or replayed
+active_cassette: Optional[Cassette] = None
+
+
+def _capture_tool_io(tool_instance):
+    """Report every call of the tool, with its output, to the active cassette."""
+    forward = tool_instance.forward
+
+    def captured_forward(*args, **kwargs):
+        result = forward(*args, **kwargs)
+        cassette = active_cassette
+        if cassette is not None:
+            call = json.dumps([tool_instance.name, args, kwargs], sort_keys=True, default=str)
+            cassette.tool_call(call, result)
+        return result
+
+    tool_instance.forward = captured_forward
+    return tool_instance
+
+
+for _tool in {id(t): t for agent in AGENTS.values() for t in agent.tools.values()}.values():
+    if _tool.name != "final_answer":
+        _capture_tool_io(_tool)
+
+
+def ledger_fingerprint(engine: Optional[Engine] = None) -> str:
+    """Hash of every ledger entry's item, type, units, price and date, in insertion order."""
+    digest = hashlib.sha256()
+    with (engine or get_engine()).connect() as conn:
+        rows = conn.execute(text(
+            "SELECT item_name, transaction_type, units, price, transaction_date FROM transactions ORDER BY rowid"
+        ))
+        for row in rows:
+            digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+
+def file_fingerprint(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def _cassette_run(cassette: Cassette, backing_model: Optional[Model]):
+    global active_cassette
+    previous_model, previous_rpm = model, model_rate_limiter.rate * 60
+    set_backing_model(CassetteModel(cassette, backing_model))
+    if cassette.mode == "replay":
+        model_rate_limiter.set_rate(1e9)  # nothing reaches the provider
+    active_cassette = cassette
+    try:
+        yield cassette
+    finally:
+        active_cassette = None
+        set_backing_model(previous_model)
+        model_rate_limiter.set_rate(previous_rpm)
+
+
+def record_run(cassette_path: str, results_path: str = "test_results.csv", **run_kwargs) -> Dict:
+    """Run a fresh batch on the current model and record it to `cassette_path`.
+
+    Args:
+        cassette_path: Where the cassette is written.
+        results_path: Passed to run_test_scenarios.
+        **run_kwargs: Other run_test_scenarios arguments (resume is always False).
+
+    Returns:
+        Dict: Run time, recorded model and tool calls, and the ledger/results fingerprints.
+    """
+    cassette = Cassette(cassette_path, "record")
+    fingerprints = {}
+    try:
+        with _cassette_run(cassette, model):
+            start = time.perf_counter()
+            run_test_scenarios(resume=False, results_path=results_path, **run_kwargs)
+            seconds = time.perf_counter() - start
+        fingerprints = {"ledger": ledger_fingerprint(), "results": file_fingerprint(results_path)}
+    finally:
+        cassette.close(fingerprints)
+    return {"seconds": round(seconds, 3), **cassette.stats, **fingerprints}
+
+
+def replay_run(
+    cassette_path: str, results_path: Optional[str] = None, strict: bool = False, **run_kwargs
+) -> Dict:
+    """Re-execute a recorded batch with model responses from the cassette and verify it.
+
+    Args:
+        cassette_path: A cassette written by record_run.
+        results_path: Passed to run_test_scenarios. Defaults to `<cassette_path>.results.csv`,
+            so a replay never overwrites the results of a real run.
+        strict: Fail on model requests that were not recorded verbatim.
+        **run_kwargs: Other run_test_scenarios arguments (resume is always False).
+
+    Returns:
+        Dict: Run time, model/tool call counts and mismatches, and 'ledger_match',
+        'results_match' and 'verified' (everything matched the recording).
+    """
+    results_path = results_path or f"{cassette_path}.results.csv"
+    cassette = Cassette(cassette_path, "replay", strict=strict)
+    with _cassette_run(cassette, None):
+        start = time.perf_counter()
+        run_test_scenarios(resume=False, results_path=results_path, **run_kwargs)
+        seconds = time.perf_counter() - start
+    recorded = cassette.fingerprints
+    report = {
+        "seconds": round(seconds, 3),
+        **cassette.stats,
+        "ledger_match": recorded.get("ledger") == ledger_fingerprint(),
+        "results_match": recorded.get("results") == file_fingerprint(results_path),
+    }
+    report["verified"] = (
+        report["ledger_match"] and report["results_match"]
+        and not report["tool_mismatches"] and not report["unmatched_model_calls"]
+    )
+    for mismatch in cassette.mismatches:
+        logger.warning("Tool output differs from the recording for %s", mismatch["call"])
+    return report
+
+
+# ===================================================================================
+# Sharded Batch Runs
+# Each tenant's batch runs in its own worker process against its own shard, so
+# stores are processed in parallel on separate cores without sharing a write lock.
+# The provider rate limit is split evenly between the worker processes.
+# ===================================================================================
+
+def _run_tenant_batch(
+    tenant: str, requests_path: str, requests_per_minute: float, resume: bool, auto_reorder: bool
+):
+    """Worker: run one tenant's batch against its shard."""
+    model_rate_limiter.set_rate(requests_per_minute)
+    with tenant_scope(tenant):
+        results = run_test_scenarios(
+            resume=resume,
+            auto_reorder=auto_reorder,
+            results_path=f"test_results_{tenant}.csv",
+            requests_path=requests_path,
+        )
+    # Only the count crosses the process boundary; the rows are in the tenant's results file
+    return tenant, len(results)
+
+
+def run_sharded_batches(
+    tenant_requests: Dict[str, str],
+    processes: Optional[int] = None,
+    resume: bool = False,
+    auto_reorder: bool = False,
+) -> Dict[str, int]:
+    """Run the batches of many tenants in parallel, one process per shard at a time.
+
+    Args:
+        tenant_requests: Tenant id -> CSV of that tenant's customer requests.
+        processes: Worker processes (defaults to the CPU count, at most one per tenant).
+        resume: Passed to each tenant's run_test_scenarios.
+        auto_reorder: Passed to each tenant's run_test_scenarios.
+
+    Returns:
+        Tenant id -> number of results recorded in `test_results_<tenant>.csv`.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    for tenant in tenant_requests:
+        shard_router.shard_path(tenant)  # validate ids before starting any worker
+    processes = max(1, min(processes or os.cpu_count() or 1, len(tenant_requests)))
+    rate_share = model_rate_limiter.rate * 60 / processes
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [
+            pool.submit(_run_tenant_batch, tenant, requests_path, rate_share, resume, auto_reorder)
+            for tenant, requests_path in tenant_requests.items()
+        ]
+        for future in futures:
+            tenant, total = future.result()
+            results[tenant] = total
+            print(f"Tenant {tenant}: {total} result(s)")
     return results
 
 
+# ===================================================================================
+# Profiling
+# `--profile[=DIR]` runs the batch inside a ProfilingSession: each pipeline stage
+# (parse, inventory, quoting, sales, orchestrator) gets its own cProfile profile, a
+# sampling thread records wall-clock call stacks for flame graphs, SQLAlchemy cursor
+# events count and time every query by the helper that issued it, and tracemalloc
+# tracks peak memory. Add `--stub-model` to run the agents on the offline StubModel,
+# so the tool and database layer can be profiled without spending model tokens.
+# ===================================================================================
+
+# Directory written by a bare --profile
+PROFILE_DIR = "profile"
+# Seconds between stack samples
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# The session of the current --profile run, if any; pipeline stages report to it
+active_profile: Optional["ProfilingSession"] = None
+# Stage whose SQL queries are being counted (tool worker threads inherit it)
+profile_stage: contextvars.ContextVar[str] = contextvars.ContextVar("profile_stage", default="session")
+
+
+@dataclass
+class _StageEntry:
+    name: str
+    profile: Optional[cProfile.Profile]
+    start: float
+    memory: int
+
+
+class ProfilingSession:
+    """cProfile per stage, sampled stacks, SQL per helper and peak memory for one run.
+
+    Stages nest per thread: entering a stage pauses the enclosing stage's profile,
+    so each profile holds only its own stage's calls. Everything outside a stage on
+    the thread that started the session is profiled as "session".
+
+    Args:
+        output_dir: Directory for the per-stage .prof files, stacks.folded and summary.json.
+        sample_interval: Seconds between stack samples; 0 disables sampling.
+        trace_memory: Track allocations with tracemalloc (slows the run down noticeably).
+    """
+
+    def __init__(
+        self,
+        output_dir: str = PROFILE_DIR,
+        sample_interval: float = PROFILE_SAMPLE_INTERVAL,
+        trace_memory: bool = True,
+    ):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.profiles: Dict[str, List[cProfile.Profile]] = {}
+        self.stages: Dict[str, Dict] = {}
+        self.sql: Dict[tuple, List[float]] = {}
+        self.samples: Dict[str, int] = {}
+        self.summary: Dict = {}
+        self._thread_profiles: Dict[tuple, cProfile.Profile] = {}
+        self._stacks: Dict[int, List[_StageEntry]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._started_tracemalloc = False
+        self._session = None
+        self._started = 0.0
+
+    # ---- stages ----
+
+    def _profile_for(self, name: str) -> cProfile.Profile:
+        key = (threading.get_ident(), name)
+        with self._lock:
+            profile = self._thread_profiles.get(key)
+            if profile is None:
+                profile = self._thread_profiles[key] = cProfile.Profile()
+                self.profiles.setdefault(name, []).append(profile)
+        return profile
+
+    @staticmethod
+    def _enable(profile: Optional[cProfile.Profile]) -> Optional[cProfile.Profile]:
+        try:
+            profile.enable()
+            return profile
+        except ValueError:
+            # Python 3.12+ allows one active cProfile per interpreter; the stage is still timed
+            return None
+
+    def _enter(self, name: str) -> _StageEntry:
+        memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        return _StageEntry(name, self._enable(self._profile_for(name)), time.perf_counter(), memory)
+
+    def _exit(self, entry: _StageEntry) -> None:
+        if entry.profile is not None:
+            entry.profile.disable()
+        memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        with self._lock:
+            stats = self.stages.setdefault(entry.name, {"entries": 0, "seconds": 0.0, "net_alloc_bytes": 0})
+            stats["entries"] += 1
+            stats["seconds"] += time.perf_counter() - entry.start
+            stats["net_alloc_bytes"] += memory - entry.memory
+
+    @contextmanager
+    def stage(self, name: str):
+        """Profile the block as stage `name` on the current thread."""
+        stack = self._stacks.setdefault(threading.get_ident(), [])
+        if stack and stack[-1].profile is not None:
+            stack[-1].profile.disable()
+        entry = self._enter(name)
+        stack.append(entry)
+        token = profile_stage.set(name)
+        try:
+            yield entry
+        finally:
+            profile_stage.reset(token)
+            stack.pop()
+            self._exit(entry)
+            if stack:
+                stack[-1].profile = self._enable(stack[-1].profile)
+
+    # ---- SQL ----
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("profile_query_start")
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        # The helper is the innermost function of this module on the stack
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_globals is not globals():
+            frame = frame.f_back
+        key = (profile_stage.get(), frame.f_code.co_name if frame is not None else "(other)")
+        with self._lock:
+            totals = self.sql.setdefault(key, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    # ---- sampling ----
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.sample_interval):
+            for ident, frame in sys._current_frames().items():
+                stack = self._stacks.get(ident)
+                if ident == own or not stack:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                try:
+                    stage = stack[-1].name
+                except IndexError:
+                    continue
+                key = ";".join([stage] + names[::-1])
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    # ---- lifecycle ----
+
+    def start(self) -> "ProfilingSession":
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+        self._session = self.stage("session")
+        self._session.__enter__()
+        if self.sample_interval > 0:
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        self._started = time.perf_counter()
+        return self
+
+    def stop(self) -> Dict:
+        """Stop profiling, write the output files and return the summary."""
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self._session.__exit__(None, None, None)
+        event.remove(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(Engine, "after_cursor_execute", self._after_cursor_execute)
+        peak, top_allocations = 0, []
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            top_allocations = [
+                {"location": str(stat.traceback), "mb": round(stat.size / 1e6, 3), "blocks": stat.count}
+                for stat in tracemalloc.take_snapshot().statistics("lineno")[:10]
+            ]
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        self.summary = self._write(time.perf_counter() - self._started, peak, top_allocations)
+        return self.summary
+
+    def _write(self, seconds: float, peak: int, top_allocations: List[Dict]) -> Dict:
+        os.makedirs(self.output_dir, exist_ok=True)
+        functions: Dict[tuple, list] = {}
+        files = []
+        for name, profiles in self.profiles.items():
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            path = os.path.join(self.output_dir, f"{name}.prof")
+            stats.dump_stats(path)
+            files.append(path)
+            for (filename, line, function), (_, calls, self_seconds, cumulative, _) in stats.stats.items():
+                totals = functions.setdefault((name, f"{function} ({os.path.basename(filename)}:{line})"), [0, 0.0, 0.0])
+                totals[0] += calls
+                totals[1] += self_seconds
+                totals[2] += cumulative
+        if self.samples:
+            path = os.path.join(self.output_dir, "stacks.folded")
+            with open(path, "w") as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write(f"{stack} {count}\n")
+            files.append(path)
+
+        sql_by_stage: Dict[str, List[float]] = {}
+        for (stage, _), (count, sql_seconds) in self.sql.items():
+            totals = sql_by_stage.setdefault(stage, [0, 0.0])
+            totals[0] += count
+            totals[1] += sql_seconds
+        summary = {
+            "seconds": round(seconds, 3),
+            "peak_memory_mb": round(peak / 1e6, 2),
+            "stages": {
+                name: {
+                    "entries": stats["entries"],
+                    "seconds": round(stats["seconds"], 3),
+                    "sql_queries": sql_by_stage.get(name, [0, 0.0])[0],
+                    "sql_ms": round(sql_by_stage.get(name, [0, 0.0])[1] * 1000, 1),
+                    "net_alloc_mb": round(stats["net_alloc_bytes"] / 1e6, 2),
+                }
+                for name, stats in self.stages.items()
+            },
+            "sql_by_helper": sorted(
+                (
+                    {"stage": stage, "helper": helper, "queries": count, "ms": round(sql_seconds * 1000, 2)}
+                    for (stage, helper), (count, sql_seconds) in self.sql.items()
+                ),
+                key=lambda row: row["ms"], reverse=True,
+            ),
+            "top_functions": [
+                {"stage": stage, "function": function, "calls": calls,
+                 "self_ms": round(self_seconds * 1000, 2), "cumulative_ms": round(cumulative * 1000, 2)}
+                for (stage, function), (calls, self_seconds, cumulative) in sorted(
+                    functions.items(), key=lambda item: item[1][1], reverse=True
+                )[:25]
+            ],
+            "top_allocations": top_allocations,
+            "samples": sum(self.samples.values()),
+            "files": files,
+        }
+        path = os.path.join(self.output_dir, "summary.json")
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        summary["files"].append(path)
+        return summary
+
+
+def print_profile_report(summary: Dict) -> None:
+    """Print a profiling summary: stages, SQL per helper, hottest functions and memory."""
+    print_section_header("Profile")
+    print(pd.DataFrame.from_dict(summary["stages"], orient="index").to_string())
+    if summary["sql_by_helper"]:
+        print("\n  SQL by helper (top 10 by time):")
+        print(pd.DataFrame(summary["sql_by_helper"][:10]).to_string(index=False))
+    print("\n  Hottest functions by self time:")
+    print(pd.DataFrame(summary["top_functions"][:10]).to_string(index=False))
+    print(f"\n  Wall time: {summary['seconds']:.2f}s, peak traced memory: {summary['peak_memory_mb']:.1f} MB, "
+          f"{summary['samples']} stack samples")
+    print(f"  Wrote {', '.join(summary['files'])}")
+    print("  Open a .prof with `python -m pstats` or snakeviz; render stacks.folded with "
+          "flamegraph.pl or speedscope.")
+
+
+@contextmanager
+def profiling_session(output_dir: str = PROFILE_DIR, **options):
+    """Profile the block (see ProfilingSession); prints the report and writes the files on exit."""
+    global active_profile
+    session = ProfilingSession(output_dir, **options).start()
+    active_profile = session
+    try:
+        yield session
+    finally:
+        active_profile = None
+        print_profile_report(session.stop())
+
+
+# ===================================================================================
+# Server Mode
+# `--serve[=HOST:PORT]` keeps one process running, with the engine, agents, catalogs,
+# quote templates, ledger snapshot and caches warm, and accepts order requests over
+# HTTP:
+#   POST /requests  {"request": "...", "request_date": "2025-04-10"}
+#   GET  /health    liveness plus a database round trip
+#   GET  /metrics   request counts, latency percentiles, throughput and cache stats
+# Requests run through process_customer_request_async on one event loop thread, so
+# concurrent orders overlap across agent stages just as in the async pipeline.
+# ===================================================================================
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+# Completed requests whose latencies feed the /metrics percentiles
+SERVER_LATENCY_WINDOW = 1000
+# Seconds a request may run before the server answers 504
+SERVER_REQUEST_TIMEOUT = float(os.getenv("SERVER_REQUEST_TIMEOUT", "300"))
+SERVER_RUN_ID = "server"    # Idempotency keys of server requests are server:<request_id>:...
+
+
+class ServerMetrics:
+    """Request counters and a rolling window of completed-request latencies."""
+
+    def __init__(self, window: int = SERVER_LATENCY_WINDOW):
+        self.started_at = time.time()
+        self.received = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self._finished: deque = deque(maxlen=window)  # (finished_at, seconds)
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            self.received += 1
+            self.in_flight += 1
+
+    def finish(self, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            if ok:
+                self.completed += 1
+                self._finished.append((time.time(), seconds))
+            else:
+                self.failed += 1
+
+    def reject(self) -> None:
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            finished = list(self._finished)
+            counts = {
+                "received": self.received, "completed": self.completed, "failed": self.failed,
+                "rejected": self.rejected, "in_flight": self.in_flight,
+            }
+        uptime = time.time() - self.started_at
+        latencies = np.array([seconds for _, seconds in finished]) * 1000
+        window_seconds = finished[-1][0] - finished[0][0] if len(finished) > 1 else 0.0
+        return {
+            "uptime_seconds": round(uptime, 1),
+            **counts,
+            "requests_per_second": round(counts["completed"] / uptime, 3) if uptime else 0.0,
+            # Throughput over the latency window, i.e. the recent sustained rate
+            "window_requests_per_second": round((len(finished) - 1) / window_seconds, 3) if window_seconds else 0.0,
+            "latency_ms": {
+                f"p{q}": round(float(np.percentile(latencies, q)), 1) for q in (50, 95, 99)
+            } if len(latencies) else {},
+        }
+
+
+class PipelineService:
+    """The warm pipeline behind the HTTP server: an event loop thread running
+    process_customer_request_async, plus the server's metrics.
+
+    Args:
+        request_timeout: Seconds to wait for one request before giving up on it.
+    """
+
+    def __init__(self, request_timeout: float = SERVER_REQUEST_TIMEOUT):
+        self.request_timeout = request_timeout
+        self.metrics = ServerMetrics()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="pipeline-loop", daemon=True)
+        self._thread.start()
+
+    def warm_up(self) -> Dict:
+        """Pay the startup costs once: ledger schema, catalog, quote templates and
+        history, stock counters and the ledger snapshot. Initializes the database
+        only if it has no inventory yet."""
+        start = time.perf_counter()
+        engine = get_engine()
+        with engine.connect() as conn:
+            tables = _table_names(conn)
+        if "inventory" not in tables:
+            init_database(engine)
+        ensure_ledger_schema(engine)
+        get_inventory_catalog()
+        quote_archives.get()
+        if QUOTE_DRAFTS_ENABLED:
+            quote_templates.get()._ensure_built()
+        for item_name in get_inventory_catalog().names:
+            stock_counters.get().available(item_name)
+        get_ledger_snapshot()
+        seconds = time.perf_counter() - start
+        logger.info("Pipeline warm in %.2fs", seconds)
+        return {"warm_up_seconds": round(seconds, 3)}
+
+    @staticmethod
+    async def _process(request_text: str, request_id: str, use_parser: bool, metrics: Dict) -> str:
+        # Inside the coroutine, so the scope is in the context its stage threads copy
+        with request_scope(SERVER_RUN_ID, request_id):
+            return await process_customer_request_async(request_text, use_parser=use_parser, metrics=metrics)
+
+    def submit(self, request_text: str, request_id: str, use_parser: bool = True) -> tuple:
+        """Run one request on the event loop; returns (response, metrics, seconds).
+
+        Ledger writes carry idempotency keys derived from `request_id`, so a
+        request submitted again with the same id returns the sales it already
+        recorded instead of recording them twice.
+
+        Raises:
+            TimeoutError: If the request takes longer than `request_timeout`. The
+                request is cancelled: stages it has not started are skipped, and
+                the agent stage already running finishes in its thread, keeping
+                that agent's lock until it does. A sales stage that was running
+                may still commit sales after the timeout.
+        """
+        metrics: Dict = {"request_id": request_id}
+        self.metrics.start()
+        start = time.perf_counter()
+        ok = False
+        future = asyncio.run_coroutine_threadsafe(
+            self._process(request_text, request_id, use_parser, metrics), self.loop
+        )
+        try:
+            response = future.result(self.request_timeout)
+            ok = response != PIPELINE_ERROR_MESSAGE
+            return response, metrics, time.perf_counter() - start
+        except TimeoutError:
+            future.cancel()
+            raise
+        finally:
+            self.metrics.finish(time.perf_counter() - start, ok)
+
+    def health(self) -> Dict:
+        """Liveness with a database round trip."""
+        try:
+            with get_engine().connect() as conn:
+                conn.exec_driver_sql("SELECT 1")
+            database = "ok"
+        except Exception as e:
+            database = f"error: {e}"
+        return {
+            "status": "ok" if database == "ok" and self._thread.is_alive() else "degraded",
+            "database": database,
+            "event_loop": self._thread.is_alive(),
+            "in_flight": self.metrics.in_flight,
+            "uptime_seconds": round(time.time() - self.metrics.started_at, 1),
+        }
+
+    def snapshot(self) -> Dict:
+        """Everything /metrics reports."""
+        return {
+            "requests": self.metrics.snapshot(),
+            "model": model_rate_limiter.stats,
+            "coalescing": single_flight.stats,
+            "quote_templates": quote_templates.get().summary(),
+            "database_thread_calls": database_thread.completed,
+        }
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+        database_thread.shutdown()
+
+
+class _PipelineRequestHandler(http.server.BaseHTTPRequestHandler):
+    """JSON endpoints of PipelineServer; keeps connections alive between requests."""
+
+    protocol_version = "HTTP/1.1"
+    server: "PipelineServer"
+
+    def _send_json(self, status: int, payload: Dict, headers: Optional[Dict] = None) -> None:
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        service = self.server.service
+        if self.path == "/health":
+            health = service.health()
+            self._send_json(200 if health["status"] == "ok" else 503, health)
+        elif self.path == "/metrics":
+            self._send_json(200, service.snapshot())
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        service = self.server.service
+        if self.path != "/requests":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            request_text = body["request"]
+            if not isinstance(request_text, str) or not request_text.strip():
+                raise ValueError("'request' must be a non-empty string")
+            if body.get("request_date"):
+                request_text = f"{request_text} (Date of request: {body['request_date']})"
+            request_id = str(body.get("request_id") or self.headers.get("X-Request-Id") or uuid.uuid4().hex)
+        except (ValueError, KeyError, TypeError) as e:
+            service.metrics.reject()
+            self._send_json(400, {"error": f"invalid request body: {e}"})
+            return
+        try:
+            response, metrics, seconds = service.submit(
+                request_text, request_id, use_parser=body.get("use_parser", True)
+            )
+        except TimeoutError:
+            self._send_json(504, {
+                "error": f"request timed out after {service.request_timeout:.0f}s",
+                "request_id": request_id,
+                "detail": "sales may still be recorded for this request; retry with the same "
+                          "request_id to avoid recording them twice",
+            }, {"X-Request-Id": request_id})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e), "request_id": request_id}, {"X-Request-Id": request_id})
+            return
+        self._send_json(
+            200,
+            {"response": response, "request_id": request_id, "seconds": round(seconds, 3), "metrics": metrics},
+            {"X-Correlation-Id": metrics.get("correlation_id", ""), "X-Request-Id": request_id},
+        )
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class PipelineServer(http.server.ThreadingHTTPServer):
+    """ThreadingHTTPServer bound to a PipelineService; one handler thread per connection."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, service: PipelineService):
+        super().__init__(address, _PipelineRequestHandler)
+        self.service = service
+
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT) -> None:
+    """Warm the pipeline once, then serve requests until interrupted."""
+    service = PipelineService()
+    service.warm_up()
+    server = PipelineServer((host, port), service)
+    print(f"Serving the order pipeline on http://{host}:{server.server_address[1]} "
+          "(POST /requests, GET /health, GET /metrics)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        flush_logs()
+
+
 if __name__ == "__main__":
-    results = run_test_scenarios()
+    cli_args = sys.argv[1:]
+    # Runs start over unless --resume is given (--fresh states the default explicitly)
+    resume = "--resume" in cli_args
+    # Automatic restocking after each request is opt-in
+    auto_reorder = "--auto-reorder" in cli_args
+    tenants = [arg.split("=", 1)[1].split(",") for arg in cli_args if arg.startswith("--tenants=")]
+    record = [arg.split("=", 1)[1] for arg in cli_args if arg.startswith("--record=")]
+    replay = [arg.split("=", 1)[1] for arg in cli_args if arg.startswith("--replay=")]
+    use_parser = "--no-parser" not in cli_args
+    if "--stub-model" in cli_args:
+        # No provider to protect, so the request-rate limit would only add waiting
+        model_rate_limiter.set_rate(1e9)
+    # --profile[=DIR] profiles whichever run the other flags select
+    profile = [arg.partition("=")[2] or PROFILE_DIR for arg in cli_args if arg.split("=", 1)[0] == "--profile"]
+    serve_at = [arg.partition("=")[2] for arg in cli_args if arg.split("=", 1)[0] == "--serve"]
+    with profiling_session(profile[0]) if profile else nullcontext():
+        if serve_at:
+            host, _, port = (serve_at[0] or f"{SERVER_HOST}:{SERVER_PORT}").rpartition(":")
+            serve(host or SERVER_HOST, int(port))
+        elif record:
+            print(json.dumps(record_run(
+                record[0], tune_steps="--tune-steps" in cli_args, use_parser=use_parser, auto_reorder=auto_reorder
+            ), indent=2))
+        elif replay:
+            report = replay_run(replay[0], use_parser=use_parser, auto_reorder=auto_reorder)
+            print(json.dumps(report, indent=2))
+            verified = report["verified"]
+        elif tenants:
+            # Every tenant processes the sample requests against its own shard
+            results = run_sharded_batches(
+                {tenant: "quote_requests_sample.csv" for tenant in tenants[0]}, resume=resume, auto_reorder=auto_reorder
+            )
+        else:
+            results = run_test_scenarios(
+                resume=resume, tune_steps="--tune-steps" in cli_args, use_parser=use_parser, auto_reorder=auto_reorder
+            )
+    if replay and not verified:
+        sys.exit(1)
@@ -0,0 +1,120 @@
+"""Tests for parse_customer_request on requests from quote_requests_sample.csv.
+
+Run from the project/ directory:
+
+    python -m pytest test_request_parser.py
+"""
+
+import os
+
+os.environ.setdefault("MODEL_PROVIDER", "stub")
+
+import pytest
+
+import project_starter as ps
+
+
+def lines_of(request_text: str) -> list:
+    return [
+        (line.quantity, line.unit, line.item_name)
+        for line in ps.parse_customer_request(request_text).lines
+    ]
+
+
+@pytest.mark.parametrize("request_text, expected", [
+    (
+        "I would like to request a large order of high-quality paper supplies for an upcoming "
+        "event. We need 500 reams of A4 paper, 300 reams of letter-sized paper, and 200 reams of "
+        "cardstock. Please ensure the delivery is made by April 15, 2025. Thank you.",
+        [(500, "reams", "A4 paper"), (300, "reams", "A4 paper"), (200, "reams", "Cardstock")],
+    ),
+    (
+        "I need to order 10 reams of standard copy paper, 5 reams of cardstock, and 3 boxes of "
+        "assorted colored paper. I need the order delivered by April 10, 2025, for an upcoming meeting.",
+        [(10, "reams", "A4 paper"), (5, "reams", "Cardstock"), (3, "boxes", "Colored paper")],
+    ),
+    (
+        "I need to order 1000 sheets of high-quality A4 paper and 500 sheets of cardstock for "
+        "printing concert materials. I need these supplies delivered by April 10, 2025.",
+        [(1000, "sheets", "A4 paper"), (500, "sheets", "Cardstock")],
+    ),
+    (
+        "We need to order 500 sheets of A4 white paper and 300 sheets of colored paper for our "
+        "assembly event. Please ensure delivery by April 15, 2025. Thank you.",
+        [(500, "sheets", "A4 paper"), (300, "sheets", "Colored paper")],
+    ),
+])
+def test_sample_requests(request_text, expected):
+    assert lines_of(request_text) == expected
+
+
+def test_inline_dash_list_is_split():
+    request_text = (
+        "I would like to order the following paper supplies for the ceremony: - 200 sheets of "
+        "A4 glossy paper - 100 sheets of heavy cardstock (white) - 100 sheets of colored paper "
+        "(assorted colors). I need these supplies delivered by April 15, 2025."
+    )
+    assert lines_of(request_text) == [
+        (200, "sheets", "Glossy paper"),
+        (100, "sheets", "Cardstock"),
+        (100, "sheets", "Colored paper"),
+    ]
+
+
+def test_bulleted_lines_with_parenthesised_details():
+    request_text = (
+        "Specifically, I need:\n\n- 1000 sheets of A4 printing paper\n- 500 sheets of A3 poster "
+        "paper\n- 200 rolls of banner paper (width: 36 inches)\n- 300 sheets of cardstock "
+        "(various colors)\n\nPlease arrange for delivery by April 15, 2025. Thank you."
+    )
+    assert lines_of(request_text) == [
+        (1000, "sheets", "A4 paper"),
+        (500, "sheets", "Large poster paper (24x36 inches)"),
+        (200, "rolls", "Rolls of banner paper (36-inch width)"),
+        (300, "sheets", "Cardstock"),
+    ]
+
+
+def test_unit_is_part_of_the_item_name():
+    assert lines_of("Please send 5 rolls of banner paper.") == [
+        (5, "rolls", "Rolls of banner paper (36-inch width)")
+    ]
+
+
+def test_reams_convert_to_sheets():
+    (line,) = ps.parse_customer_request("We need 3 reams of A4 paper.").lines
+    assert line.catalog_quantity == 1500
+
+
+def test_dates():
+    order = ps.parse_customer_request(
+        "I need 200 sheets of cardstock delivered by April 10, 2025. (Date of request: 2025-04-02)"
+    )
+    assert (order.request_date, order.needed_by) == ("2025-04-02", "2025-04-10")
+    assert [line.item_name for line in order.lines] == ["Cardstock"]
+
+
+def test_unmatched_items_leave_the_order_incomplete():
+    order = ps.parse_customer_request("We need 500 sheets of A4 paper and 20 boxes of staples.")
+    assert [line.item_name for line in order.lines] == ["A4 paper", None]
+    assert not order.is_complete
+
+
+@pytest.mark.parametrize("request_text, unparsed", [
+    ("We need 200 sheets of A4 paper and 50 balloons.", ["50 balloons"]),
+    ("We need 200 sheets of A4 paper and a banner printed with our logo.", ["a banner printed with our logo"]),
+    ("We need 500 sheets of A4 paper, 200 balloons and 50 party streamers.", ["200 balloons"]),
+    ("We need 500 sheets of A4 paper. Please also send napkins.", ["napkins"]),
+])
+def test_items_outside_the_lines_leave_the_order_incomplete(request_text, unparsed):
+    order = ps.parse_customer_request(request_text)
+    assert order.unparsed == unparsed
+    assert not order.is_complete
+
+
+def test_dates_and_purposes_are_not_items():
+    order = ps.parse_customer_request(
+        "Please deliver 300 sheets of cardstock for invitations by April 15, 2025, for our meeting."
+    )
+    assert order.unparsed == []
+    assert order.is_complete